@@ -1,5 +1,4 @@
-import os
-from artemis.fileman.config_files import get_config_path, get_config_value
+from artemis.fileman.config_files import get_config_path, get_config_value, config_file_exists, invalidate_config_cache
 
 _DEFAULT_ARTEMIS_CONFIG = """
 [plotting]
@@ -16,10 +15,10 @@ _CONFIG_FILE_NAME = '.artemisrc'
 
 
 def check_or_create_artemis_config():
-    config_path = get_config_path(_CONFIG_FILE_NAME)
-    if not os.path.exists(config_path):
-        with open(config_path, 'w') as f:
+    if not config_file_exists(_CONFIG_FILE_NAME):
+        with open(get_config_path(_CONFIG_FILE_NAME), 'w') as f:
             f.write(_DEFAULT_ARTEMIS_CONFIG)
+        invalidate_config_cache(_CONFIG_FILE_NAME)
     return _CONFIG_FILE_NAME
 
 
@@ -0,0 +1,268 @@
+import argparse
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from artemis.config import get_artemis_config_value
+from artemis.experiments.decorators import ExperimentFunction
+from artemis.experiments.experiment_management import get_experient_to_record_dict, _filter_records
+from artemis.experiments.experiment_record import get_all_record_ids, group_record_ids_by_experiment, \
+    load_experiment_record, get_experiment_dir, ExpInfoFields, ExpStatusOptions, get_serialized_args, ARTEMIS_LOGGER
+from artemis.experiments.experiments import hold_global_experiment_libary
+from artemis.fileman import config_files
+from artemis.fileman.config_files import set_non_persistent_config_value, get_config_value
+from artemis.fileman.local_dir import format_filename, make_dir
+from artemis.fileman.persistent_ordered_dict import PersistentOrderedDict
+from artemis.general.benchmarking import make_benchmark_report, run_benchmark_script
+from artemis._version import __version__ as ARTEMIS_VERSION
+
+"""
+Benchmarks for the hot paths of the experiment framework.  These run on synthetic record trees in a temporary directory,
+so your real experiment records are not touched.  Run with:
+
+    python -m artemis.experiments.benchmark_experiments -n 1000 -o results.json
+
+The results are printed and (optionally) saved as JSON, so that they can be compared across versions.
+"""
+
+RECORD_FILTERS = ('all', 'finished', 'errors', 'last', 'invalid', 'dur>1s', 'age<24h', 'finished@last', 'invalid|errors')
+
+
+@contextmanager
+def hold_experiment_dir(expdir):
+    """
+    Temporarily point the experiment directory (see get_experiment_dir) at a different location.
+    :param expdir: The temporary experiment directory
+    """
+    old_expdir = get_artemis_config_value(section="experiments", option="experiment_directory")
+    set_non_persistent_config_value(config_filename='.artemisrc', section="experiments", option="experiment_directory", value=expdir)
+    try:
+        yield expdir
+    finally:
+        set_non_persistent_config_value(config_filename='.artemisrc', section="experiments", option="experiment_directory", value=old_expdir)
+
+
+@contextmanager
+def hold_temporary_experiment_dir():
+    """
+    Point the experiment directory at a fresh temporary directory, and delete it afterwards.
+    """
+    expdir = tempfile.mkdtemp()
+    try:
+        with hold_experiment_dir(expdir):
+            yield expdir
+    finally:
+        shutil.rmtree(expdir)
+
+
+def synthetic_experiment(a, b=2):
+    return a*b
+
+
+def noop_experiment():
+    pass
+
+
+def get_synthetic_experiment_ids(n_experiments):
+    return ['synthetic_experiment.a={}'.format(i) for i in range(n_experiments)]
+
+
+def register_synthetic_experiments(n_experiments):
+    """
+    Register the experiments that the records from create_synthetic_record_tree belong to.  Call this within
+    hold_global_experiment_libary, so that they do not pollute the global library.
+    :return: The list of experiments.
+    """
+    root = ExperimentFunction(is_root=True)(synthetic_experiment)
+    return [root.add_variant(a=i) for i in range(n_experiments)]
+
+
+def _write_synthetic_record(record_dir, record_id, experiment_id, a, i, date):
+    # Mimics the files written by run_and_record, with a mix of finished/errored and valid/invalid records.
+    status = ExpStatusOptions.ERROR if i % 10 == 9 else ExpStatusOptions.FINISHED
+    args = OrderedDict([('a', a), ('b', 3 if i % 7 == 6 else 2)])  # b=3 makes the record invalid.
+    EIF = ExpInfoFields
+    PersistentOrderedDict(os.path.join(record_dir, 'info.pkl'), items=[
+        (EIF.NAME, experiment_id), (EIF.ID, record_id), (EIF.DIR, record_dir), (EIF.ARGS, get_serialized_args(args)),
+        (EIF.FUNCTION, synthetic_experiment.__name__), (EIF.TIMESTAMP, date), (EIF.MODULE, __name__), (EIF.FILE, __file__),
+        (EIF.STATUS, status), (EIF.USER, 'benchmark'), (EIF.MAC, '00:00:00:00:00:00'), (EIF.PID, 0),
+        (EIF.ARTEMIS_VERSION, ARTEMIS_VERSION), (EIF.RUNTIME, 0.5 * (i % 5)), (EIF.N_FIGS, 0), (EIF.FIGS, []),
+        ])
+    with open(os.path.join(record_dir, 'output.txt'), 'w') as f:
+        f.write('{}\n'.format(a))
+    if status is ExpStatusOptions.FINISHED:
+        with open(os.path.join(record_dir, 'result.pkl'), 'wb') as f:
+            pickle.dump(synthetic_experiment(**args), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def create_synthetic_record_tree(expdir, n_records, n_experiments, populate=False, start_time=None):
+    """
+    Create a directory of record folders, named like real records ('<timestamp>-<experiment_id>'), spread evenly
+    over n_experiments experiments.
+
+    :param expdir: The directory in which to create the records.
+    :param n_records: Total number of records to create.
+    :param n_experiments: Number of distinct experiments to spread them over.
+    :param populate: If True, fill the record folders with info, output and result files like run_and_record does.
+        Otherwise just create empty folders.
+    :param start_time: The datetime of the first record (records are 1s apart).  Defaults to one day before now.
+    :return: A list of the record ids created.
+    """
+    experiment_ids = get_synthetic_experiment_ids(n_experiments)
+    if start_time is None:
+        start_time = datetime.now() - timedelta(days=1)
+    record_ids = []
+    for i in range(n_records):
+        date = start_time + timedelta(seconds=i, microseconds=1)
+        experiment_id = experiment_ids[i % n_experiments]
+        record_id = format_filename('%T-%N', base_name=experiment_id, current_time=date)
+        record_dir = make_dir(os.path.join(expdir, record_id))
+        if populate:
+            _write_synthetic_record(record_dir, record_id=record_id, experiment_id=experiment_id, a=i % n_experiments, i=i, date=date)
+        record_ids.append(record_id)
+    return record_ids
+
+
+def _group_record_ids_by_loading(record_ids, experiment_ids):
+    # The old way: load every record just to find out which experiment it belongs to.
+    exp_rec_dict = OrderedDict((exp_id, []) for exp_id in experiment_ids)
+    for record_id in record_ids:
+        exp_id = load_experiment_record(record_id).get_experiment_id()
+        if exp_id in exp_rec_dict:
+            exp_rec_dict[exp_id].append(record_id)
+    return exp_rec_dict
+
+
+def time_function(func, n_repeats=3):
+    """
+    :param func: A function taking no arguments
+    :param n_repeats: Number of times to call it
+    :return: The fastest time, in seconds, of the calls.
+    """
+    times = []
+    for _ in range(n_repeats):
+        t_start = time.time()
+        func()
+        times.append(time.time() - t_start)
+    return min(times)
+
+
+def benchmark_record_grouping(n_records=50000, n_experiments=100, n_repeats=3):
+    """
+    Compare grouping record ids by experiment through parsing the record ids against loading each record.
+    :return: An OrderedDict<benchmark_name -> time in seconds>
+    """
+    with hold_temporary_experiment_dir() as expdir:
+        create_synthetic_record_tree(expdir, n_records=n_records, n_experiments=n_experiments)
+        experiment_ids = get_synthetic_experiment_ids(n_experiments)
+        record_ids = get_all_record_ids(expdir=get_experiment_dir())
+        assert _group_record_ids_by_loading(record_ids, experiment_ids) == group_record_ids_by_experiment(record_ids, experiment_ids)
+        return OrderedDict([
+            ('get_all_record_ids', time_function(lambda: get_all_record_ids(), n_repeats=n_repeats)),
+            ('group_by_loading_records', time_function(lambda: _group_record_ids_by_loading(record_ids, experiment_ids), n_repeats=n_repeats)),
+            ('group_by_parsing_ids', time_function(lambda: group_record_ids_by_experiment(record_ids, experiment_ids), n_repeats=n_repeats)),
+            ])
+
+
+def benchmark_record_operations(n_records=1000, n_experiments=20, n_repeats=3, filters=RECORD_FILTERS):
+    """
+    Time the operations the UI runs over every record: listing, loading, reading status/args/results, filtering and
+    rendering the experiment table.
+    :return: An OrderedDict<benchmark_name -> time in seconds>
+    """
+    from artemis.experiments.ui import ExperimentBrowser
+    with hold_temporary_experiment_dir() as expdir, hold_global_experiment_libary():
+        register_synthetic_experiments(n_experiments)
+        record_ids = create_synthetic_record_tree(expdir, n_records=n_records, n_experiments=n_experiments, populate=True)
+        records = [load_experiment_record(rid) for rid in record_ids]
+        exp_record_dict = get_experient_to_record_dict(get_synthetic_experiment_ids(n_experiments))
+        results = OrderedDict([
+            ('get_all_record_ids', time_function(lambda: get_all_record_ids(), n_repeats=n_repeats)),
+            ('get_experient_to_record_dict', time_function(lambda: get_experient_to_record_dict(list(exp_record_dict.keys())), n_repeats=n_repeats)),
+            ('load_experiment_record', time_function(lambda: [load_experiment_record(rid) for rid in record_ids], n_repeats=n_repeats)),
+            ('get_status', time_function(lambda: [load_experiment_record(rid).get_status() for rid in record_ids], n_repeats=n_repeats)),
+            ('args_valid', time_function(lambda: [load_experiment_record(rid).args_valid() for rid in record_ids], n_repeats=n_repeats)),
+            ('get_result', time_function(lambda: [rec.get_result(err_if_none=False) for rec in records], n_repeats=n_repeats)),
+            ])
+        for expr in filters:
+            results['_filter_records({})'.format(expr)] = time_function(lambda: _filter_records(expr, exp_record_dict), n_repeats=n_repeats)
+        browser = ExperimentBrowser()
+        results['get_experiment_list_str'] = time_function(lambda: browser.get_experiment_list_str(exp_record_dict), n_repeats=n_repeats)
+    return results
+
+
+def benchmark_run_and_record(n_runs=20):
+    """
+    Measure the overhead that run_and_record adds to an experiment that does nothing.
+    :return: An OrderedDict<benchmark_name -> time in seconds per run>
+    """
+    old_level = ARTEMIS_LOGGER.level
+    ARTEMIS_LOGGER.setLevel(logging.WARNING)  # Otherwise we log a few lines per run.
+    try:
+        with hold_temporary_experiment_dir(), hold_global_experiment_libary():
+            experiment = ExperimentFunction()(noop_experiment)
+            call_time = time_function(lambda: [experiment.call() for _ in range(n_runs)], n_repeats=1)/n_runs
+            run_time = time_function(lambda: [experiment.run(print_to_console=False, keep_record=True) for _ in range(n_runs)], n_repeats=1)/n_runs
+            light_run_time = time_function(lambda: [experiment.run(keep_record=True, light_table='noop_sweep') for _ in range(n_runs)], n_repeats=1)/n_runs
+    finally:
+        ARTEMIS_LOGGER.setLevel(old_level)
+    return OrderedDict([('call_noop', call_time), ('run_and_record_noop', run_time), ('run_and_record_overhead', run_time-call_time),
+        ('run_and_record_light_noop', light_run_time), ('run_and_record_light_overhead', light_run_time-call_time)])
+
+
+def benchmark_config_access(n_calls=1000):
+    """
+    Time the config lookups on the record-loading hot path (get_experiment_dir is called for every record operation).
+    :return: An OrderedDict<benchmark_name -> time in seconds per call>
+    """
+    get_expdir_option = lambda: get_artemis_config_value(section="experiments", option="experiment_directory")
+    with hold_temporary_experiment_dir():
+        results = OrderedDict([
+            ('get_experiment_dir', time_function(lambda: [get_experiment_dir() for _ in range(n_calls)], n_repeats=1)/n_calls),
+            ('get_artemis_config_value', time_function(lambda: [get_expdir_option() for _ in range(n_calls)], n_repeats=1)/n_calls),
+            ])
+        old_ttl = config_files.CONFIG_CACHE_TTL
+        config_files.CONFIG_CACHE_TTL = 0
+        try:
+            results['get_artemis_config_value_stat_every_call'] = time_function(lambda: [get_expdir_option() for _ in range(n_calls)], n_repeats=1)/n_calls
+        finally:
+            config_files.CONFIG_CACHE_TTL = old_ttl
+        results['get_config_value_uncached'] = time_function(lambda: [get_config_value('.artemisrc', section="experiments", option="experiment_directory", use_cashed_config=False) for _ in range(n_calls)], n_repeats=1)/n_calls
+    return results
+
+
+def run_benchmarks(n_records=1000, n_experiments=20, n_repeats=3, n_runs=20, n_grouping_records=50000, n_config_calls=1000):
+    """
+    Run the full benchmark suite.
+    :return: An OrderedDict containing info about the environment and a dict<benchmark_name -> time in seconds>
+    """
+    benchmarks = OrderedDict()
+    for group, results in [
+            ('record_operations', benchmark_record_operations(n_records=n_records, n_experiments=n_experiments, n_repeats=n_repeats)),
+            ('record_grouping', benchmark_record_grouping(n_records=n_grouping_records, n_experiments=n_experiments, n_repeats=n_repeats)),
+            ('run_and_record', benchmark_run_and_record(n_runs=n_runs)),
+            ('config_access', benchmark_config_access(n_calls=n_config_calls)),
+            ]:
+        for name, duration in results.items():
+            benchmarks['{}/{}'.format(group, name)] = duration
+    return make_benchmark_report(
+        settings=[('n_records', n_records), ('n_experiments', n_experiments), ('n_repeats', n_repeats), ('n_runs', n_runs), ('n_grouping_records', n_grouping_records), ('n_config_calls', n_config_calls)],
+        benchmarks=benchmarks,
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the experiment framework on synthetic record trees.')
+    parser.add_argument('-n', '--n_records', type=int, default=1000, help='Number of synthetic records for the record-operation benchmarks')
+    parser.add_argument('-e', '--n_experiments', type=int, default=20, help='Number of experiments to spread the records over')
+    parser.add_argument('-g', '--n_grouping_records', type=int, default=50000, help='Number of (empty) synthetic records for the grouping benchmark')
+    parser.add_argument('-r', '--n_repeats', type=int, default=3, help='Number of times to repeat each timing (we report the fastest)')
+    parser.add_argument('-R', '--n_runs', type=int, default=20, help='Number of no-op experiment runs to average run_and_record overhead over')
+    parser.add_argument('-c', '--n_config_calls', type=int, default=1000, help='Number of calls to average the cost of config lookups over')
+    run_benchmark_script(run_benchmarks, parser, unit='s')
@@ -14,13 +14,17 @@ from time import time
 
 import math
 
+from artemis.fileman.file_lock import write_file_atomically
 from artemis.fileman.local_dir import make_dir
 from artemis.general.display import equalize_string_lengths
 from six import string_types
-from six.moves import reduce, xrange
+from six.moves import reduce, xrange, shlex_quote
 from artemis.experiments.experiment_record import (load_experiment_record, ExpInfoFields,
                                                    ExpStatusOptions, ARTEMIS_LOGGER, record_id_to_experiment_id,
-                                                   get_all_record_ids, get_experiment_dir, has_experiment_record)
+                                                   get_all_record_ids, get_experiment_dir, has_experiment_record,
+                                                   group_record_ids_by_experiment, LightExperimentRecord,
+                                                   parse_experiment_id_from_record_id, LIGHT_RECORD_TABLE_EXTENSION,
+                                                   append_light_record, merge_light_record_tables)
 from artemis.experiments.experiments import load_experiment, get_global_experiment_library
 from artemis.fileman.config_files import get_home_dir,set_non_persistent_config_value
 from artemis.general.hashing import compute_fixed_hash
@@ -81,6 +85,202 @@ def pull_experiment_records(user, ip, experiment_names, include_variants=True, n
     return output
 
 
+def _quote_path(path):
+    # Quote a path for the shell, but leave a leading ~ so that it is expanded on the machine that runs the command
+    return '~/'+shlex_quote(path[2:]) if path.startswith('~/') else shlex_quote(path)
+
+
+def _get_shell_command(command, user=None, ip=None):
+    """
+    :param command: A shell command string
+    :param user, ip: The machine to run it on.  If ip is None, run it locally (useful for testing).
+    :return: A list of args to pass to subprocess.
+    """
+    return ['sh', '-c', command] if ip is None else ['ssh', '{}@{}'.format(user, ip) if user is not None else ip, command]
+
+
+def _parse_record_manifest(lines):
+    """
+    :param lines: Lines of "relative_path<tab>mtime<tab>size" for every file in an experiment directory.
+    :return: A dict<name -> (mtime, size, n_files)>, where name is a record id (the directory containing the file) or
+        the file name of a lightweight record table.
+    """
+    manifest = {}
+    for line in lines:
+        if len(line.strip())==0:
+            continue
+        rel_path, mtime, size = line.rstrip('\n').rsplit('\t', 2)
+        name = rel_path.split('/', 1)[0]
+        if name == rel_path and not name.endswith(LIGHT_RECORD_TABLE_EXTENSION):
+            continue  # Some other file in the experiment directory
+        old_mtime, old_size, old_n = manifest.get(name, (0, 0, 0))
+        manifest[name] = (max(old_mtime, int(float(mtime))), old_size+int(size), old_n+1)
+    return manifest
+
+
+def get_record_manifest(expdir=None):
+    """
+    Get the manifest of a local experiment directory, in the same format as get_remote_record_manifest.
+    :param expdir: The experiment directory (defaults to the current one)
+    :return: A dict<name -> (mtime, size, n_files)>  (see _parse_record_manifest)
+    """
+    if expdir is None:
+        expdir = get_experiment_dir()
+    lines = []
+    for name in os.listdir(expdir):
+        path = os.path.join(expdir, name)
+        if os.path.isdir(path):
+            for filename in os.listdir(path):
+                file_path = os.path.join(path, filename)
+                if os.path.isfile(file_path):
+                    stat = os.stat(file_path)
+                    lines.append('{}/{}\t{}\t{}'.format(name, filename, stat.st_mtime, stat.st_size))
+        elif name.endswith(LIGHT_RECORD_TABLE_EXTENSION):
+            stat = os.stat(path)
+            lines.append('{}\t{}\t{}'.format(name, stat.st_mtime, stat.st_size))
+    return _parse_record_manifest(lines)
+
+
+# Lists "relative_path<tab>mtime<tab>size" for the files in an experiment directory and its subdirectories.  We run this
+# with whatever python the remote has, because the listing options of find and stat differ between GNU and BSD/macOS.
+_LIST_RECORD_FILES_SCRIPT = """
+import os, sys
+root = sys.argv[1]
+for name in os.listdir(root):
+    path = os.path.join(root, name)
+    for rel_path in ([name+'/'+f for f in os.listdir(path)] if os.path.isdir(path) else [name]):
+        full_path = os.path.join(root, rel_path)
+        if os.path.isfile(full_path):
+            stat = os.stat(full_path)
+            sys.stdout.write('%s\\t%r\\t%d\\n' % (rel_path, stat.st_mtime, stat.st_size))
+"""
+
+
+def get_remote_record_manifest(user, ip, remote_dir='~/.artemis/experiments'):
+    """
+    Get a compact manifest of the records on another computer.  This is a single listing of the remote experiment
+    directory, which is much cheaper than having rsync build and compare its full file list.
+
+    :param user: User name on the remote machine
+    :param ip: IP address of the remote machine, or None to treat remote_dir as a local directory.
+    :param remote_dir: The remote experiment directory
+    :return: A dict<name -> (mtime, size, n_files)>  (see _parse_record_manifest)
+    """
+    command = '"$(command -v python3 || command -v python)" -c {} {}'.format(shlex_quote(_LIST_RECORD_FILES_SCRIPT), _quote_path(remote_dir))
+    output = subprocess.check_output(_get_shell_command(command, user=user, ip=ip))
+    return _parse_record_manifest(output.decode('utf-8').split('\n'))
+
+
+def get_records_to_pull(remote_manifest, local_manifest, experiment_names=None, include_variants=True):
+    """
+    :param remote_manifest: A manifest from get_remote_record_manifest
+    :param local_manifest: A manifest from get_record_manifest
+    :param experiment_names: Only include records of these experiments (or None to include all)
+    :param include_variants: Also include records of variants of these experiments
+    :return: A sorted list of record ids (and lightweight-record table names) that are new or have changed on the remote.
+        Lightweight-record tables can mix experiments, so they are included whenever they have changed.
+    """
+    if experiment_names is not None:
+        experiment_names = set(experiment_names)
+    names = []
+    for name, entry in remote_manifest.items():
+        if local_manifest.get(name) == entry:
+            continue
+        if experiment_names is not None and not name.endswith(LIGHT_RECORD_TABLE_EXTENSION):
+            exp_id = parse_experiment_id_from_record_id(name)
+            if exp_id is None or not (exp_id in experiment_names or include_variants and any(exp_id.startswith(e+'.') for e in experiment_names)):
+                continue
+        names.append(name)
+    return sorted(names)
+
+
+_PULLED_TABLES_FILE_NAME = '.pulled_light_record_tables'  # Manifest entries of the remote tables that were last merged
+
+
+def _load_pulled_table_entries(local_dir):
+    path = os.path.join(local_dir, _PULLED_TABLES_FILE_NAME)
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                name, mtime, size, n_files = line.rstrip('\n').split('\t')
+                entries[name] = (int(mtime), int(size), int(n_files))
+    return entries
+
+
+def _start_tar_transfer(names, user, ip, remote_dir, local_dir):
+    # Start copying the named files/directories from remote_dir to local_dir through a tar stream.  Returns the processes.
+    sender = subprocess.Popen(_get_shell_command('tar -C {} -cf - -T -'.format(_quote_path(remote_dir)), user=user, ip=ip), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    receiver = subprocess.Popen(['tar', '-C', local_dir, '--no-same-owner', '-xf', '-'], stdin=sender.stdout)
+    sender.stdout.close()  # So that the sender gets a SIGPIPE if the receiver dies
+    sender.stdin.write(''.join(name+'\n' for name in names).encode('utf-8'))
+    sender.stdin.close()
+    return [sender, receiver]
+
+
+def pull_experiment_records_incrementally(user, ip, experiment_names=None, include_variants=True,
+        remote_dir='~/.artemis/experiments', local_dir=None, n_streams=4):
+    """
+    Pull experiment records from another computer, transferring only records that are new or have changed.  We first
+    fetch a manifest of the remote records (see get_remote_record_manifest), compare it to the local one, and then copy
+    the changed records over n_streams parallel "tar" streams through ssh.  Pulling when nothing has changed costs one
+    directory listing on the remote.
+
+    Tables of lightweight records are not copied over the local ones (which may have rows of their own).  They are
+    copied to a temporary directory, and their rows are merged into the local tables by record id.  (The remote table is
+    copied without its lock, so if a row is being appended as we copy, it is skipped, and merged on the next pull.)
+
+    :param user: User name on the remote machine
+    :param ip: IP address of the remote machine, or None to treat remote_dir as a local directory.
+    :param experiment_names: Names of experiments whose records to pull, or None to pull all records.
+    :param include_variants: Also pull records of variants of these experiments
+    :param remote_dir: The experiment directory on the remote machine.
+    :param local_dir: The local experiment directory (defaults to the current one)
+    :param n_streams: Number of transfers to run in parallel.
+    :return: A list of the record ids (and lightweight-record tables) that were pulled.
+    """
+    if isinstance(experiment_names, string_types):
+        experiment_names = [experiment_names]
+    if local_dir is None:
+        local_dir = get_experiment_dir()
+    make_dir(local_dir)
+    remote_manifest = get_remote_record_manifest(user=user, ip=ip, remote_dir=remote_dir)
+    local_manifest = get_record_manifest(local_dir)
+    pulled_table_entries = _load_pulled_table_entries(local_dir)
+    for name in list(local_manifest.keys()):
+        if name.endswith(LIGHT_RECORD_TABLE_EXTENSION):  # Compare tables to the remote version we last merged
+            local_manifest[name] = pulled_table_entries.get(name)
+    to_pull = get_records_to_pull(
+        remote_manifest = remote_manifest,
+        local_manifest = local_manifest,
+        experiment_names = experiment_names,
+        include_variants = include_variants
+        )
+    tables = [name for name in to_pull if name.endswith(LIGHT_RECORD_TABLE_EXTENSION)]
+    record_ids = [name for name in to_pull if not name.endswith(LIGHT_RECORD_TABLE_EXTENSION)]
+    staging_dir = tempfile.mkdtemp() if len(tables) > 0 else None
+    try:
+        processes = []
+        for names in divide_into_subsets(record_ids, subset_size=int(math.ceil(len(record_ids)/float(n_streams)))) if len(record_ids)>0 else []:
+            processes += _start_tar_transfer(names, user=user, ip=ip, remote_dir=remote_dir, local_dir=local_dir)
+        if len(tables) > 0:
+            processes += _start_tar_transfer(tables, user=user, ip=ip, remote_dir=remote_dir, local_dir=staging_dir)
+        return_codes = [p.wait() for p in processes]
+        if any(code != 0 for code in return_codes):
+            raise subprocess.CalledProcessError(max(return_codes), 'tar')
+        for name in tables:
+            merge_light_record_tables(os.path.join(staging_dir, name), os.path.join(local_dir, name))
+            pulled_table_entries[name] = remote_manifest[name]
+        if len(tables) > 0:
+            lines = ''.join('{}\t{}\t{}\t{}\n'.format(name, *entry) for name, entry in sorted(pulled_table_entries.items()))
+            write_file_atomically(os.path.join(local_dir, _PULLED_TABLES_FILE_NAME), lambda f: f.write(lines.encode('utf-8')))
+    finally:
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir)
+    ARTEMIS_LOGGER.info('Pulled {} new or changed records from {}'.format(len(to_pull), remote_dir if ip is None else ip))
+    return to_pull
+
+
 def load_lastest_experiment_results(experiments, error_if_no_result = True):
     """
     Given a list of experiments (or experiment ids), return an OrderedDict<record_id: result>
@@ -528,8 +728,11 @@ def run_multiple_experiments(experiments, prefixes = None, parallel = False, dis
         print ('Prefix key: \n'+'\n'.join('{}{}'.format(p, eid) for p, eid in izip_equal(prefixes, experiment_identifiers)))
         target_func = partial(_parallel_run_target, notes=notes, raise_exceptions=raise_exceptions, **run_args)
         p = multiprocessing.Pool(processes=parallel)
-
-        return p.map(target_func, zip(experiment_identifiers, prefixes))
+        try:
+            return p.map(target_func, zip(experiment_identifiers, prefixes))
+        finally:
+            p.close()
+            p.join()
     else:
         return [ex.run(raise_exceptions=raise_exceptions, display_results=display_results, notes=notes, **run_args) for ex in experiments]
 
@@ -558,13 +761,8 @@ def get_experient_to_record_dict(experiment_ids = None):
     """
     if experiment_ids is None:
         experiment_ids = get_global_experiment_library().keys()
-    record_ids = get_all_record_ids(experiment_ids)
-    exp_rec_dict = OrderedDict((exp_id, []) for exp_id in experiment_ids)
-    for rid in record_ids:
-        rec = load_experiment_record(rid)
-        exp_id = rec.get_experiment_id()
-        exp_rec_dict[exp_id].append(rid)
-    return exp_rec_dict
+    expdir = get_experiment_dir()
+    return group_record_ids_by_experiment(get_all_record_ids(expdir=expdir), experiment_ids, expdir=expdir)
 
 
 def deprefix_experiment_ids(experiment_ids):
@@ -602,13 +800,18 @@ def deprefix_experiment_ids(experiment_ids):
 def archive_record(record):
     """
     :param ExperimentRecord record:
-    :return str: New directory
+    :return str: New directory (or for a lightweight record, the table in the archive that its row was moved to)
     """
     record_dir = record.get_dir()
     exp_dir, record_name = os.path.split(record_dir)
     new_home = os.path.normpath(os.path.join(exp_dir, '..', 'experiment-archive'))
     if not os.path.exists(new_home):
         make_dir(new_home)
+    if isinstance(record, LightExperimentRecord):
+        new_table_path = os.path.join(new_home, os.path.basename(record.get_table_path()))
+        append_light_record(LightExperimentRecord(new_table_path, record.get_id(), row=record.row))
+        record.delete()
+        return new_table_path
     shutil.move(record_dir, new_home)
     new_record_path = os.path.join(new_home, record_name)
     assert os.path.exists(new_record_path)
@@ -3,6 +3,7 @@ import inspect
 import logging
 import os
 import pickle
+import re
 import shutil
 import signal
 import sys
@@ -11,6 +12,7 @@ import time
 import traceback
 from collections import OrderedDict
 from contextlib import contextmanager
+from functools import partial
 from getpass import getuser
 from pickle import PicklingError
 
@@ -18,6 +20,7 @@ from datetime import datetime, timedelta
 from uuid import getnode
 
 from artemis.config import get_artemis_config_value
+from artemis.fileman.file_lock import hold_file_lock, write_file_atomically
 from artemis.fileman.local_dir import format_filename, make_file_dir, get_artemis_data_path, make_dir
 from artemis.fileman.persistent_ordered_dict import PersistentOrderedDict
 from artemis.general.display import CaptureStdOut
@@ -295,7 +298,10 @@ class ExperimentRecord(object):
         return load_experiment(self.get_experiment_id())
 
     def get_experiment_id(self):
-        return self.get_id()[27:]
+        experiment_id = parse_experiment_id_from_record_id(self.get_id())
+        if experiment_id is None:  # Non-standard identifier, so we fall back to the name saved in the info file.
+            experiment_id = self.info.get_field(ExpInfoFields.NAME, default=self.get_id()[27:])
+        return experiment_id
 
     def get_timestamp(self):
         return time.mktime(self.get_datetime().timetuple())
@@ -403,6 +409,235 @@ class ExperimentRecord(object):
             raise Exception('Cannot kill a process with status "{}", for it is already dead.'.format(status))
 
 
+class LightExperimentRecordInfo(ExperimentRecordInfo):
+    """
+    The info of a LightExperimentRecord.  This behaves like ExperimentRecordInfo, but is held in memory, as part of a
+    row of the record table, rather than in its own file.
+    """
+
+    def __init__(self, info_dict):
+        self._text_path = None
+        self.persistent_obj = info_dict
+
+
+class LightExperimentRecord(ExperimentRecord):
+    """
+    A record of a run in "lightweight" mode (see run_and_record_light).  Instead of having its own directory, the record
+    is a row in a table file shared by all lightweight runs of a sweep.  The row holds the info (args, status, runtime,
+    etc.) and the result, but no console output or figures are saved.
+    """
+
+    def __init__(self, table_path, record_id, row=None):
+        ExperimentRecord.__init__(self, os.path.join(os.path.dirname(table_path), record_id))
+        self._table_path = table_path
+        self._row = row
+
+    @property
+    def row(self):
+        if self._row is None:
+            self._row = load_light_record_table(self._table_path)[self.get_id()]
+        return self._row
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = LightExperimentRecordInfo(self.row['info'])
+        return self._info
+
+    def __reduce__(self):
+        return self.__class__, (self._table_path, self.get_id())
+
+    def get_table_path(self):
+        """
+        :return: The path of the table file containing this record.
+        """
+        return self._table_path
+
+    def get_args_hash(self):
+        """
+        :return: The hash of the arguments with which this record was run (or None if they could not be hashed).
+        """
+        return self.row['args_hash']
+
+    def get_log(self):
+        return ''
+
+    def list_files(self, full_path=False):
+        return []
+
+    def open_file(self, filename, *args, **kwargs):
+        raise ValueError('Lightweight record {} has no directory, so it has no files to open.  Run the experiment without light_table to save files.'.format(self.get_id()))
+
+    def get_figure_locs(self, include_directory=True):
+        return []
+
+    def has_result(self):
+        return 'result' in self.row
+
+    def get_result(self, err_if_none = True):
+        if 'result' in self.row:
+            return self.row['result']
+        elif err_if_none:
+            raise NoSavedResultError(self.get_id())
+        else:
+            return None
+
+    def save_result(self, result):
+        # The result is written to the table when the run ends (see run_and_record_light)
+        self.row['result'] = result
+
+    def get_error_trace(self):
+        return self.row.get('error_trace', None)
+
+    def write_error_trace(self, print_too = True):
+        assert 'error_trace' not in self.row, 'Error trace has already been created in this experiment... Something fishy going on here.'
+        error_text = traceback.format_exc()
+        self.row['error_trace'] = error_text
+        if print_too:
+            print(error_text)
+
+    def delete(self):
+        delete_light_records([self.get_id()], table_path=self._table_path)
+
+
+LIGHT_RECORD_TABLE_EXTENSION = '.lightrecords'
+
+_LIGHT_RECORD_TABLE_CACHE = {}  # table_path -> ((mtime, size), OrderedDict<record_id -> row>)
+
+_LIGHT_RECORD_INDEX = {}  # expdir -> dict<record_id -> table_path>
+
+
+def get_light_record_table_path(table_name, expdir = None):
+    """
+    :param table_name: The name of the table (e.g. the name of the sweep)
+    :param expdir: The experiment directory, or None to use the default.
+    :return: The path to the table file that lightweight records of this name are appended to.
+    """
+    assert '/' not in table_name, 'Table names cannot have "/" in them: {}'.format(table_name)
+    if expdir is None:
+        expdir = get_experiment_dir()
+    return os.path.join(expdir, table_name + LIGHT_RECORD_TABLE_EXTENSION)
+
+
+def load_light_record_table(table_path):
+    """
+    Load the rows of a table of lightweight records.  Tables are cached, and only re-read when the file changes.
+    :param table_path: Path to the table file
+    :return: An OrderedDict<record_id -> row>, where a row is a dict containing the 'info' (an
+        OrderedDict<ExpInfoFields -> value>), the 'args_hash', and optionally the 'result' and 'error_trace'.
+    """
+    if not os.path.exists(table_path):
+        return OrderedDict()
+    stat = os.stat(table_path)
+    code = (stat.st_mtime, stat.st_size)
+    if table_path in _LIGHT_RECORD_TABLE_CACHE and _LIGHT_RECORD_TABLE_CACHE[table_path][0] == code:
+        return _LIGHT_RECORD_TABLE_CACHE[table_path][1]
+    rows = OrderedDict()
+    with open(table_path, 'rb') as f:
+        while True:
+            try:
+                row = pickle.load(f)
+            except EOFError:
+                break
+            except Exception:  # Can happen if a process was killed while appending its row.
+                ARTEMIS_LOGGER.warning('Table of lightweight records {} ended with a corrupt row, which was ignored.'.format(table_path))
+                break
+            rows[row['info'][ExpInfoFields.ID]] = row
+    _LIGHT_RECORD_TABLE_CACHE[table_path] = (code, rows)
+    return rows
+
+
+def get_light_record_table_lock_path(table_path):
+    """
+    :param table_path: Path to a table of lightweight records
+    :return: The path of the lock file held while the table is appended to or rewritten.
+    """
+    return table_path + '.lock'
+
+
+def append_light_record(record):
+    """
+    Append a lightweight record to its table.  Rows are appended while holding a lock on the table, so processes running
+    different experiments of a sweep in parallel can share a table.
+    :param LightExperimentRecord record: The record to append
+    """
+    data = pickle.dumps(record.row, protocol=pickle.HIGHEST_PROTOCOL)
+    table_path = make_file_dir(record.get_table_path())
+    with hold_file_lock(get_light_record_table_lock_path(table_path)):
+        with open(table_path, 'ab') as f:
+            f.write(data)
+
+
+def merge_light_record_tables(source_path, table_path):
+    """
+    Add the rows of one table of lightweight records (e.g. a copy pulled from another computer) to another table, skipping
+    records that it already has.
+    :param source_path: Path to the table whose rows to add
+    :param table_path: Path to the table to add them to (created if it does not exist)
+    :return: A list of the ids of the records that were added.
+    """
+    source_rows = load_light_record_table(source_path)
+    make_file_dir(table_path)
+    with hold_file_lock(get_light_record_table_lock_path(table_path)):
+        _LIGHT_RECORD_TABLE_CACHE.pop(table_path, None)
+        existing_rows = load_light_record_table(table_path)
+        new_rows = [row for rid, row in source_rows.items() if rid not in existing_rows]
+        if len(new_rows) > 0:
+            with open(table_path, 'ab') as f:
+                _write_light_record_rows(new_rows, f)
+        _LIGHT_RECORD_TABLE_CACHE.pop(table_path, None)
+    return [row['info'][ExpInfoFields.ID] for row in new_rows]
+
+
+def _write_light_record_rows(rows, f):
+    for row in rows:
+        pickle.dump(row, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def delete_light_records(record_ids, table_path=None, expdir = None):
+    """
+    Delete lightweight records by rewriting the tables that contain them.
+    :param record_ids: A list of record ids
+    :param table_path: The table containing the records, or None to look them up in the experiment directory.
+    :param expdir: The experiment directory, or None to use the default.
+    """
+    if table_path is None:
+        index = get_light_record_index(expdir=expdir)
+        table_paths = set(index[rid] for rid in record_ids if rid in index)
+    else:
+        table_paths = [table_path]
+    record_ids = set(record_ids)
+    for path in table_paths:
+        with hold_file_lock(get_light_record_table_lock_path(path)):  # So that no rows are appended while we rewrite
+            _LIGHT_RECORD_TABLE_CACHE.pop(path, None)
+            rows = [row for rid, row in load_light_record_table(path).items() if rid not in record_ids]
+            if len(rows)==0:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                write_file_atomically(path, partial(_write_light_record_rows, rows))
+            _LIGHT_RECORD_TABLE_CACHE.pop(path, None)
+
+
+def get_light_record_index(expdir = None, filenames = None):
+    """
+    :param expdir: The experiment directory, or None to use the default.
+    :param filenames: The contents of the experiment directory, if you've already listed them.
+    :return: A dict<record_id -> table_path> for all lightweight records in the experiment directory.
+    """
+    if expdir is None:
+        expdir = get_experiment_dir()
+    if filenames is None:
+        filenames = os.listdir(expdir)
+    index = {}
+    for filename in filenames:
+        if filename.endswith(LIGHT_RECORD_TABLE_EXTENSION):
+            table_path = os.path.join(expdir, filename)
+            index.update((rid, table_path) for rid in load_light_record_table(table_path))
+    _LIGHT_RECORD_INDEX[expdir] = index
+    return index
+
+
 _CURRENT_EXPERIMENT_RECORD = None
 
 
@@ -527,8 +762,31 @@ def open_in_record_dir(filename, *args, **kwargs):
     return get_current_experiment_record().open_file(filename, *args, **kwargs)
 
 
-def record_id_to_experiment_id(record_id):
-    return load_experiment_record(record_id).get_experiment_id()
+_RECORD_ID_PREFIX_REGEX = re.compile(r'^\d{4}\.\d{2}\.\d{2}T\d{2}\.\d{2}\.\d{2}(\.\d{6})?-')
+
+
+def parse_experiment_id_from_record_id(record_id):
+    """
+    Get the experiment id from a record id of the standard format '<timestamp>-<experiment_id>' (see record_experiment),
+    without touching the disk.
+    :param record_id: A string identifying the experiment record
+    :return: The experiment id, or None if the record id is not in the standard format.
+    """
+    match = _RECORD_ID_PREFIX_REGEX.match(record_id)
+    return record_id[match.end():] if match is not None else None
+
+
+def record_id_to_experiment_id(record_id, expdir = None):
+    """
+    :param record_id: A string identifying the experiment record
+    :param expdir: The experiment directory, or None to use the default.
+    :return: The id of the experiment that the record belongs to.  This is parsed from the record id where possible, and
+        only read from the record's info file when the record id is not in the standard format.
+    """
+    experiment_id = parse_experiment_id_from_record_id(record_id)
+    if experiment_id is None:
+        experiment_id = load_experiment_record(record_id, expdir=expdir).get_experiment_id()
+    return experiment_id
 
 
 def delete_experiment_with_id(experiment_identifier):
@@ -564,11 +822,12 @@ def merge_experiment_dicts(*dicts):
     return merge_dict
 
 
-def filter_experiment_ids(record_ids, expr=None, experiment_ids=None):
+def filter_experiment_ids(record_ids, expr=None, experiment_ids=None, expdir=None):
     if expr is not None:
         record_ids = [e for e in record_ids if expr in e]
     if experiment_ids is not None:
-        record_ids = [record_id for record_id in record_ids if ExperimentRecord(record_id).get_experiment_id() in experiment_ids]
+        experiment_ids = set(experiment_ids)
+        record_ids = [record_id for record_id in record_ids if record_id_to_experiment_id(record_id, expdir=expdir) in experiment_ids]
     return record_ids
 
 
@@ -581,8 +840,10 @@ def get_all_record_ids(experiment_ids=None, filters=None, expdir = None):
     """
     if expdir is None:
         expdir = get_experiment_dir()
-    ids = [e for e in os.listdir(expdir) if os.path.isdir(os.path.join(expdir, e))]
-    ids = filter_experiment_ids(record_ids=ids, experiment_ids=experiment_ids)
+    filenames = os.listdir(expdir)
+    ids = [e for e in filenames if os.path.isdir(os.path.join(expdir, e))]
+    ids += list(get_light_record_index(expdir=expdir, filenames=filenames).keys())
+    ids = filter_experiment_ids(record_ids=ids, experiment_ids=experiment_ids, expdir=expdir)
     if filters is not None:
         for expr in filters:
             ids = filter_experiment_ids(record_ids=ids, expr=expr)
@@ -590,6 +851,27 @@ def get_all_record_ids(experiment_ids=None, filters=None, expdir = None):
     return ids
 
 
+def group_record_ids_by_experiment(record_ids, experiment_ids, expdir = None):
+    """
+    Group record ids by the experiment they belong to.  The experiment id is parsed from each record id, so records are
+    only loaded when their id is not in the standard '<timestamp>-<experiment_id>' format.
+
+    :param Sequence[str] record_ids: A list of record ids
+    :param Sequence[str] experiment_ids: A list of experiment ids.  Records of other experiments are dropped.
+    :param expdir: The experiment directory, or None to use the default.
+    :return OrderedDict[str, List[str]]: A dict<experiment_id -> list<experiment_record_id>>, with keys in the order of
+        experiment_ids and records in the order of record_ids.
+    """
+    if expdir is None:
+        expdir = get_experiment_dir()
+    exp_rec_dict = OrderedDict((exp_id, []) for exp_id in experiment_ids)
+    for record_id in record_ids:
+        exp_id = record_id_to_experiment_id(record_id, expdir=expdir)
+        if exp_id in exp_rec_dict:
+            exp_rec_dict[exp_id].append(record_id)
+    return exp_rec_dict
+
+
 def get_experiment_to_record_mapping(experiments):
     """
     Get a dictionary mapping each experiment in the provided list to its list of recrods.
@@ -598,12 +880,9 @@ def get_experiment_to_record_mapping(experiments):
     :param Sequence[Experiment] experiments: A collection of experiments
     :return Mapping[Experiment, Sequence[ExperimentRecord]]: The resulting mapping
     """
-    all_relavent_record_ids = get_all_record_ids(experiment_ids=[exp.get_id() for exp in experiments])
-    id_map = OrderedDict((ex, []) for ex in experiments)
-    for record_id in all_relavent_record_ids:
-        record = load_experiment_record(record_id=record_id)
-        id_map[record.get_experiment()].append(record)
-    return id_map
+    expdir = get_experiment_dir()
+    exp_rec_dict = group_record_ids_by_experiment(get_all_record_ids(expdir=expdir), [ex.get_id() for ex in experiments], expdir=expdir)
+    return OrderedDict((ex, [load_experiment_record(record_id, expdir=expdir) for record_id in exp_rec_dict[ex.get_id()]]) for ex in experiments)
 
 
 def get_experiment_to_latest_record_mapping(experiments):
@@ -643,6 +922,11 @@ def load_experiment_record(record_id, expdir = None):
     if expdir is None:
         expdir = get_experiment_dir()
     path = os.path.join(expdir, record_id)
+    light_index = _LIGHT_RECORD_INDEX.get(expdir, {})
+    if record_id not in light_index and not os.path.isdir(path):  # Maybe it's a lightweight record we don't know about yet
+        light_index = get_light_record_index(expdir=expdir)
+    if record_id in light_index:
+        return LightExperimentRecord(light_index[record_id], record_id)
     return ExperimentRecord(path)
 
 
@@ -652,9 +936,12 @@ def clear_experiment_records(ids):
     :param ids: A list of experiment ids, or None to remove all.
     """
     folder = get_experiment_dir()
+    light_index = get_light_record_index(expdir=folder)
     for exp_id in ids:
-        exp_path = os.path.join(folder, exp_id)
-        ExperimentRecord(exp_path).delete()
+        if exp_id not in light_index:
+            exp_path = os.path.join(folder, exp_id)
+            ExperimentRecord(exp_path).delete()
+    delete_light_records([exp_id for exp_id in ids if exp_id in light_index], expdir=folder)
 
 
 def save_figure_in_record(name, fig=None, default_ext='.pkl'):
@@ -703,8 +990,70 @@ def load_serialized_args(ser_args):
         return ser_args
 
 
+def run_and_record_light(function, experiment_id, light_table, keep_record=True, raise_exceptions=True, notes = ()):
+    """
+    Run an experiment function in "lightweight" mode, which is meant for big sweeps of tiny runs.  Instead of creating a
+    record directory, capturing the console output and saving figures, we append a row containing the args, their
+    hash, the status, the runtime and the result to a table shared by all runs with the same light_table.  The records
+    still show up in the UI and can be selected like other records.  Keep the results small, as the whole table is
+    loaded when browsing.
+
+    :param function: A function which takes no args.
+    :param experiment_id: The name under which you'd like to save this run of this experiment.
+    :param light_table: The name of the table to append to (e.g. the name of your sweep).
+    :param keep_record: If False, the row is not written.
+    :param raise_exceptions: True to raise any exception that occurs when running the experiment.
+    :param notes: A list of notes to save with the record.
+    :return: A generator yielding the LightExperimentRecord object (see run_and_record).
+    """
+    EIF = ExpInfoFields
+    date = datetime.now()
+    record_id = format_filename(file_string='%T-%N', base_name=experiment_id, current_time=date)
+    root_function = get_partial_chain(function)[0]
+    args, undefined_args = get_defined_and_undefined_args(function)
+    assert len(undefined_args)==0, "Required arguments {} are still undefined!".format(undefined_args)
+    try:
+        args_hash = compute_fixed_hash(dict(args), try_objects=True)
+    except NotImplementedError:  # Happens when we have unhashable arguments
+        args_hash = None
+    module = inspect.getmodule(root_function)
+    info = OrderedDict([
+        (EIF.NAME, experiment_id), (EIF.ID, record_id), (EIF.ARGS, get_serialized_args(args)),
+        (EIF.FUNCTION, root_function.__name__), (EIF.TIMESTAMP, date), (EIF.MODULE, module.__name__),
+        (EIF.STATUS, ExpStatusOptions.STARTED), (EIF.PID, os.getpid()), (EIF.ARTEMIS_VERSION, ARTEMIS_VERSION),
+        ])
+    if len(notes)>0:
+        info[EIF.NOTES] = list(notes)
+    record = LightExperimentRecord(get_light_record_table_path(light_table), record_id, row=dict(info=info, args_hash=args_hash))
+
+    start_time = time.time()
+    try:
+        with hold_current_experiment_record(record):
+            if inspect.isgeneratorfunction(root_function):
+                for result in function():
+                    record.save_result(result)
+                    yield record
+            else:
+                record.save_result(function())
+        record.info.set_field(EIF.STATUS, ExpStatusOptions.FINISHED)
+    except (KeyboardInterrupt, GeneratorExit):
+        record.info.set_field(EIF.STATUS, ExpStatusOptions.STOPPED)
+        record.write_error_trace(print_too=False)
+        raise
+    except Exception:
+        record.info.set_field(EIF.STATUS, ExpStatusOptions.ERROR)
+        record.write_error_trace(print_too=not raise_exceptions)
+        if raise_exceptions:
+            raise
+    finally:
+        record.info.set_field(EIF.RUNTIME, time.time() - start_time)
+        if keep_record:
+            append_light_record(record)
+    yield record
+
+
 def run_and_record(function, experiment_id, print_to_console=True, show_figs=None, test_mode=None, keep_record=None,
-        raise_exceptions=True, notes = (), prefix=None, **experiment_record_kwargs):
+        raise_exceptions=True, notes = (), prefix=None, light_table=None, **experiment_record_kwargs):
     """
     Run an experiment function.  Save the console output, return values, and any matplotlib figures generated to a new
     experiment folder in ~/.artemis/experiments
@@ -717,6 +1066,8 @@ def run_and_record(function, experiment_id, print_to_console=True, show_figs=Non
     :param keep_record:
     :param raise_exceptions:
     :param notes:
+    :param light_table: If not None, run in lightweight mode, and append the record to the table with this name instead
+        of creating a record directory.  See run_and_record_light.
     :param experiment_record_kwargs:
     :return: The ExperimentRecord object
     """
@@ -724,6 +1075,17 @@ def run_and_record(function, experiment_id, print_to_console=True, show_figs=Non
     if test_mode is None:
         test_mode = is_test_mode()
 
+    if light_table is not None:
+        old_test_mode = is_test_mode()
+        set_test_mode(test_mode)
+        try:
+            for exp_rec in run_and_record_light(function, experiment_id=experiment_id, light_table=light_table,
+                    keep_record=bool(keep_record), raise_exceptions=raise_exceptions, notes=notes):
+                yield exp_rec
+        finally:
+            set_test_mode(old_test_mode)
+        return
+
     old_test_mode = is_test_mode()
     set_test_mode(test_mode)
     ARTEMIS_LOGGER.info('{border} {mode} Experiment: {name} {border}'
@@ -767,7 +1129,7 @@ def run_and_record(function, experiment_id, print_to_console=True, show_figs=Non
                 result = function()
                 exp_rec.save_result(result)
             exp_rec.info.set_field(EIF.STATUS, ExpStatusOptions.FINISHED)
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, GeneratorExit):  # GeneratorExit happens when a generator experiment is closed early
             exp_rec.info.set_field(EIF.STATUS, ExpStatusOptions.STOPPED)
             exp_rec.write_error_trace(print_too=False)
             raise
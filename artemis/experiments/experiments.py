@@ -488,8 +488,10 @@ def hold_global_experiment_libary(new_lib = None):
     global _GLOBAL_EXPERIMENT_LIBRARY
     oldlib = _GLOBAL_EXPERIMENT_LIBRARY
     _GLOBAL_EXPERIMENT_LIBRARY = new_lib
-    yield _GLOBAL_EXPERIMENT_LIBRARY
-    _GLOBAL_EXPERIMENT_LIBRARY = oldlib
+    try:
+        yield _GLOBAL_EXPERIMENT_LIBRARY
+    finally:
+        _GLOBAL_EXPERIMENT_LIBRARY = oldlib
 
 
 def get_global_experiment_library():
@@ -0,0 +1,330 @@
+import itertools
+import logging
+import math
+import multiprocessing
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+
+from artemis.experiments.experiment_management import run_multiple_experiments
+from artemis.experiments.experiment_record import ExpStatusOptions, get_all_record_ids, group_record_ids_by_experiment, \
+    load_experiment_record, get_experiment_dir
+from artemis.experiments.experiments import _kwargs_to_experiment_name, load_experiment
+from artemis.general.functional import advanced_getargspec
+
+"""
+Sweeps over the parameters of an experiment.  Instead of writing nested loops of add_variant, which registers every
+variant when your module is imported, you declare a parameter space:
+
+    @experiment_root
+    def train(learning_rate, n_hidden, seed=1234):
+        ...
+
+    sweep = Sweep(train, space=dict(learning_rate=LogUniform(1e-4, 1e-1), n_hidden=[50, 100, 200]), mode='random', n_samples=100)
+    sweep.run(parallel=True)
+
+Variants are only created (with add_variant) when they are about to be run, and points that already have valid records
+are skipped, so an interrupted sweep picks up where it left off when you run it again.  The sweep runs over any
+Experiment, so to sweep over the arguments of a config variant, just pass the variant returned by add_config_variant.
+
+For sweeps over generator experiments, run_successive_halving stops the worst variants early and only lets the best
+ones continue.
+"""
+
+ARTEMIS_LOGGER = logging.getLogger('artemis')
+
+
+class Uniform(object):
+    """
+    A parameter dimension sampled uniformly from [low, high).
+    """
+
+    def __init__(self, low, high, n_grid=None):
+        """
+        :param low: Lower bound
+        :param high: Upper bound
+        :param n_grid: If the sweep is a grid, the number of evenly spaced points (including the ends) to use.
+        """
+        assert high > low, 'Upper bound {} must be above lower bound {}'.format(high, low)
+        self.low = low
+        self.high = high
+        self.n_grid = n_grid
+
+    def from_unit(self, u):
+        """
+        :param u: A number in [0, 1)
+        :return: The corresponding parameter value
+        """
+        return float(self.low + u*(self.high-self.low))
+
+    def grid_values(self):
+        assert self.n_grid is not None, 'To use {} in a grid sweep you must specify n_grid'.format(self)
+        return [float(v) for v in np.linspace(self.low, self.high, self.n_grid)]
+
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, self.low, self.high)
+
+
+class LogUniform(Uniform):
+    """
+    A parameter dimension whose logarithm is sampled uniformly, so that e.g. 1e-4..1e-3 is as likely as 1e-2..1e-1.
+    """
+
+    def __init__(self, low, high, n_grid=None):
+        assert low > 0, 'Lower bound of a LogUniform must be positive.  Got {}'.format(low)
+        Uniform.__init__(self, low, high, n_grid=n_grid)
+
+    def from_unit(self, u):
+        return float(math.exp(math.log(self.low) + u*(math.log(self.high)-math.log(self.low))))
+
+    def grid_values(self):
+        assert self.n_grid is not None, 'To use {} in a grid sweep you must specify n_grid'.format(self)
+        return [float(v) for v in np.logspace(math.log10(self.low), math.log10(self.high), self.n_grid)]
+
+
+def _get_grid_values(dimension):
+    return dimension.grid_values() if isinstance(dimension, Uniform) else list(dimension)
+
+
+def _value_from_unit(dimension, u):
+    if isinstance(dimension, Uniform):
+        return dimension.from_unit(u)
+    else:
+        values = list(dimension)
+        return values[min(int(u*len(values)), len(values)-1)]
+
+
+def iter_parameter_points(space, mode='grid', n_samples=None, seed=1234):
+    """
+    Generate points in a parameter space.
+
+    :param space: A dict<arg_name -> dimension>, where a dimension is either a list of values, or a Uniform/LogUniform.
+        (use an OrderedDict if you care about the order of args in the point)
+    :param mode: How to go through the space.  One of:
+        'grid': Every combination of values.  Uniform dimensions must specify n_grid.
+        'random': n_samples independent random samples.  List dimensions are sampled uniformly.
+        'lhs': n_samples samples from a Latin hypercube: Each dimension is split into n_samples equal strata, and every
+            stratum is sampled exactly once.  This covers the space more evenly than 'random'.
+    :param n_samples: The number of points to generate for 'random' and 'lhs'.
+    :param seed: The random seed.  Keep it fixed so that a sweep generates the same points each time it is run.
+    :return: A generator of OrderedDict<arg_name -> value>
+    """
+    names = list(space.keys())
+    dimensions = [space[name] for name in names]
+    if mode == 'grid':
+        for values in itertools.product(*[_get_grid_values(dim) for dim in dimensions]):
+            yield OrderedDict(zip(names, values))
+    elif mode in ('random', 'lhs'):
+        assert n_samples is not None, "You need to specify n_samples for a '{}' sweep".format(mode)
+        rng = np.random.RandomState(seed)
+        if mode == 'random':
+            unit_points = rng.rand(n_samples, len(names))
+        else:
+            unit_points = np.array([(rng.permutation(n_samples)+rng.rand(n_samples))/float(n_samples) for _ in names]).T.reshape(n_samples, len(names))
+        for unit_point in unit_points:
+            yield OrderedDict((name, _value_from_unit(dim, u)) for name, dim, u in zip(names, dimensions, unit_point))
+    else:
+        raise ValueError("mode must be one of 'grid', 'random', 'lhs'.  Got '{}'".format(mode))
+
+
+class Sweep(object):
+    """
+    A sweep over the arguments of an experiment.  See the top of this module for an example.
+    """
+
+    def __init__(self, experiment, space, mode='grid', n_samples=None, seed=1234):
+        """
+        :param Experiment experiment: The experiment (or root experiment) to create variants from.
+        :param space: A dict<arg_name -> dimension> (see iter_parameter_points)
+        :param mode: 'grid', 'random', or 'lhs' (see iter_parameter_points)
+        :param n_samples: Number of points for 'random' or 'lhs' sweeps.
+        :param seed: Random seed used to generate the points.
+        """
+        self.experiment = experiment
+        self.space = space
+        self.mode = mode
+        self.n_samples = n_samples
+        self.seed = seed
+
+    def iter_points(self):
+        """
+        :return: A generator of OrderedDict<arg_name -> value> for each point in the sweep.
+        """
+        return iter_parameter_points(self.space, mode=self.mode, n_samples=self.n_samples, seed=self.seed)
+
+    def get_variant_id(self, point):
+        """
+        :return: The id that the variant for this point has (or will have, once it is created).
+        """
+        return self.experiment.get_id() + '.' + _kwargs_to_experiment_name(point)
+
+    def get_variant(self, point):
+        """
+        Get the variant for this point, creating (and registering) it if it does not exist yet.
+        :return Experiment: The variant
+        """
+        name = _kwargs_to_experiment_name(point)
+        if name in self.experiment.variants:
+            return self.experiment.variants[name]
+        return self.experiment.add_variant(**point)
+
+    def get_variants(self):
+        """
+        Create (if necessary) and return the variants for all points in the sweep.
+        :return: A list of Experiments
+        """
+        return [self.get_variant(point) for point in self.iter_points()]
+
+    def get_point_args(self, point):
+        """
+        :return: An OrderedDict of all arguments the variant for this point will be run with (without creating it).
+        """
+        all_arg_names, _, _, defaults = advanced_getargspec(self.experiment.function)
+        undefined_args = [name for name in all_arg_names if name not in point and name not in defaults]
+        assert len(undefined_args)==0, "Required arguments {} of {} are neither in the sweep's space nor defined by the experiment.".format(undefined_args, self.experiment.get_id())
+        return OrderedDict((name, point[name] if name in point else defaults[name]) for name in all_arg_names)
+
+    def iter_pending_points(self):
+        """
+        :return: A generator of the points that do not yet have a completed record with matching arguments.
+        """
+        expdir = get_experiment_dir()
+        points = list(self.iter_points())
+        exp_rec_dict = group_record_ids_by_experiment(get_all_record_ids(expdir=expdir), [self.get_variant_id(p) for p in points], expdir=expdir)
+        for point in points:
+            records = [load_experiment_record(rid, expdir=expdir) for rid in exp_rec_dict[self.get_variant_id(point)]]
+            current_args = self.get_point_args(point)
+            if not any(rec.get_status() == ExpStatusOptions.FINISHED and rec.args_valid(current_args=current_args) for rec in records):
+                yield point
+
+    def run(self, parallel=False, batch_size=100, skip_completed=True, raise_exceptions=True, run_args=None):
+        """
+        Run the sweep.  Variants are created in batches just before they are run.
+
+        :param parallel: Run in parallel (see run_multiple_experiments)
+        :param batch_size: Number of variants to create and dispatch at a time.
+        :param skip_completed: Skip points that already have a completed record with matching arguments.
+        :param raise_exceptions: Stop the sweep if a run fails.
+        :param run_args: Other args to pass to Experiment.run() (e.g. light_table='my_sweep' to save lightweight records)
+        :return: A list of the ExperimentRecords created.
+        """
+        run_args = {} if run_args is None else run_args
+        points = self.iter_pending_points() if skip_completed else self.iter_points()
+        records = []
+        while True:
+            batch = [self.get_variant(point) for point in itertools.islice(points, batch_size)]
+            if len(batch) == 0:
+                break
+            records += run_multiple_experiments(batch, parallel=parallel, raise_exceptions=raise_exceptions, run_args=run_args)
+        return records
+
+
+def _run_for_successive_halving(experiment_id, n_steps, run_args):
+    """
+    Run an experiment's generator from the start until it has yielded n_steps results, and then close it, which marks
+    the record as STOPPED if it has not finished.  This is a top-level function so that it can be run in a Pool.
+    :return: (record_id, n_steps_done, is_done)
+    """
+    iterator = load_experiment(experiment_id).iterator(raise_exceptions=False, **run_args)
+    record = None
+    n_steps_done = 0
+    is_done = False
+    try:
+        while n_steps_done < n_steps and not is_done:
+            record = next(iterator)
+            if record.get_status() in (ExpStatusOptions.FINISHED, ExpStatusOptions.ERROR):
+                is_done = True  # The final yield just returns the finished record again.
+            else:
+                n_steps_done += 1
+    finally:
+        iterator.close()
+    return record.get_id(), n_steps_done, is_done
+
+
+def run_successive_halving(experiments, score_function, min_iterations=1, max_iterations=None, reduction_factor=3,
+        n_survivors=1, higher_is_better=True, parallel=False, run_args=None):
+    """
+    Run generator-experiments with successive-halving early stopping.  In round k, each surviving experiment is run until
+    it has yielded min_iterations * reduction_factor**k results.  Its score is then computed from its latest yielded
+    result, and only the best 1/reduction_factor of experiments go on to the next round.  The rest are stopped (their
+    records are marked STOPPED).  The survivors of the last round are run until max_iterations (or until their generator
+    finishes if max_iterations is None).
+
+    A generator can't be paused across processes, so the survivors of each round are run again from the start (in a new
+    record, which replaces the record of the previous round).  This keeps at most `parallel` experiments in memory at a
+    time, at the cost of redoing at most 1/(reduction_factor-1) of the survivors' work.  It assumes that experiments are
+    deterministic (e.g. that they seed their random number generators).  Experiments whose generator finishes early
+    keep their final score, and experiments that raise an error are dropped.
+
+    As with run_multiple_experiments, in parallel mode the experiments are looked up by id in the worker processes, so
+    they must be registered there too (which they are when processes are forked).  The scores are computed in this
+    process, so score_function does not need to be picklable.
+
+        records_and_scores = run_successive_halving(sweep.get_variants(), score_function=lambda result: result['test_score'], min_iterations=2)
+
+    :param experiments: A list of Experiments defined by generator functions.
+    :param score_function: A function which takes the latest yielded result of an experiment and returns a score.
+    :param min_iterations: The number of results every experiment yields in the first round.
+    :param max_iterations: The number of results that the final survivors are run for (None to run them to completion)
+    :param reduction_factor: Keep the best 1/reduction_factor experiments after each round.
+    :param n_survivors: Stop halving when this many experiments remain.
+    :param higher_is_better: True if a higher score is better, False if it is worse (e.g. for a loss)
+    :param parallel: The number of experiments to run at once (True to use all CPUs, False to run one at a time).
+    :param run_args: Other args to pass to Experiment.iterator()
+    :return: A list of (ExperimentRecord, score) tuples, sorted from best to worst.  Experiments that raised an error are
+        not included.
+    """
+    assert reduction_factor > 1, 'reduction_factor must be greater than 1.  Got {}'.format(reduction_factor)
+    assert all(ex.is_generator() for ex in experiments), 'Successive halving only works on experiments defined by generators.'
+    run_args = {} if run_args is None else run_args
+    n_parallel = multiprocessing.cpu_count() if parallel in (True, 'all') else 1 if not parallel else parallel
+
+    states = OrderedDict()  # experiment_id -> (record_id, score, n_steps_done, is_done)
+
+    def get_score(record_id):
+        record = load_experiment_record(record_id)
+        if record.get_status() == ExpStatusOptions.ERROR or not record.has_result():
+            return None
+        return score_function(record.get_result())
+
+    def advance(experiment_ids, n_steps):
+        to_run = [eid for eid in experiment_ids if not (eid in states and states[eid][3])]
+        target_func = partial(_run_for_successive_halving, n_steps=n_steps, run_args=run_args)
+        if n_parallel > 1 and len(to_run) > 1:
+            pool = multiprocessing.Pool(processes=min(n_parallel, len(to_run)))
+            try:
+                results = pool.map(target_func, to_run, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [target_func(eid) for eid in to_run]
+        for eid, (record_id, n_steps_done, is_done) in zip(to_run, results):
+            if eid in states:  # Replace the record of the previous round
+                load_experiment_record(states[eid][0]).delete()
+            states[eid] = (record_id, get_score(record_id), n_steps_done, is_done)
+        failed = [eid for eid in experiment_ids if states[eid][1] is None]
+        for eid in failed:
+            ARTEMIS_LOGGER.warning('Experiment {} did not produce a score, so it will not continue in successive halving.'.format(eid))
+        return [eid for eid in experiment_ids if eid not in failed]
+
+    survivors = [ex.get_id() for ex in experiments]
+    n_steps = min_iterations
+    while True:
+        if max_iterations is not None:
+            n_steps = min(n_steps, max_iterations)
+        survivors = advance(survivors, n_steps)
+        is_last_round = len(survivors) <= n_survivors or (max_iterations is not None and n_steps >= max_iterations) or all(states[eid][3] for eid in survivors)
+        if is_last_round:
+            break
+        ranked = sorted(survivors, key=lambda eid: states[eid][1], reverse=higher_is_better)
+        n_keep = max(n_survivors, int(math.ceil(len(ranked)/float(reduction_factor))))
+        ARTEMIS_LOGGER.info('Successive halving: {} experiments scored after {} iterations.  Stopping {} of them.'.format(len(ranked), n_steps, len(ranked)-n_keep))
+        survivors = ranked[:n_keep]
+        n_steps *= reduction_factor
+    if max_iterations is None or n_steps < max_iterations:
+        survivors = advance(survivors, float('inf') if max_iterations is None else max_iterations)
+
+    ranked = sorted([eid for eid in states if states[eid][1] is not None], key=lambda eid: states[eid][1], reverse=higher_is_better)
+    return [(load_experiment_record(states[eid][0]), states[eid][1]) for eid in ranked]
@@ -0,0 +1,23 @@
+from artemis.experiments.benchmark_experiments import hold_temporary_experiment_dir, \
+    create_synthetic_record_tree, register_synthetic_experiments, get_synthetic_experiment_ids
+from artemis.experiments.experiment_management import get_experient_to_record_dict, select_experiment_records
+from artemis.experiments.experiment_record import get_all_record_ids, ExpStatusOptions
+from artemis.experiments.experiments import hold_global_experiment_libary
+
+
+def test_synthetic_record_tree():
+
+    with hold_temporary_experiment_dir() as expdir, hold_global_experiment_libary():
+        register_synthetic_experiments(n_experiments=4)
+        record_ids = create_synthetic_record_tree(expdir, n_records=20, n_experiments=4, populate=True)
+        assert get_all_record_ids() == sorted(record_ids)
+        exp_record_dict = get_experient_to_record_dict(get_synthetic_experiment_ids(4))
+        assert [len(rids) for rids in exp_record_dict.values()] == [5, 5, 5, 5]
+        assert len(select_experiment_records('finished', exp_record_dict)) == 18
+        assert len(select_experiment_records('invalid', exp_record_dict)) == 2
+        records = select_experiment_records('errors', exp_record_dict)
+        assert len(records) == 2 and all(rec.get_status() == ExpStatusOptions.ERROR for rec in records)
+
+
+if __name__ == '__main__':
+    test_synthetic_record_tree()
@@ -1,6 +1,8 @@
 import itertools
 import os
 import pickle
+import shutil
+import tempfile
 import time
 import warnings
 from collections import OrderedDict
@@ -12,12 +14,16 @@ from six.moves import xrange
 
 from artemis.experiments.decorators import experiment_function, experiment_root
 from artemis.experiments.deprecated import start_experiment, end_current_experiment
-from artemis.experiments.experiment_management import run_multiple_experiments
+from artemis.experiments.benchmark_experiments import create_synthetic_record_tree, get_synthetic_experiment_ids
+from artemis.experiments.experiment_management import run_multiple_experiments, get_experient_to_record_dict, \
+    select_experiment_records, pull_experiment_records_incrementally, get_record_manifest, get_remote_record_manifest
 from artemis.experiments.experiment_record import \
     load_experiment_record, ExperimentRecord, record_experiment, \
     delete_experiment_with_id, get_current_record_dir, open_in_record_dir, \
     ExpStatusOptions, get_current_experiment_id, get_current_experiment_record, \
-    get_current_record_id, has_experiment_record, experiment_id_to_record_ids
+    get_current_record_id, has_experiment_record, experiment_id_to_record_ids, parse_experiment_id_from_record_id, \
+    group_record_ids_by_experiment, get_experiment_to_record_mapping, LightExperimentRecord, get_all_record_ids, \
+    get_experiment_dir, append_light_record, load_light_record_table, ExpInfoFields
 from artemis.experiments.experiments import get_experiment_info, load_experiment, experiment_testing_context, \
     clear_all_experiments
 from artemis.experiments.test_experiments import test_unpicklable_args
@@ -459,6 +465,121 @@ def test_generator_experiment():
         assert rec2.get_result() == 3
 
 
+def test_record_to_experiment_mapping():
+
+    assert parse_experiment_id_from_record_id('2017.10.25T12.53.43.581735-my_exp.a=1') == 'my_exp.a=1'
+    assert parse_experiment_id_from_record_id('2017.10.25T12.53.43-my_exp') == 'my_exp'  # No microseconds
+    assert parse_experiment_id_from_record_id('test_exp') is None
+
+    with experiment_testing_context(new_experiment_lib=True):
+
+        @experiment_function
+        def my_mapping_test(a=1):
+            return a
+
+        X2 = my_mapping_test.add_variant(a=2)
+        rec1 = my_mapping_test.run()
+        rec2 = X2.run()
+        rec3 = X2.run()
+
+        record_ids = [rec1.get_id(), rec2.get_id(), rec3.get_id(), '2017.10.25T12.53.43.581735-some_other_exp']
+        exp_rec_dict = group_record_ids_by_experiment(record_ids, ['my_mapping_test', 'my_mapping_test.a=2'])
+        assert list(exp_rec_dict.keys()) == ['my_mapping_test', 'my_mapping_test.a=2']
+        assert exp_rec_dict['my_mapping_test'] == [rec1.get_id()]
+        assert exp_rec_dict['my_mapping_test.a=2'] == [rec2.get_id(), rec3.get_id()]
+
+        mapping = get_experiment_to_record_mapping([my_mapping_test, X2])
+        assert [rec.get_id() for rec in mapping[my_mapping_test]] == [rec1.get_id()]
+        assert [rec.get_id() for rec in mapping[X2]] == [rec2.get_id(), rec3.get_id()]
+
+
+def test_light_records():
+
+    with experiment_testing_context(new_experiment_lib=True):
+
+        @experiment_function
+        def my_light_test(a=1, fail=False):
+            print('This is not saved')
+            if fail:
+                raise Exception('Failed!')
+            return a*2
+
+        X2 = my_light_test.add_variant(a=2)
+        X3 = my_light_test.add_variant(a=3, fail=True)
+        old_files = set(os.listdir(get_experiment_dir()))
+
+        rec1 = my_light_test.run(light_table='test_light_sweep')
+        rec2 = X2.run(light_table='test_light_sweep')
+        rec3 = X3.run(light_table='test_light_sweep', raise_exceptions=False)
+        new_files = set(os.listdir(get_experiment_dir())) - old_files
+        assert new_files - {'test_light_sweep.lightrecords.lock'} == {'test_light_sweep.lightrecords'}  # Just the table file (and its lock file)
+        assert rec1.get_result() == 2
+        assert rec3.get_status() == ExpStatusOptions.ERROR and 'Failed!' in rec3.get_error_trace()
+
+        records = X2.get_records()
+        assert len(records) == 1 and isinstance(records[0], LightExperimentRecord)
+        assert records[0].get_id() == rec2.get_id()
+        assert records[0].get_result() == 4
+        assert records[0].get_args() == OrderedDict([('a', 2), ('fail', False)])
+        assert records[0].get_status() == ExpStatusOptions.FINISHED
+        assert records[0].args_valid()
+        assert records[0].get_log() == ''
+        with pytest.raises(ValueError):
+            records[0].open_file('output.txt')
+        assert pickle.loads(pickle.dumps(records[0])).get_result() == 4
+
+        exp_rec_dict = get_experient_to_record_dict()
+        assert [len(rids) for rids in exp_rec_dict.values()] == [1, 1, 1]
+        assert [rec.get_id() for rec in select_experiment_records('finished', exp_rec_dict)] == [rec1.get_id(), rec2.get_id()]
+        assert [rec.get_id() for rec in select_experiment_records('errors', exp_rec_dict)] == [rec3.get_id()]
+
+        from artemis.experiments.ui import ExperimentBrowser
+        table = ExperimentBrowser().get_experiment_list_str(exp_rec_dict)
+        assert 'Ran Succesfully' in table and 'Error' in table
+
+        rec2.delete()
+        assert rec2.get_id() not in get_all_record_ids()
+        assert rec1.get_id() in get_all_record_ids()
+
+
+def _append_light_row(expdir, table_name, record_id):
+    append_light_record(LightExperimentRecord(os.path.join(expdir, table_name), record_id, row={'info': OrderedDict([(ExpInfoFields.ID, record_id)]), 'args_hash': None}))
+
+
+def test_pull_records_incrementally():
+
+    remote_dir, local_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+        record_ids = create_synthetic_record_tree(remote_dir, n_records=12, n_experiments=3, populate=True)
+        _append_light_row(remote_dir, 'my_sweep.lightrecords', 'remote_row_1')
+        _append_light_row(local_dir, 'my_sweep.lightrecords', 'local_row')
+        assert get_remote_record_manifest(user=None, ip=None, remote_dir=remote_dir) == get_record_manifest(remote_dir)
+        pulled = pull_experiment_records_incrementally(user=None, ip=None, remote_dir=remote_dir, local_dir=local_dir, n_streams=3)
+        assert pulled == sorted(record_ids + ['my_sweep.lightrecords'])
+        assert dict((k, v) for k, v in get_record_manifest(local_dir).items() if k in record_ids) == dict((k, v) for k, v in get_record_manifest(remote_dir).items() if k in record_ids)
+        assert list(load_light_record_table(os.path.join(local_dir, 'my_sweep.lightrecords'))) == ['local_row', 'remote_row_1']  # Rows are merged
+        assert load_experiment_record(record_ids[4], expdir=local_dir).get_result() == load_experiment_record(record_ids[4], expdir=remote_dir).get_result()
+
+        # Nothing changed, so nothing is pulled
+        assert pull_experiment_records_incrementally(user=None, ip=None, remote_dir=remote_dir, local_dir=local_dir) == []
+
+        # Only changed or new records of the requested experiments are pulled
+        with open(os.path.join(remote_dir, record_ids[4], 'output.txt'), 'a') as f:
+            f.write('More output')
+        new_record_ids = create_synthetic_record_tree(remote_dir, n_records=3, n_experiments=3, populate=True)
+        pulled = pull_experiment_records_incrementally(user=None, ip=None, experiment_names=get_synthetic_experiment_ids(3)[1:], remote_dir=remote_dir, local_dir=local_dir)
+        assert pulled == sorted([record_ids[4]] + new_record_ids[1:])
+        assert not os.path.exists(os.path.join(local_dir, new_record_ids[0]))
+
+        # A table that changed on the remote is merged again, keeping the local rows
+        _append_light_row(remote_dir, 'my_sweep.lightrecords', 'remote_row_2')
+        assert pull_experiment_records_incrementally(user=None, ip=None, remote_dir=remote_dir, local_dir=local_dir) == sorted([new_record_ids[0], 'my_sweep.lightrecords'])
+        assert list(load_light_record_table(os.path.join(local_dir, 'my_sweep.lightrecords'))) == ['local_row', 'remote_row_1', 'remote_row_2']
+    finally:
+        shutil.rmtree(remote_dir)
+        shutil.rmtree(local_dir)
+
+
 if __name__ == '__main__':
 
     set_test_mode(True)
@@ -482,3 +603,6 @@ if __name__ == '__main__':
     test_current_experiment_access_functions()
     test_generator_experiment()
     test_unpicklable_args()
+    test_record_to_experiment_mapping()
+    test_light_records()
+    test_pull_records_incrementally()
@@ -0,0 +1,95 @@
+import numpy as np
+from pytest import raises
+
+from artemis.experiments import experiment_root
+from artemis.experiments.experiments import experiment_testing_context, get_global_experiment_library
+from artemis.experiments.experiment_record import ExpStatusOptions
+from artemis.experiments.sweeps import Sweep, Uniform, LogUniform, iter_parameter_points, run_successive_halving
+
+
+def test_parameter_points():
+
+    points = list(iter_parameter_points(dict(a=[1, 2, 3], b=Uniform(0, 1, n_grid=5)), mode='grid'))
+    assert len(points) == 15
+    assert [p['b'] for p in points[:5]] == [0., 0.25, 0.5, 0.75, 1.]
+
+    points = list(iter_parameter_points(dict(a=LogUniform(1e-4, 1e-1), b=[1, 2, 3]), mode='random', n_samples=50, seed=1))
+    assert points == list(iter_parameter_points(dict(a=LogUniform(1e-4, 1e-1), b=[1, 2, 3]), mode='random', n_samples=50, seed=1))
+    assert all(1e-4 <= p['a'] < 1e-1 for p in points)
+    assert set(p['b'] for p in points) == {1, 2, 3}
+
+    # In a latin hypercube, every stratum of every dimension is sampled exactly once
+    points = list(iter_parameter_points(dict(a=Uniform(0, 10), b=Uniform(-1, 1)), mode='lhs', n_samples=10))
+    assert sorted(int(p['a']) for p in points) == list(range(10))
+    assert sorted(int((p['b']+1)*5) for p in points) == list(range(10))
+
+
+def test_sweep():
+
+    with experiment_testing_context(new_experiment_lib=True):
+
+        @experiment_root
+        def my_swept_experiment(a, b, c=3):
+            return a*b+c
+
+        sweep = Sweep(my_swept_experiment, space=dict(a=[1, 2], b=LogUniform(1, 100, n_grid=3)), mode='grid')
+        assert len(my_swept_experiment.get_all_variants()) == 0  # Nothing registered until we run
+        records = sweep.run(batch_size=4)
+        assert len(records) == 6
+        assert sorted(rec.get_result() for rec in records) == sorted(a*b+3 for a in [1, 2] for b in [1., 10., 100.])
+        assert 'my_swept_experiment.a=2,b=10.0' in get_global_experiment_library()
+        assert list(sweep.iter_pending_points()) == []
+        assert sweep.run() == []  # Resumes: everything is already done
+        with raises(AssertionError):
+            Sweep(my_swept_experiment, space=dict(a=[1, 2])).run()  # b is not defined
+
+        # Changing the defaults invalidates the records, so the points are run again.
+        sweep = Sweep(my_swept_experiment.add_root_variant(c=4), space=dict(a=[1, 2], b=[1.]))
+        assert len(list(sweep.iter_pending_points())) == 2
+        assert [rec.get_result() for rec in sweep.run()] == [5, 6]
+
+
+def test_sweep_over_config_variant():
+
+    with experiment_testing_context(new_experiment_lib=True):
+
+        @experiment_root
+        def my_configured_experiment(transform, x=2):
+            return transform(x)
+
+        X = my_configured_experiment.add_config_variant('power', transform=lambda exponent=2: (lambda x: x**exponent))
+        records = Sweep(X, space=dict(exponent=[1, 2, 3]), mode='grid').run()
+        assert [rec.get_result() for rec in records] == [2, 4, 8]
+        assert np.array_equal([rec.get_result() for rec in Sweep(X, space=dict(exponent=[1, 2, 3]), mode='grid').run(skip_completed=False)], [2, 4, 8])
+
+
+def test_successive_halving():
+
+    with experiment_testing_context(new_experiment_lib=True):
+
+        @experiment_root
+        def my_learning_curve(rate, n_steps=20):
+            if rate == 0:
+                raise ValueError('Diverged')
+            for t in range(1, n_steps+1):
+                yield dict(t=t, loss=1./(rate*t))
+
+        variants = Sweep(my_learning_curve, space=dict(rate=list(range(10)))).get_variants()
+        records_and_scores = run_successive_halving(variants, score_function=lambda result: result['loss'], higher_is_better=False, parallel=3)
+        assert len(records_and_scores) == 9  # The diverged one is dropped
+        records = [rec for rec, score in records_and_scores]
+        assert [rec.get_experiment_id() for rec in records[:3]] == ['my_learning_curve.rate=9', 'my_learning_curve.rate=8', 'my_learning_curve.rate=7']
+        assert [rec.get_result()['t'] for rec in records] == [20, 3, 3, 1, 1, 1, 1, 1, 1]
+        assert records[0].get_status() == ExpStatusOptions.FINISHED
+        assert all(rec.get_status() == ExpStatusOptions.STOPPED for rec in records[1:])
+        assert all(len(ex.get_records()) == 1 for ex in variants)  # Survivors were rerun, replacing earlier records
+
+        records_and_scores = run_successive_halving(variants[1:], score_function=lambda result: result['loss'], higher_is_better=False, max_iterations=5, run_args=dict(light_table='my_halving'))
+        assert [rec.get_result()['t'] for rec, _ in records_and_scores] == [5, 3, 3, 1, 1, 1, 1, 1, 1]
+
+
+if __name__ == '__main__':
+    test_parameter_points()
+    test_sweep()
+    test_sweep_over_config_variant()
+    test_successive_halving()
@@ -0,0 +1,197 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from artemis.fileman.disk_memoize import save_memo, load_memo
+from artemis.general.benchmarking import make_benchmark_report, run_benchmark_script
+
+"""
+Benchmarks for the storage backends of memoize_to_disk.  For each backend we save a large array (or a dict of arrays)
+and then, in a fresh process, measure the time to load it, the time to load it and read every element, and the
+increase in peak resident memory.  Run with:
+
+    python -m artemis.fileman.benchmark_disk_memoize --size_mb 1000 -o results.json
+
+We also compare the compression codecs on different kinds of data.
+
+Before each load we ask the OS to drop the file from its page cache (with posix_fadvise, where available), so that the
+loads are cold.
+"""
+
+STORAGES = ('pickle', 'numpy')
+
+
+def _get_peak_rss_bytes():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports kilobytes, OSX bytes.
+
+
+def drop_from_page_cache(path):
+    """
+    Ask the OS to forget the cached contents of a file, so that the next read actually goes to disk.  Does nothing on
+    platforms without posix_fadvise.
+    :param path: The file path
+    """
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _sum_all_arrays(obj):
+    if isinstance(obj, np.ndarray):
+        return float(np.sum(obj))
+    elif isinstance(obj, dict):
+        return sum(_sum_all_arrays(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(_sum_all_arrays(v) for v in obj)
+    else:
+        return 0.
+
+
+def _time_load_target(memo_path, touch_data, queue):
+    baseline_rss = _get_peak_rss_bytes()
+    start = time.time()
+    result = load_memo(memo_path)
+    if touch_data:
+        _sum_all_arrays(result)
+    queue.put((time.time() - start, _get_peak_rss_bytes() - baseline_rss))
+
+
+def time_cold_load(memo_path, touch_data):
+    """
+    Load a memo in a new process.
+    :param memo_path: Path to the memo file
+    :param touch_data: Also read every element of every array (to include the cost of paging in memory-mapped data)
+    :return: (load_time, peak_rss_increase_in_bytes)
+    """
+    drop_from_page_cache(memo_path)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_time_load_target, args=(memo_path, touch_data, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def get_synthetic_result(kind, size_mb):
+    """
+    :param kind: One of:
+        'array': A single array of random floats (incompressible)
+        'dict': A dict of 4 arrays of random floats and some metadata
+        'sparse': An array of floats which is 99% zeros
+        'labels': An array of small integers
+        'objects': A list of small dicts
+    :param size_mb: The (approximate) total size of the data, in megabytes.
+    :return: The synthetic result
+    """
+    n = int(size_mb * 2**20 / 8)
+    if kind == 'array':
+        return np.random.RandomState(1234).randn(n)
+    elif kind == 'dict':
+        rng = np.random.RandomState(1234)
+        return {'x_train': rng.randn(n//4), 'y_train': rng.randn(n//4), 'x_test': rng.randn(n//4), 'y_test': rng.randn(n//4), 'name': 'synthetic', 'n_classes': 10}
+    elif kind == 'sparse':
+        arr = np.zeros(n)
+        arr[::100] = np.random.RandomState(1234).randn(len(arr[::100]))
+        return arr
+    elif kind == 'labels':
+        return np.random.RandomState(1234).randint(10, size=n*8).astype(np.uint8)
+    elif kind == 'objects':
+        rng = np.random.RandomState(1234)
+        return [{'id': i, 'name': 'item_{}'.format(i), 'score': float(rng.rand())} for i in range(int(size_mb * 2**20 / 64))]
+    else:
+        raise ValueError('No synthetic result "{}"'.format(kind))
+
+
+def get_available_codecs():
+    """
+    :return: A list of the codecs that can be used here (None means no compression).
+    """
+    codecs = [None, 'zlib', 'lzma']
+    try:
+        import lz4.frame
+        codecs.append('lz4')
+    except ImportError:
+        pass
+    return codecs
+
+
+def benchmark_memo_codecs(size_mb=20, kinds=('array', 'sparse', 'labels', 'objects'), codecs=None):
+    """
+    Compare save time, file size and cold load time for each compression codec on each kind of data.
+    :return: An OrderedDict<benchmark_name -> value>.  Times are in seconds, sizes in bytes.
+    """
+    if codecs is None:
+        codecs = get_available_codecs()
+    results = OrderedDict()
+    memo_dir = tempfile.mkdtemp()
+    try:
+        for kind in kinds:
+            result = get_synthetic_result(kind, size_mb)
+            storage = 'pickle' if kind == 'objects' else 'numpy'
+            for codec in codecs:
+                codec_name = codec if codec is not None else 'none'
+                start = time.time()
+                memo_path = save_memo(result, os.path.join(memo_dir, '{}-{}.pkl'.format(kind, codec_name)), storage=storage, compression=codec)
+                results['{}/{}/save_time'.format(kind, codec_name)] = time.time() - start
+                results['{}/{}/file_size'.format(kind, codec_name)] = os.path.getsize(memo_path)
+                load_time, _ = time_cold_load(memo_path, touch_data=True)
+                results['{}/{}/cold_load_and_read_time'.format(kind, codec_name)] = load_time
+    finally:
+        shutil.rmtree(memo_dir)
+    return results
+
+
+def benchmark_memo_storage(size_mb=100, kinds=('array', 'dict'), storages=STORAGES):
+    """
+    :return: An OrderedDict<benchmark_name -> value>.  Times are in seconds, sizes in bytes.
+    """
+    results = OrderedDict()
+    memo_dir = tempfile.mkdtemp()
+    try:
+        for kind in kinds:
+            result = get_synthetic_result(kind, size_mb)
+            for storage in storages:
+                start = time.time()
+                memo_path = save_memo(result, os.path.join(memo_dir, '{}-{}.pkl'.format(kind, storage)), storage=storage)
+                results['{}/{}/save_time'.format(kind, storage)] = time.time() - start
+                results['{}/{}/file_size'.format(kind, storage)] = os.path.getsize(memo_path)
+                load_time, _ = time_cold_load(memo_path, touch_data=False)
+                results['{}/{}/cold_load_time'.format(kind, storage)] = load_time
+                load_and_read_time, peak_rss_increase = time_cold_load(memo_path, touch_data=True)
+                results['{}/{}/cold_load_and_read_time'.format(kind, storage)] = load_and_read_time
+                results['{}/{}/peak_rss_increase'.format(kind, storage)] = peak_rss_increase
+    finally:
+        shutil.rmtree(memo_dir)
+    return results
+
+
+def run_benchmarks(size_mb=100, codec_size_mb=20):
+    """
+    Run the full benchmark suite.
+    :return: An OrderedDict containing info about the environment and a dict<benchmark_name -> value>
+    """
+    return make_benchmark_report(
+        settings=[('size_mb', size_mb), ('codec_size_mb', codec_size_mb)],
+        benchmarks=[('memo_storage/'+k, v) for k, v in benchmark_memo_storage(size_mb=size_mb).items()]
+            + [('memo_codecs/'+k, v) for k, v in benchmark_memo_codecs(size_mb=codec_size_mb).items()],
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the storage backends of memoize_to_disk.')
+    parser.add_argument('-s', '--size_mb', type=float, default=100, help='Size of the array data to memoize, in MB')
+    parser.add_argument('-c', '--codec_size_mb', type=float, default=20, help='Size of the data used to compare compression codecs, in MB')
+    run_benchmark_script(run_benchmarks, parser)
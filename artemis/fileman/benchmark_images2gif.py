@@ -0,0 +1,83 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from artemis.fileman.images2gif import writeGif, readGifIntoArray
+from artemis.general.benchmarking import make_benchmark_report, run_benchmark_script
+
+"""
+Benchmarks for the colour quantizers used by writeGif.  For each quantizer and frame size we write a synthetic
+animation, and measure the frames written per second, the file size, and the mean absolute error of the frames read
+back.  Run with:
+
+    python -m artemis.fileman.benchmark_images2gif --sizes 256 512 -o results.json
+
+NeuQuant is very slow, so it is only run on a few frames (see --neuquant_frames).
+"""
+
+QUANTIZERS = ('pil', 'kmeans', 'neuquant')
+
+
+def get_synthetic_animation(size, n_frames, seed=1234):
+    """
+    :param size: The width (and height) of the frames
+    :param n_frames: Number of frames
+    :return: A (n_frames, size, size, 3) uint8 array of smooth blobs of colour drifting over a gradient, like the
+        animations of images and heatmaps that we export from experiments.
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:size, :size] / float(size)
+    centres, velocities, colours = rng.rand(5, 2), (rng.rand(5, 2)-.5)*.05, rng.rand(5, 3)
+    frames = np.empty((n_frames, size, size, 3), dtype=np.uint8)
+    for t in range(n_frames):
+        frame = np.stack([x, y, 1-x], axis=2) * 0.5
+        for (cx, cy), colour in zip(centres + t*velocities, colours):
+            frame += np.exp(-((x-cx)**2 + (y-cy)**2) / 0.02)[:, :, None] * colour
+        frames[t] = np.clip(frame*255, 0, 255)
+    return frames
+
+
+def benchmark_quantizers(sizes=(256, 512), n_frames=20, neuquant_frames=2, quantizers=QUANTIZERS):
+    """
+    :return: An OrderedDict<benchmark_name -> value>.  Rates are in frames per second, sizes in bytes.
+    """
+    results = OrderedDict()
+    gif_dir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            for quantizer in quantizers:
+                frames = get_synthetic_animation(size, neuquant_frames if quantizer == 'neuquant' else n_frames)
+                path = os.path.join(gif_dir, '{}-{}.gif'.format(size, quantizer))
+                start = time.time()
+                writeGif(path, list(frames), quantizer=quantizer, subRectangles=False)
+                results['{}x{}/{}/frames_per_second'.format(size, size, quantizer)] = len(frames) / (time.time() - start)
+                results['{}x{}/{}/file_size_per_frame'.format(size, size, quantizer)] = os.path.getsize(path) / float(len(frames))
+                results['{}x{}/{}/mean_abs_error'.format(size, size, quantizer)] = float(np.mean(np.abs(readGifIntoArray(path, mode='RGB').astype(np.float64) - frames)))
+    finally:
+        shutil.rmtree(gif_dir)
+    return results
+
+
+def run_benchmarks(sizes=(256, 512), n_frames=20, neuquant_frames=2, quantizers=QUANTIZERS):
+    """
+    Run the full benchmark suite.
+    :return: An OrderedDict containing info about the environment and a dict<benchmark_name -> value>
+    """
+    return make_benchmark_report(
+        settings=[('sizes', list(sizes)), ('n_frames', n_frames), ('neuquant_frames', neuquant_frames), ('quantizers', list(quantizers))],
+        benchmarks=[('gif_quantizers/'+k, v) for k, v in benchmark_quantizers(sizes=sizes, n_frames=n_frames, neuquant_frames=neuquant_frames, quantizers=quantizers).items()],
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the colour quantizers used when writing GIFs.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[256, 512], help='Widths (and heights) of the frames')
+    parser.add_argument('-n', '--n_frames', type=int, default=20, help='Number of frames in each animation')
+    parser.add_argument('--neuquant_frames', type=int, default=2, help='Number of frames to use for the (slow) NeuQuant quantizer')
+    parser.add_argument('-q', '--quantizers', nargs='+', default=list(QUANTIZERS), help='Quantizers to compare')
+    run_benchmark_script(run_benchmarks, parser)
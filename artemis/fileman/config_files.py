@@ -1,11 +1,79 @@
 import os
 import sys
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from six import string_types, binary_type, integer_types
 from six.moves.configparser import NoSectionError, NoOptionError, ConfigParser
 
 __author__ = 'peter'
 
 
-_CONFIG_OBJECTS = {}
+CONFIG_CACHE_TTL = 1.  # Seconds for which a cached config is trusted before we stat the file to see if it has changed.
+
+_CONFIG_OBJECTS = {}  # config_path -> _CachedConfig
+_CONFIG_OVERRIDES = {}  # config_path -> OrderedDict<(section, option) -> value> (see set_non_persistent_config_value)
+_CONFIG_PATHS = {}  # (config_filename, home) -> config_path
+
+
+class _CachedConfig(object):
+
+    def __init__(self, config, file_signature):
+        self.config = config
+        self.file_signature = file_signature  # None if the file does not exist
+        self.last_checked = time.time()
+        self.values = {}  # (section, option, read_method) -> value, after read_method is applied
+
+
+def _get_file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size, stat.st_ino
+
+
+def _get_cached_config(config_path):
+    """
+    Get the cached config for a file, re-reading the file if it has changed on disk since we read it.  We only look at
+    the file (with a stat call) if it has not been checked in the last CONFIG_CACHE_TTL seconds.
+    """
+    entry = _CONFIG_OBJECTS.get(config_path)
+    now = time.time()
+    if entry is not None and now - entry.last_checked < CONFIG_CACHE_TTL:
+        return entry
+    signature = _get_file_signature(config_path)
+    if entry is None or signature != entry.file_signature:
+        config = ConfigParser()
+        if signature is not None:
+            config.read(config_path)
+        for (section, option), value in _CONFIG_OVERRIDES.get(config_path, {}).items():
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, option, value)
+        entry = _CONFIG_OBJECTS[config_path] = _CachedConfig(config, signature)
+    entry.last_checked = now
+    return entry
+
+
+def invalidate_config_cache(config_filename=None):
+    """
+    Forget cached configs, so that they are re-read from disk on the next access.  (Changes to config files are picked
+    up anyway, within CONFIG_CACHE_TTL seconds.)
+    :param config_filename: The config file to forget (e.g. '.artemisrc'), or None to forget all of them.
+    """
+    if config_filename is None:
+        _CONFIG_OBJECTS.clear()
+    else:
+        _CONFIG_OBJECTS.pop(get_config_path(config_filename), None)
+
+
+def config_file_exists(config_filename):
+    """
+    :param config_filename: A configuration filename (eg '.artemisrc')
+    :return: True if the file exists.  Like config values, this is cached for up to CONFIG_CACHE_TTL seconds.
+    """
+    return _get_cached_config(get_config_path(config_filename)).file_signature is not None
 
 
 def get_config_value(config_filename, section, option, default_generator=None, write_default=False, read_method=None, use_cashed_config=True):
@@ -35,8 +103,10 @@ def get_config_value(config_filename, section, option, default_generator=None, w
         If 'eval' it parses the setting into a python object
         If it is a function, it passes the value through the function before returning it.
     :param use_cashed_config: If set, will not read the config file from the file system but use the previously read and stored config file.
-        Since the cashed config file might have been modified since reading it from disk, the returned value might be different from the value
-        stored on the file on disk. In case write_default is set to True, the default value will be written to disk either way if no value has been found.
+        The cached config is re-read if the file has changed on disk (which we check at most every CONFIG_CACHE_TTL
+        seconds), but values set with set_non_persistent_config_value are kept.  Values read with read_method=None,
+        'eval' or a type (e.g. int) are cached after parsing, so repeated calls are cheap.
+        In case write_default is set to True, the default value will be written to disk either way if no value has been found.
         If set to False, the original value will be returned without modifying the hashed version.
     :return: The value of the property of interest.
     """
@@ -46,12 +116,19 @@ def get_config_value(config_filename, section, option, default_generator=None, w
     if write_default:
         assert default_generator is not None, "If you set write_default true, you must provide a function that can generate the default."
 
-    if not os.path.exists(config_path):
+    cached = _get_cached_config(config_path) if use_cashed_config else None
+    value_key = (section, option, read_method)
+    cache_value = cached is not None and (read_method is None or read_method == 'eval' or isinstance(read_method, type))
+    if cache_value and value_key in cached.values:
+        value = cached.values[value_key]
+        return value if _is_immutable_value(value) else deepcopy(value)  # So callers can not modify the cached value
+
+    if (cached.file_signature is None) if cached is not None else not os.path.exists(config_path):
         assert default_generator is not None, 'No config file "%s" exists, and you do not have any default value.' % (config_path, )
         value = default_generator()
         default_used = True
     else:
-        config = _get_config_object(config_path, use_cashed_config=use_cashed_config)
+        config = cached.config if cached is not None else _get_config_object(config_path, use_cashed_config=False)
         try:
             value = config.get(section, option)
         except (NoSectionError, NoOptionError) as err:
@@ -62,20 +139,29 @@ def get_config_value(config_filename, section, option, default_generator=None, w
                 default_used = True
 
     if default_used and write_default:
-        config = _get_config_object(config_path)
+        config = _get_config_object(config_path, use_cashed_config=False)  # (Not the cached config, which has the non-persistent values)
         if not config.has_section(section):
             config.add_section(section)
         config.set(section, option, value)
         with open(config_path, 'w') as f:
             config.write(f)
+        _CONFIG_OBJECTS.pop(config_path, None)  # So it is re-read, with the non-persistent values, on the next access
 
     if read_method == 'eval':
         value = eval(value)
     elif callable(read_method):
         value = read_method(value)
+    if cache_value and not default_used:
+        cached.values[value_key] = value if _is_immutable_value(value) else deepcopy(value)
     return value
 
 
+def _is_immutable_value(value):
+    if isinstance(value, tuple):
+        return all(_is_immutable_value(v) for v in value)
+    return value is None or isinstance(value, string_types+(binary_type, bool, float, complex)+integer_types)
+
+
 def _get_config_object(config_path, use_cashed_config=True):
     '''
     Returns a ConfigParser for the config file at the given path. If no file exists, an empty config file is created.
@@ -84,17 +170,19 @@ def _get_config_object(config_path, use_cashed_config=True):
         If set to False, will re-read the config file from disk. If a ConfigParser was previously created, it will not be replaced!
     :return:
     '''
-    if config_path not in _CONFIG_OBJECTS or not use_cashed_config:
-        config = ConfigParser()
-        if not os.path.exists(config_path):
+    if use_cashed_config:
+        cached = _get_cached_config(config_path)
+        if cached.file_signature is None:
             with open(config_path,'w') as f:
-                config.write(f)
-        else:
-            config.read(config_path)
-        if use_cashed_config:
-            _CONFIG_OBJECTS[config_path] = config
+                ConfigParser().write(f)  # (Not the cached config, which has the non-persistent values)
+            cached.file_signature = _get_file_signature(config_path)
+        return cached.config
+    config = ConfigParser()
+    if not os.path.exists(config_path):
+        with open(config_path,'w') as f:
+            config.write(f)
     else:
-        config = _CONFIG_OBJECTS[config_path]
+        config.read(config_path)
     return config
 
 
@@ -118,12 +206,16 @@ def get_home_dir():
 
 def get_config_path(config_filename):
     assert config_filename.startswith('.'), "We enforce the convention that configuration files must start with '.'"
-    config_path = os.path.join(get_home_dir(), config_filename)
-    return config_path
+    key = (config_filename, os.path.expanduser('~'))
+    if key not in _CONFIG_PATHS:  # (get_home_dir checks that the directory exists, so we only do it once)
+        _CONFIG_PATHS[key] = os.path.join(get_home_dir(), config_filename)
+    return _CONFIG_PATHS[key]
 
 def set_non_persistent_config_value(config_filename, section, option, value):
     config_path = get_config_path(config_filename)
     config = _get_config_object(config_path)
+    _CONFIG_OVERRIDES.setdefault(config_path, OrderedDict())[(section, option)] = value  # So that it survives re-reading the file
+    _CONFIG_OBJECTS[config_path].values.clear()
     if not config.has_section(section):
         config.add_section(section)
     return config.set(section=section, option=option,value=value)
@@ -1,33 +1,146 @@
 import os
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from shutil import rmtree
 from artemis.general.display import surround_with_header
 from artemis.general.should_be_builtins import izip_equal
-from six.moves import input
+from six.moves import input, queue
 
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-def crawl_directory(directory, ignore_hidden = True):
+
+class _ListdirEntry(object):
+    """
+    A stand-in for os.DirEntry when scandir is not available (so every call to is_dir or stat is a system call).
+    """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self, follow_symlinks=True):
+        return os.path.isdir(self.path) and (follow_symlinks or not os.path.islink(self.path))
+
+    def is_file(self, follow_symlinks=True):
+        return os.path.isfile(self.path) and (follow_symlinks or not os.path.islink(self.path))
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self, follow_symlinks=True):
+        return os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+
+
+def scan_directory(directory, ignore_hidden = True):
+    """
+    List the entries of a directory.  Unlike os.listdir, the entries know whether they are directories without another
+    system call (on most platforms), and cache the result of their stat() calls.
+
+    :param directory: A string representing a directory.
+    :param ignore_hidden: Leave out entries whose names start with '.'
+    :return: A list of os.DirEntry objects (with .name, .path, .is_dir(), .stat(), ...)
+    """
+    if scandir is not None:
+        entries = list(scandir(directory))
+    else:
+        entries = [_ListdirEntry(directory, name) for name in os.listdir(directory)]
+    if ignore_hidden:
+        entries = [e for e in entries if not e.name.startswith('.')]
+    return entries
+
+
+def _scan_directory_or_fail(directory, ignore_hidden):
+    # We catch BaseException too, because in a thread pool an uncaught one kills the worker without ever returning a
+    # result, and the crawl would wait for it forever.
+    try:
+        return directory, scan_directory(directory, ignore_hidden=ignore_hidden), None
+    except BaseException as err:
+        return directory, None, err
+
+
+def _iter_directory_listings(directory, ignore_hidden, follow_symlinks, n_threads):
+    """
+    Yield (directory_path, entries) for the directory and each directory under it.  See iter_directory.
+    """
+    if n_threads is None:
+        pending = [directory]
+        while len(pending) > 0:
+            path, entries, err = _scan_directory_or_fail(pending.pop(), ignore_hidden=ignore_hidden)
+            if err is not None:
+                if path == directory or not isinstance(err, OSError):
+                    raise err
+                continue
+            yield path, entries
+            pending.extend(e.path for e in reversed(entries) if e.is_dir(follow_symlinks=follow_symlinks))
+    else:
+        results = queue.Queue()
+        pool = ThreadPool(n_threads)
+        try:
+            pool.apply_async(_scan_directory_or_fail, (directory, ignore_hidden), callback=results.put)
+            n_pending = 1
+            while n_pending > 0:
+                path, entries, err = results.get()
+                n_pending -= 1
+                if err is not None:
+                    if path == directory or not isinstance(err, OSError):
+                        raise err
+                    continue
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        pool.apply_async(_scan_directory_or_fail, (entry.path, ignore_hidden), callback=results.put)
+                        n_pending += 1
+                yield path, entries
+        finally:
+            pool.terminate()
+
+
+def iter_directory(directory, ignore_hidden = True, follow_symlinks = False, n_threads = None):
+    """
+    Iterate through all the files and directories under a directory, without building the whole tree in memory.  A
+    directory is yielded before the entries inside it.
+
+    Subdirectories that can not be read (e.g. because they were deleted during the crawl) are skipped, as in os.walk.
+
+    :param directory: A string representing a directory.
+    :param ignore_hidden: Skip files and directories whose names start with '.' (and do not go into such directories)
+    :param follow_symlinks: Go into symbolic links to directories (careful: links can make cycles)
+    :param n_threads: If not None, scan subdirectories in a pool of this many threads.  This is much faster on network
+        file systems, where each listing mostly waits on the server.  Then the order in which directories are visited
+        is not fixed (although the entries of each directory still come together).
+    :return: A generator of os.DirEntry objects
+    """
+    for _, entries in _iter_directory_listings(directory, ignore_hidden=ignore_hidden, follow_symlinks=follow_symlinks, n_threads=n_threads):
+        for entry in entries:
+            yield entry
+
+
+def crawl_directory(directory, ignore_hidden = True, n_threads = None):
     """
     Given a directory, return a dict representing the tree of files under that directory.
 
     :param directory: A string representing a directory.
+    :param n_threads: If not None, scan subdirectories in a pool of this many threads (see iter_directory)
     :return: A dict<file_or_dir_name: content> where:
         file_or_dir_name is the name of the file within the parent directory.
         content is either
         - An absolute file path (for files) or
         - A dictionary containing the output of crawl_directory for a subdirectory.
     """
-    contents = os.listdir(directory)
-    if ignore_hidden:
-        contents = [c for c in contents if not c.startswith('.')]
-    this_dir = OrderedDict()
-    for c in contents:
-        full_path = os.path.join(directory, c)
-        if os.path.isdir(full_path):
-            this_dir[c] = crawl_directory(full_path)
-        else:
-            this_dir[c] = full_path
-    return this_dir
+    subtrees = {directory: OrderedDict()}
+    for path, entries in _iter_directory_listings(directory, ignore_hidden=ignore_hidden, follow_symlinks=True, n_threads=n_threads):
+        tree = subtrees[path]
+        for entry in entries:
+            if entry.is_dir():
+                tree[entry.name] = subtrees[entry.path] = OrderedDict()
+            else:
+                tree[entry.name] = entry.path
+    return subtrees[directory]
 
 
 class DirectoryCrawler(object):
@@ -50,19 +163,16 @@ class DirectoryCrawler(object):
         else:
             reverse = False
         if refresh or self._contents is None:
-            self._contents = os.listdir(self.directory)
+            entries = scan_directory(self.directory, ignore_hidden=self.ignore_hidden)  # (The entries cache their stats)
             if sortby=='mtime':
-                self._contents = sorted(self._contents, key = lambda item: os.path.getmtime(self.get_path(item)))
+                entries = sorted(entries, key = lambda entry: entry.stat().st_mtime)
             elif sortby=='name':
-                self._contents = sorted(self._contents)
+                entries = sorted(entries, key = lambda entry: entry.name)
             elif sortby is not None:
                 raise AssertionError('Invalid value for sortby: {}'.format(sortby))
             if reverse:
-                self._contents = self._contents[::-1]
-            if end_dirs_with_slash:
-                self._contents = [c+os.sep if self.isdir(c) else c for c in self._contents]
-            if self.ignore_hidden:
-                self._contents = [item for item in self._contents if not item.startswith('.')]
+                entries = entries[::-1]
+            self._contents = [e.name+os.sep if end_dirs_with_slash and e.is_dir() else e.name for e in entries]
         return self._contents
 
     def isdir(self, item):
@@ -1,11 +1,27 @@
+import atexit
+import gzip
 import logging
 import os
+import pickle
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from functools import partial
 from shutil import rmtree
+from zipfile import BadZipfile
 
+import numpy as np
+from six.moves import queue
+
+from artemis.config import get_artemis_config_value
+from artemis.fileman.file_lock import acquire_file_lock, release_file_lock, write_file_atomically, remove_file_lock
 from artemis.fileman.local_dir import get_artemis_data_path, make_file_dir
+from artemis.fileman.npy_io import load_npz_memmapped
 from artemis.general.functional import infer_arg_values
 from artemis.general.hashing import compute_fixed_hash
+from artemis.general.nested_structures import NestedType
+from artemis.general.should_be_builtins import LRUCache
 from artemis.general.test_mode import is_test_mode
 
 logging.basicConfig()
@@ -19,8 +35,27 @@ MEMO_WRITE_ENABLED = True
 MEMO_READ_ENABLED = True
 MEMO_DIR = get_artemis_data_path('memoize_to_disk')
 
+MEMO_EXTENSIONS = ('.pkl', '.npy', '.npz')
+
+MEMO_STATS_FILE_NAME = '.memo_stats'
+MEMO_COMPUTE_TIMES_FILE_NAME = '.memo_compute_times'
+MEMO_STAT_FIELDS = ('hits', 'misses', 'compute_time', 'time_saved', 'evictions')
+MEMO_WRITE_QUEUE_SIZE = 4  # Max number of write-behind memos waiting to be written before callers block
+MEMO_SIZE_CHECK_INTERVAL = 60.  # Max seconds between scans of the memo directory when a size limit is set
+MEMO_EVICTION_HEADROOM = 0.1  # When a size limit forces evictions, evict down to this fraction below the limit
+
+_NOT_IN_CACHE = object()
+_NPZ_STRUCTURE_KEY = '__structure__'
+_UNFLUSHED_MEMO_STATS = {}  # function_name -> OrderedDict of stats not yet written to the stats file
+_MEMO_COMPUTE_TIMES = {}  # memo_dir -> ((inode, size) of compute-times file when read, dict<memo_name -> compute time>)
+_PENDING_MEMO_WRITES = {}  # filepath -> result, for write-behind memos that have not been written yet
+_MEMO_SIZE_ESTIMATES = {}  # memo_dir (or None for the whole memo directory) -> [estimated bytes, time of last scan]
+_MEMO_WRITER = None
 
-def memoize_to_disk(fcn, local_cache = False, disable_on_tests=False, use_cpickle = False, suppress_info = False):
+
+def memoize_to_disk(fcn, local_cache = False, disable_on_tests=False, use_cpickle = False, suppress_info = False,
+        local_cache_max_entries = None, local_cache_max_bytes = None, storage = 'pickle', lock_across_processes = True,
+        max_disk_bytes = None, compression = None, write_behind = False):
     """
     Save (memoize) computed results to disk, so that the same function, called with the
     same arguments, does not need to be recomputed.  This is useful if you have a long-running
@@ -43,6 +78,9 @@ def memoize_to_disk(fcn, local_cache = False, disable_on_tests=False, use_cpickl
     a) The decorator can/should not be visible from where the function is defined.
     b) You only want to memoize the function in one use-case, but not all.
 
+    The arguments are hashed on every call.  If you repeatedly pass the same large array (e.g. a dataset), freeze it with
+    x = artemis.general.hashing.freeze_array(x) so that it is only hashed once.
+
     :param fcn: The function you're decorating
     :param local_cache: Keep a cache in python (so you don't need to go to disk if you call again in the same process)
     :param disable_on_tests: Persistent memos can really screw up tests, so disable memos when is_test_mode() returns
@@ -50,6 +88,29 @@ def memoize_to_disk(fcn, local_cache = False, disable_on_tests=False, use_cpickl
     :param use_cpickle: Use CPickle, instead of pickle, to save results.  This can be faster for complex python
         structures, but can be slower for numpy arrays.  So we recommend not using it.
     :param suppress_info: Don't log info loading and saving memos.
+    :param local_cache_max_entries: Bound the local cache to this many results, evicting the least recently used ones.
+        (Setting this implies local_cache=True).  Evicted results are still on disk.
+    :param local_cache_max_bytes: Bound the local cache to results whose total (estimated) size is at most this many
+        bytes.  (Setting this implies local_cache=True).
+    :param storage: How to save results to disk.  Can be:
+        'pickle': Pickle everything
+        'numpy': Save numpy arrays natively, and load them back memory-mapped (read-only).  A result that is an array is
+            saved as a .npy file, and a nested structure (lists/tuples/dicts) containing arrays as a .npz file.  Results
+            without arrays are still pickled.  This avoids a full pickle round-trip when loading large arrays.
+        Memos saved with either storage are read back regardless of this setting.
+    :param lock_across_processes: When a memo is missing, take a file lock before computing it, so that if many processes
+        call the function with the same arguments at once, only the first computes the result and the others wait for
+        it and then read it.  (Memo files are always written atomically, so readers never see a partial file).
+    :param max_disk_bytes: Limit the total size of this function's memos on disk.  After a memo is written, the least
+        recently used memos are deleted until the limit is met.  A global limit on the memo directory can also be set in
+        ~/.artemisrc (see enforce_memo_size_limit).
+    :param compression: Compress memos on disk.  Can be None (no compression), 'zlib', 'lzma' (smaller but slower),
+        'lz4' (very fast, but needs the lz4 package), or 'fast' (lz4 if installed, otherwise zlib).  Compression is
+        streamed, so large results are never held in memory twice.  Compressed arrays are not memory-mapped when loaded.
+        This is worth it for compressible results (e.g. sparse arrays), especially on network filesystems.
+    :param write_behind: Return the result as soon as it is computed, and write the memo on a background thread.  At most
+        MEMO_WRITE_QUEUE_SIZE memos wait to be written at once (after that, callers block), and pending memos are written
+        before the process exits (or call flush_memo_writes).  Don't modify the result in-place until it is written.
     :return: A wrapper around the function that checks for memos and loads old results if they exist.
     """
 
@@ -58,66 +119,575 @@ def memoize_to_disk(fcn, local_cache = False, disable_on_tests=False, use_cpickl
     else:
         import pickle
 
-    cached_local_results = {}
+    compression = get_memo_codec(compression)
+    if local_cache_max_entries is not None or local_cache_max_bytes is not None:
+        local_cache = True
+    cached_local_results = LRUCache(max_entries=local_cache_max_entries, max_bytes=local_cache_max_bytes)
+
+    function_name = fcn.__name__
+
+    def read_memo(filepath):
+        # Return the saved result, or _NOT_IN_CACHE if there is no usable memo.
+        memo_path = find_memo_file(filepath, compression=compression)
+        if memo_path is None:
+            return _NOT_IN_CACHE
+        corrupt_memo_errors = get_corrupt_memo_errors(memo_path)
+        try:
+            if not suppress_info:
+                LOGGER.info('Reading memo for function {}'.format(fcn.__name__, ))
+            result = load_memo(memo_path, pickle_module=pickle)
+            _touch_memo(memo_path)
+            _add_memo_stats(function_name, hits=1, time_saved=get_memo_compute_time(memo_path))
+            return result
+        except (IOError, OSError):  # The memo was deleted (e.g. evicted) after we found it.
+            return _NOT_IN_CACHE
+        except ImportError as err:
+            if not suppress_info:
+                LOGGER.warn('Memo-file "{}" was tried to reference an old class and got ImportError: {}.  Recomputing.'.format(memo_path, str(err)))
+            return _NOT_IN_CACHE
+        except corrupt_memo_errors as err:
+            if not suppress_info:
+                LOGGER.warn('Memo-file "{}" was corrupt.  ({}: {}).  Recomputing.'.format(memo_path, err.__class__.__name__, str(err)))
+            return _NOT_IN_CACHE
+
+    def compute_memo(args, kwargs):
+        start_time = time.time()
+        result = fcn(*args, **kwargs)
+        compute_time = time.time() - start_time
+        if MEMO_READ_ENABLED:
+            _add_memo_stats(function_name, misses=1, compute_time=compute_time)
+        return result, compute_time
+
+    def write_memo(filepath, result, compute_time):
+        make_file_dir(filepath)
+        if not suppress_info:
+            LOGGER.info('Writing disk-memo for function {}'.format(fcn.__name__, ))
+        memo_path = save_memo(result, filepath, storage=storage, pickle_module=pickle, compression=compression)
+        _record_memo_compute_time(memo_path, compute_time)
+        if max_disk_bytes is not None:
+            _enforce_memo_size_limit_after_write(max_disk_bytes, memo_path, fcn=fcn)
+        global_max_bytes = get_artemis_config_value(section='memoize', option='max_memo_dir_bytes', default_generator='None', read_method='eval')
+        if global_max_bytes is not None:
+            _enforce_memo_size_limit_after_write(global_max_bytes, memo_path)
 
     def check_memos(*args, **kwargs):
 
         if disable_on_tests and is_test_mode():
             return fcn(*args, **kwargs)
 
-        result_computed = False
         full_args = infer_arg_values(fcn, args, kwargs)
         filepath = get_function_hash_filename(fcn, full_args)
         # The filepath is used as the unique identifier, for both the local path and the disk-path
         # It may be more efficient to use the built-in hashability of certain types for the local cash, and just have special
         # ways of dealing with non-hashables like lists and numpy arrays - it's a bit dangerous because we need to check
         # that no object or subobjects have been changed.
+        if MEMO_READ_ENABLED and local_cache:
+            # local_cache_signature = get_local_cache_signature(args, kwargs)
+            result = cached_local_results.get(filepath, _NOT_IN_CACHE)
+            if result is not _NOT_IN_CACHE:
+                if not suppress_info:
+                    LOGGER.info('Reading disk-memo from local cache for function {}'.format(fcn.__name__, ))
+                _add_memo_stats(function_name, hits=1, time_saved=get_memo_compute_time(filepath, refresh=False))
+                return result
+
         if MEMO_READ_ENABLED:
-            if local_cache:
-                # local_cache_signature = get_local_cache_signature(args, kwargs)
-                if filepath in cached_local_results:
-                    if not suppress_info:
-                        LOGGER.info('Reading disk-memo from local cache for function {}'.format(fcn.__name__, ))
-                    return cached_local_results[filepath]
-            if os.path.exists(filepath):
-                with open(filepath, 'rb') as f:
-                    try:
-                        if not suppress_info:
-                            LOGGER.info('Reading memo for function {}'.format(fcn.__name__, ))
-                        result = pickle.load(f)
-                    except (ValueError, ImportError, EOFError) as err:
-                        if isinstance(err, (ValueError, EOFError)) and not suppress_info:
-                            LOGGER.warn('Memo-file "{}" was corrupt.  ({}: {}).  Recomputing.'.format(filepath, err.__class__.__name__, str(err)))
-                        elif isinstance(err, ImportError) and not suppress_info:
-                            LOGGER.warn('Memo-file "{}" was tried to reference an old class and got ImportError: {}.  Recomputing.'.format(filepath, str(err)))
-                        result_computed = True
-                        result = fcn(*args, **kwargs)
+            result = _PENDING_MEMO_WRITES.get(filepath, _NOT_IN_CACHE)
+            if result is not _NOT_IN_CACHE:
+                _add_memo_stats(function_name, hits=1)
             else:
-                result_computed = True
-                result = fcn(*args, **kwargs)
+                result = read_memo(filepath)
         else:
-            result_computed = True
-            result = fcn(*args, **kwargs)
-
-        if MEMO_WRITE_ENABLED and result is not None:  # We assume result of None means you haven't done coding your function.
-            if local_cache:
-                cached_local_results[filepath] = result
-            if result_computed:  # Result was computed, so write it down
-                filepath = get_function_hash_filename(fcn, full_args, create_dir_if_not=True)
-                make_file_dir(filepath)
-                with open(filepath, 'wb') as f:
-                    if not suppress_info:
-                        LOGGER.info('Writing disk-memo for function {}'.format(fcn.__name__, ))
-                    pickle.dump(result, f, protocol=2)
+            result = _NOT_IN_CACHE
 
+        if result is _NOT_IN_CACHE:
+            # Single-flight: the first process to get here computes the result while the others wait for the lock,
+            # and then read what it wrote.  With write_behind, the lock is released by the writer once the memo is written.
+            holding_lock = MEMO_READ_ENABLED and MEMO_WRITE_ENABLED and lock_across_processes
+            if holding_lock:
+                make_file_dir(filepath)
+                lock = acquire_file_lock(get_memo_lock_path(filepath))
+            try:
+                if holding_lock:
+                    result = read_memo(filepath)
+                if result is _NOT_IN_CACHE:
+                    result, compute_time = compute_memo(args, kwargs)
+                    if MEMO_WRITE_ENABLED and result is not None:  # We assume result of None means you haven't done coding your function.
+                        if write_behind:
+                            _submit_memo_write(filepath, result, partial(write_memo, filepath, result, compute_time), lock=lock if holding_lock else None)
+                            holding_lock = False
+                        else:
+                            write_memo(filepath, result, compute_time)
+            finally:
+                if holding_lock:
+                    release_file_lock(lock)
+
+        if MEMO_WRITE_ENABLED and local_cache and result is not None:
+            cached_local_results[filepath] = result
         return result
 
     check_memos.wrapped_fcn = fcn
     check_memos.clear_cache = lambda: clear_memo_files_for_function(check_memos)
+    check_memos.local_cache = cached_local_results
 
     return check_memos
 
 
+def _is_native_array(obj):
+    return isinstance(obj, np.ndarray) and obj.dtype != object and obj.size > 0
+
+
+def _open_lz4(fileobj, mode):
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImportError("The 'lz4' codec needs the lz4 package.  Install it with 'pip install lz4', or use compression='zlib'.")
+    return lz4.frame.LZ4FrameFile(fileobj, mode=mode)
+
+
+def _import_lzma():
+    try:
+        import lzma
+    except ImportError:  # Python 2
+        from backports import lzma
+    return lzma
+
+
+def _open_lzma(fileobj, mode):
+    return _import_lzma().LZMAFile(fileobj, mode=mode)
+
+
+# codec -> (file extension, function which wraps a file object in a streaming (de)compressor)
+MEMO_CODECS = OrderedDict([
+    ('zlib', ('.gz', lambda fileobj, mode: gzip.GzipFile(fileobj=fileobj, mode=mode, compresslevel=6))),
+    ('lzma', ('.xz', _open_lzma)),
+    ('lz4', ('.lz4', _open_lz4)),
+    ])
+_CODEC_EXTENSIONS = dict((ext, codec) for codec, (ext, _) in MEMO_CODECS.items())
+
+
+def get_memo_codec(compression):
+    """
+    :param compression: None, the name of a codec in MEMO_CODECS, or 'fast' to use lz4 if it is installed (and zlib
+        otherwise).
+    :return: The name of the codec (or None)
+    """
+    if compression == 'fast':
+        try:
+            import lz4.frame
+            return 'lz4'
+        except ImportError:
+            return 'zlib'
+    assert compression is None or compression in MEMO_CODECS, "compression must be None, 'fast', or one of {}.  Got '{}'".format(list(MEMO_CODECS.keys()), compression)
+    return compression
+
+
+def get_corrupt_memo_errors(memo_path):
+    """
+    :param memo_path: Path to a memo file
+    :return: A tuple of the exception types that mean that this memo file is corrupt (e.g. truncated or partly
+        overwritten), so that it should be recomputed.
+    """
+    errors = (ValueError, EOFError, BadZipfile, zlib.error, pickle.UnpicklingError)
+    codec = _CODEC_EXTENSIONS.get(os.path.splitext(memo_path)[1])
+    if codec == 'lzma':
+        try:
+            errors += (_import_lzma().LZMAError, )
+        except ImportError:
+            pass
+    elif codec == 'lz4':
+        errors += (RuntimeError, )  # lz4.frame reports corrupt frames as RuntimeErrors
+    return errors
+
+
+def is_memo_file(filename):
+    """
+    :param filename: A file name in a memo directory
+    :return: True if it is a memo (as opposed to a lock file, stats file, temporary file, etc.)
+    """
+    base, ext = os.path.splitext(filename)
+    if ext in _CODEC_EXTENSIONS:
+        base, ext = os.path.splitext(base)
+    return ext in MEMO_EXTENSIONS and not filename.startswith('.')
+
+
+def _get_memo_name(memo_path):
+    return os.path.basename(memo_path).split('.', 1)[0]
+
+
+def find_memo_file(filepath, compression=None):
+    """
+    :param filepath: The path of the memo, as returned by get_function_hash_filename (ending in .pkl)
+    :param compression: The codec that the memo was probably saved with.  This is checked first, but all formats are
+        checked.
+    :return: The path of the memo file that exists for this path (which may be saved as .pkl, .npy or .npz, and may be
+        compressed), or None
+    """
+    base_path, _ = os.path.splitext(filepath)
+    codec_exts = [''] + [ext for ext, _ in MEMO_CODECS.values()]
+    if compression is not None:
+        codec_exts.insert(0, MEMO_CODECS[compression][0])
+    for codec_ext in codec_exts:
+        for ext in MEMO_EXTENSIONS:
+            if os.path.exists(base_path + ext + codec_ext):
+                return base_path + ext + codec_ext
+    return None
+
+
+def get_memo_lock_path(filepath):
+    """
+    :param filepath: The path of the memo, as returned by get_function_hash_filename
+    :return: The path of the lock file used when computing this memo.
+    """
+    return os.path.splitext(filepath)[0] + '.lock'
+
+
+def _write_compressed(write_function, compression):
+    # Wrap a function which writes to a file object so that it writes through a streaming compressor.
+    if compression is None:
+        return write_function
+    _, open_codec = MEMO_CODECS[compression]
+
+    def write_compressed(fileobj):
+        with open_codec(fileobj, 'wb') as f:
+            write_function(f)
+    return write_compressed
+
+
+def save_memo(result, filepath, storage='pickle', pickle_module=pickle, compression=None):
+    """
+    Save a memo to disk.
+    :param result: The result to save
+    :param filepath: The path of the memo (ending in .pkl).  If it is saved natively as numpy, the extension is changed.
+        The file is written atomically, so concurrent readers never see a partially written memo.
+    :param storage: 'pickle' or 'numpy'.  See memoize_to_disk.
+    :param compression: None, or a codec (see get_memo_codec) to compress the memo with.  Data is compressed as it is
+        written, so no compressed copy is held in memory.
+    :return: The path of the file that was written.
+    """
+    assert storage in ('pickle', 'numpy'), "storage must be 'pickle' or 'numpy', not '{}'".format(storage)
+    compression = get_memo_codec(compression)
+    codec_ext = MEMO_CODECS[compression][0] if compression is not None else ''
+    base_path, _ = os.path.splitext(filepath)
+    if storage == 'numpy':
+        if _is_native_array(result):
+            return write_file_atomically(base_path + '.npy' + codec_ext, _write_compressed(lambda f: np.lib.format.write_array(f, result, allow_pickle=False), compression))
+        if compression is None:  # Compressed nested structures are just pickled, since they could not be memory-mapped anyway.
+            try:
+                nested_type = NestedType.from_data(result)
+                leaves = nested_type.get_leaves(result, check_types=False)
+            except Exception:  # Some structure that we don't know how to take apart (e.g. sets or namedtuples).
+                leaves = []
+            array_ixs = [i for i, leaf in enumerate(leaves) if _is_native_array(leaf)]
+            if len(array_ixs) > 0:
+                array_ix_set = set(array_ixs)
+                structure = (nested_type, len(leaves), array_ixs, [leaf for i, leaf in enumerate(leaves) if i not in array_ix_set])
+                arrays = dict(('arr_{}'.format(i), leaves[i]) for i in array_ixs)
+                arrays[_NPZ_STRUCTURE_KEY] = np.frombuffer(pickle_module.dumps(structure, protocol=2), dtype=np.uint8)
+                return write_file_atomically(base_path + '.npz', lambda f: np.savez(f, **arrays))
+    return write_file_atomically(base_path + '.pkl' + codec_ext, _write_compressed(lambda f: pickle_module.dump(result, f, protocol=2), compression))
+
+
+def load_memo(memo_path, pickle_module=pickle):
+    """
+    Load a memo saved with save_memo.  Uncompressed arrays saved natively are memory-mapped in read-only mode.
+    :param memo_path: Path to a .pkl, .npy or .npz memo file (with an extra extension like .gz if it is compressed)
+    :return: The result
+    """
+    base_path, codec_ext = os.path.splitext(memo_path)
+    if codec_ext in _CODEC_EXTENSIONS:
+        _, open_codec = MEMO_CODECS[_CODEC_EXTENSIONS[codec_ext]]
+        with open(memo_path, 'rb') as raw_file:
+            with open_codec(raw_file, 'rb') as f:
+                if base_path.endswith('.npy'):
+                    return np.lib.format.read_array(f, allow_pickle=False)
+                else:
+                    return pickle_module.load(f)
+    elif memo_path.endswith('.npy'):
+        return np.load(memo_path, mmap_mode='r', allow_pickle=False)
+    elif memo_path.endswith('.npz'):
+        arrays = load_npz_memmapped(memo_path)
+        nested_type, n_leaves, array_ixs, other_leaves = pickle_module.loads(arrays.pop(_NPZ_STRUCTURE_KEY).tobytes())
+        array_leaves = dict((i, arrays['arr_{}'.format(i)]) for i in array_ixs)
+        other_leaves = iter(other_leaves)
+        leaves = [array_leaves[i] if i in array_leaves else next(other_leaves) for i in range(n_leaves)]
+        return nested_type.expand_from_leaves(leaves, check_types=False)
+    else:
+        with open(memo_path, 'rb') as f:
+            return pickle_module.load(f)
+
+
+def _touch_memo(memo_path):
+    # Update the access time explicitly, since many filesystems are mounted with noatime or relatime.
+    try:
+        os.utime(memo_path, (time.time(), os.stat(memo_path).st_mtime))
+    except OSError:
+        pass
+
+
+def _add_memo_stats(function_name, **increments):
+    if function_name not in _UNFLUSHED_MEMO_STATS:
+        _UNFLUSHED_MEMO_STATS[function_name] = OrderedDict((field, 0) for field in MEMO_STAT_FIELDS)
+    stats = _UNFLUSHED_MEMO_STATS[function_name]
+    for field, increment in increments.items():
+        stats[field] += increment
+
+
+def flush_memo_stats():
+    """
+    Write the memo statistics gathered in this process to the stats files in the memo directory.  This is called
+    automatically when the process exits.  Each process appends a line, so no locking is needed.
+    """
+    for function_name, stats in list(_UNFLUSHED_MEMO_STATS.items()):
+        function_memo_dir = os.path.join(MEMO_DIR, function_name)
+        if os.path.isdir(function_memo_dir):
+            with open(os.path.join(function_memo_dir, MEMO_STATS_FILE_NAME), 'a') as f:
+                f.write('\t'.join(str(stats[field]) for field in MEMO_STAT_FIELDS)+'\n')
+    _UNFLUSHED_MEMO_STATS.clear()
+
+
+atexit.register(flush_memo_stats)
+
+
+class _MemoWriter(object):
+    """
+    Writes memos on a background thread, in the order they were submitted.
+    """
+
+    def __init__(self, max_pending):
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._write_memos, name='memo-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_memos(self):
+        while True:
+            filepath, result, write_function, lock = self._queue.get()
+            try:
+                write_function()
+            except Exception:
+                LOGGER.exception('Failed to write memo "{}".  It will be recomputed next time.'.format(filepath))
+            finally:
+                if _PENDING_MEMO_WRITES.get(filepath) is result:
+                    del _PENDING_MEMO_WRITES[filepath]
+                release_file_lock(lock)
+                self._queue.task_done()
+
+    def submit(self, filepath, result, write_function, lock):
+        self._queue.put((filepath, result, write_function, lock))  # Blocks while the queue is full
+
+    def flush(self):
+        self._queue.join()
+
+
+def _submit_memo_write(filepath, result, write_function, lock):
+    global _MEMO_WRITER
+    if _MEMO_WRITER is None or _MEMO_WRITER.pid != os.getpid():  # A forked child does not inherit the writer thread
+        _MEMO_WRITER = _MemoWriter(max_pending=MEMO_WRITE_QUEUE_SIZE)
+    _PENDING_MEMO_WRITES[filepath] = result
+    _MEMO_WRITER.submit(filepath, result, write_function, lock)
+
+
+def flush_memo_writes():
+    """
+    Wait until all memos from functions memoized with write_behind=True have been written to disk.  This is called
+    automatically when the process exits.
+    """
+    if _MEMO_WRITER is not None and _MEMO_WRITER.pid == os.getpid():
+        _MEMO_WRITER.flush()
+
+
+atexit.register(flush_memo_writes)  # Registered after flush_memo_stats, so runs before it.
+
+
+def _record_memo_compute_time(memo_path, compute_time):
+    with open(os.path.join(os.path.dirname(memo_path), MEMO_COMPUTE_TIMES_FILE_NAME), 'a') as f:
+        f.write('{}\t{}\n'.format(_get_memo_name(memo_path), compute_time))
+
+
+def get_memo_compute_time(memo_path, refresh=True):
+    """
+    :param memo_path: Path to a memo file
+    :param refresh: Check whether other processes have recorded new compute times since we last read them.
+    :return: The time it took to compute the memo, in seconds (or 0 if it was not recorded).
+    """
+    memo_dir = os.path.dirname(memo_path)
+    if refresh or memo_dir not in _MEMO_COMPUTE_TIMES:
+        compute_times_path = os.path.join(memo_dir, MEMO_COMPUTE_TIMES_FILE_NAME)
+        try:
+            stat = os.stat(compute_times_path)
+            version = (stat.st_ino, stat.st_size)  # Compacting replaces the file, and may leave it the same size.
+        except OSError:
+            version = None
+    if memo_dir not in _MEMO_COMPUTE_TIMES or refresh and _MEMO_COMPUTE_TIMES[memo_dir][0] != version:
+        compute_times = {}
+        if version is not None:
+            with open(compute_times_path) as f:
+                for line in f:
+                    name, _, seconds = line.rstrip('\n').partition('\t')
+                    try:
+                        compute_times[name] = float(seconds)
+                    except ValueError:  # Partially written line
+                        pass
+        _MEMO_COMPUTE_TIMES[memo_dir] = (version, compute_times)
+    return _MEMO_COMPUTE_TIMES[memo_dir][1].get(_get_memo_name(memo_path), 0.)
+
+
+def enforce_memo_size_limit(max_bytes, fcn=None):
+    """
+    Delete the least recently used memos until their total size is at most max_bytes.  Memos are ordered by their last
+    access time (which we update explicitly on every read).  The stats and compute-time files in the memo directories
+    count towards the total, and are compacted when memos are evicted.
+
+    This is called automatically after writing a memo if you set max_disk_bytes in memoize_to_disk, or if you set a global
+    limit in ~/.artemisrc:
+
+        [memoize]
+        max_memo_dir_bytes = 20e9
+
+    To avoid scanning all the memos on every write, the automatic check keeps a running estimate of their size, and
+    only scans when a write would take the estimate over the limit or when MEMO_SIZE_CHECK_INTERVAL seconds have passed
+    (memos written by other processes are only noticed then).  When it has to evict, it evicts MEMO_EVICTION_HEADROOM
+    below the limit, so that the next few writes don't need to scan again.
+
+    :param max_bytes: The maximum total size, in bytes.
+    :param fcn: A memoized function, to limit the size of its memos alone, or None to limit the whole memo directory.
+    :return: A list of the paths of the deleted memos.
+    """
+    deleted, _ = _evict_memos(max_bytes, target_bytes=max_bytes, fcn=fcn)
+    return deleted
+
+
+def _enforce_memo_size_limit_after_write(max_bytes, memo_path, fcn=None):
+    key = get_memo_dir(fcn) if fcn is not None else None
+    estimate = _MEMO_SIZE_ESTIMATES.get(key)
+    try:
+        memo_bytes = os.path.getsize(memo_path)
+    except OSError:  # Already evicted by another process
+        memo_bytes = 0
+    if estimate is not None and estimate[0]+memo_bytes <= max_bytes and time.time()-estimate[1] < MEMO_SIZE_CHECK_INTERVAL:
+        estimate[0] += memo_bytes
+    else:
+        _, total_bytes = _evict_memos(max_bytes, target_bytes=max_bytes*(1-MEMO_EVICTION_HEADROOM), fcn=fcn)
+        _MEMO_SIZE_ESTIMATES[key] = [total_bytes, time.time()]
+
+
+def _evict_memos(max_bytes, target_bytes, fcn=None):
+    """
+    If the memos (and their side files) take more than max_bytes, delete the least recently used memos until they take
+    at most target_bytes.
+    :return: A list of the paths of the deleted memos, and the total size in bytes of what remains.
+    """
+    memo_dirs = [get_memo_dir(fcn)] if fcn is not None else get_all_memo_dirs()
+    memos = []
+    total_bytes = 0
+    for memo_dir in memo_dirs:
+        if not os.path.isdir(memo_dir):
+            continue
+        for name in os.listdir(memo_dir):
+            if is_memo_file(name) or name in (MEMO_STATS_FILE_NAME, MEMO_COMPUTE_TIMES_FILE_NAME):
+                path = os.path.join(memo_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # Deleted by someone else in the meantime
+                    continue
+                total_bytes += stat.st_size
+                if is_memo_file(name):
+                    memos.append((stat.st_atime, stat.st_size, path))
+    deleted = []
+    if total_bytes > max_bytes:
+        for _, size, path in sorted(memos):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            remove_file_lock(os.path.join(os.path.dirname(path), _get_memo_name(path)+'.lock'))
+            total_bytes -= size
+            deleted.append(path)
+            _add_memo_stats(os.path.basename(os.path.dirname(path)), evictions=1)
+    for memo_dir in set(os.path.dirname(path) for path in deleted):
+        total_bytes += _compact_memo_side_files(memo_dir)
+    if len(deleted) > 0:
+        LOGGER.info('Evicted {} memos to keep {} under {:.3g} bytes'.format(len(deleted), memo_dirs[0] if fcn is not None else MEMO_DIR, float(max_bytes)))
+    return deleted, total_bytes
+
+
+def _sum_memo_stats_rows(rows):
+    totals = OrderedDict((field, 0) for field in MEMO_STAT_FIELDS)
+    for row in rows:
+        if len(row) == len(MEMO_STAT_FIELDS):
+            for field, value in zip(MEMO_STAT_FIELDS, row):
+                totals[field] += float(value) if field in ('compute_time', 'time_saved') else int(value)
+    return totals
+
+
+def _compact_memo_side_files(memo_dir):
+    """
+    Drop the compute times of memos that no longer exist, and sum the rows of the stats file into one, so that these
+    files don't grow forever.  (A line appended by another process while we rewrite a file may be lost.)
+    :return: The change in their total size, in bytes.
+    """
+    change = 0
+    memo_names = set(_get_memo_name(name) for name in os.listdir(memo_dir) if is_memo_file(name))
+    compute_times_path = os.path.join(memo_dir, MEMO_COMPUTE_TIMES_FILE_NAME)
+    if os.path.exists(compute_times_path):
+        with open(compute_times_path) as f:
+            contents = f.read()
+        compacted = ''.join(line+'\n' for line in contents.split('\n')[:-1] if line.partition('\t')[0] in memo_names)
+        write_file_atomically(compute_times_path, lambda f: f.write(compacted.encode('utf-8')))
+        change += len(compacted) - len(contents)
+    stats_path = os.path.join(memo_dir, MEMO_STATS_FILE_NAME)
+    if os.path.exists(stats_path):
+        with open(stats_path) as f:
+            contents = f.read()
+        compacted = '\t'.join(str(v) for v in _sum_memo_stats_rows(line.split('\t') for line in contents.split('\n')[:-1]).values())+'\n'
+        write_file_atomically(stats_path, lambda f: f.write(compacted.encode('utf-8')))
+        change += len(compacted) - len(contents)
+    return change
+
+
+def get_memo_stats():
+    """
+    Get usage statistics for all memoized functions, accumulated over all processes that have used them.
+    :return: An OrderedDict<function_name -> OrderedDict<stat_name -> value>>.  Stats are: n_memos, bytes (total size on
+        disk), hits, misses, compute_time (total time spent computing memos), time_saved (total compute time of memos
+        that were read instead of computed), and evictions.
+    """
+    all_stats = OrderedDict()
+    for memo_dir in sorted(get_all_memo_dirs()):
+        if not os.path.isdir(memo_dir):
+            continue
+        function_name = os.path.basename(memo_dir)
+        stats = OrderedDict([('n_memos', 0), ('bytes', 0)] + [(field, 0) for field in MEMO_STAT_FIELDS])
+        for name in os.listdir(memo_dir):
+            if is_memo_file(name):
+                stats['n_memos'] += 1
+                stats['bytes'] += os.path.getsize(os.path.join(memo_dir, name))
+        stats_path = os.path.join(memo_dir, MEMO_STATS_FILE_NAME)
+        rows = []
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                rows = [line.rstrip('\n').split('\t') for line in f]
+        if function_name in _UNFLUSHED_MEMO_STATS:
+            rows.append(list(_UNFLUSHED_MEMO_STATS[function_name].values()))
+        stats.update(_sum_memo_stats_rows(rows))
+        all_stats[function_name] = stats
+    return all_stats
+
+
+def get_memo_stats_table():
+    """
+    :return: A string table of memo usage statistics (see get_memo_stats)
+    """
+    from tabulate import tabulate
+    all_stats = get_memo_stats()
+    headers = ['Function', 'Memos', 'Size (MB)', 'Hits', 'Misses', 'Compute Time (s)', 'Time Saved (s)', 'Evictions']
+    rows = [[name, s['n_memos'], '{:.3g}'.format(s['bytes']/2.**20), s['hits'], s['misses'], '{:.3g}'.format(s['compute_time']), '{:.3g}'.format(s['time_saved']), s['evictions']] for name, s in all_stats.items()]
+    return tabulate(rows, headers=headers)
+
+
 def memoize_to_disk_test(fcn):
     """
     Use this just when testing the memoization itself (because normally memoization is disabled when is_test_mode() is True.
@@ -166,27 +736,35 @@ def get_memo_dir(fcn):
     return os.path.join(MEMO_DIR, fcn.__name__)
 
 
-def get_memo_files_for_function(fcn):
-
+def get_memo_files_for_function(fcn, include_other_files=False):
+    """
+    :param fcn: The memoized function (or the function it wraps)
+    :param include_other_files: Also include lock files and temporary files.
+    :return: A list of paths to the memo files for this function
+    """
     function_memo_dir = get_memo_dir(fcn)
     if not os.path.exists(function_memo_dir):
         return []
     else:
         memos = os.listdir(function_memo_dir)
-        memo_paths = [os.path.join(function_memo_dir, mem) for mem in memos]
+        memo_paths = [os.path.join(function_memo_dir, mem) for mem in memos if include_other_files or is_memo_file(mem)]
         return memo_paths
 
 
 def clear_memo_files_for_function(fcn):
-    memos = get_memo_files_for_function(fcn)
+    flush_memo_writes()
+    memos = get_memo_files_for_function(fcn, include_other_files=True)
     for m in memos:
         os.remove(m)
+    _MEMO_SIZE_ESTIMATES.clear()
 
 
 def clear_all_memos():
+    flush_memo_writes()
     all_memos = get_all_memo_dirs()
     for m in all_memos:
         rmtree(m)
+    _MEMO_SIZE_ESTIMATES.clear()
     print('Removed all {} memo directories.'.format(len(all_memos)))
 
 
@@ -236,6 +814,7 @@ class DisableMemos(object):
 
 def browse_memos():
     from artemis.fileman.directory_crawl import DirectoryCrawlerUI
+    print(get_memo_stats_table())
     DirectoryCrawlerUI(MEMO_DIR, sortby='mtime', show_num_items=True).launch()
 
 
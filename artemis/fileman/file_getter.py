@@ -1,21 +1,40 @@
 import hashlib
+import time
+from collections import OrderedDict, deque
 from contextlib import contextmanager
 from shutil import rmtree
-from six.moves import StringIO
+from io import BytesIO
 import gzip
+import threading
 import tarfile
 from zipfile import ZipFile
 import shutil
 import os
-from six.moves.urllib.request import urlopen
-from artemis.fileman.local_dir import get_artemis_data_path, make_file_dir
-from artemis.general.should_be_builtins import bad_value
+import stat
+import uuid
+from six.moves import queue
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import urlopen, Request
+from artemis.fileman.file_lock import write_file_atomically, hold_file_lock
+from artemis.fileman.local_dir import get_artemis_data_path, make_file_dir, make_dir
 
 __author__ = 'peter'
 
 
 FILE_ROOT = get_artemis_data_path()
 
+DOWNLOAD_CHUNK_SIZE = 2**20
+DOWNLOAD_PROGRESS_INTERVAL = 2.  # Seconds between progress reports
+EXTRACTION_BUFFER_CHUNKS = 16  # Max number of downloaded chunks waiting to be extracted, when extracting while downloading
+
+DOWNLOAD_CACHE_HASH = 'sha256'
+DOWNLOAD_MANIFEST_FILE_NAME = 'manifest.tsv'
+
+_INCOMPLETE_EXTRACTION_MARKER = '.artemis_incomplete_extraction'  # In an extracted folder that is not (yet) complete
+_DOWNLOAD_MANIFESTS = {}  # manifest path -> (number of bytes of the manifest file read, dict<url -> (content_hash, size, mtime)>)
+_ARCHIVE_TYPES = ('.tar.gz', '.zip')
+
 
 def set_file_root(path, make_dir=True):
     if make_dir:
@@ -45,16 +64,18 @@ def hold_file_root(path, make_dir = True, delete_after = False, delete_before=Fa
         rmtree(path)
 
 
-def get_file(relative_name=None, url = None, use_cache = True, data_transformation = None):
+def get_file(relative_name=None, url = None, use_cache = True, data_transformation = None, checksum = None):
     """
     Get a file and return the full local path to that file.
 
     :param relative_name: The name of the local file, relative to the FILE_ROOT (by default, FILE_ROOT is ~/.artemis)
         Or if None, and a URL is specified, we give the file a temporary name.
     :param url: Optionally, a url to fetch this file from if it doesn't exist locally.
-    :param use_cache: If the file exists locally and a URL is specified, use the local version.
+    :param use_cache: If the file exists locally and a URL is specified, use the local version (after checking that it is
+        intact - see download_to_cache).
     :param data_transformation: Optionally a function that takes the downloaded data (from response.read) and outputs
         binary data that is be written into the file.
+    :param checksum: Optionally, a checksum to verify the download against (see download_file)
     :return:
     """
 
@@ -62,26 +83,594 @@ def get_file(relative_name=None, url = None, use_cache = True, data_transformati
 
     full_filename = get_file_path(relative_name=relative_name, url=url)
 
-    if (not os.path.exists(full_filename)) or (not use_cache):
+    if (not os.path.exists(full_filename)) or (not use_cache) or (url is not None and data_transformation is None and not _is_local_copy_intact(url, full_filename)):
         assert url is not None, "No local copy of '%s' was found, and you didn't provide a URL to fetch it from" % (full_filename, )
 
-        print('Downloading file from url: "%s"...' % (url, ))
-        response = urlopen(url)
-        data = response.read()
-        print('...Done.')
-
-        if data_transformation is not None:
+        if data_transformation is None:
+            download_to_cache(url, full_filename, checksum=checksum, use_cache=use_cache)
+        elif data_transformation is unzip_gz:  # Decompress from file to file, rather than in memory
+            download_path = download_to_cache(url, checksum=checksum, use_cache=use_cache)
+            print('Decompressing downloaded data...')
+            with gzip.open(download_path, 'rb') as f_in:
+                write_file_atomically(full_filename, lambda f_out: shutil.copyfileobj(f_in, f_out, DOWNLOAD_CHUNK_SIZE))
+        else:
+            download_path = download_to_cache(url, checksum=checksum, use_cache=use_cache)
+            with open(download_path, 'rb') as f:
+                data = f.read()
             print('Processing downloaded data...')
             data = data_transformation(data)
-        make_file_dir(full_filename)
-        with open(full_filename, 'wb') as f:
-            f.write(data)
+            write_file_atomically(full_filename, lambda f: f.write(data))
     return full_filename
 
 
+def get_download_cache_dir():
+    """
+    :return: The directory of the download cache (see download_to_cache).
+    """
+    return os.path.join(FILE_ROOT, 'download_cache')
+
+
+def get_cached_download_path(content_hash):
+    """
+    :param content_hash: The (DOWNLOAD_CACHE_HASH) hex digest of the contents of a file
+    :return: The path where a download with this content is stored in the download cache
+    """
+    return os.path.join(get_download_cache_dir(), 'objects', content_hash[:2], content_hash)
+
+
+def _get_download_manifest_path():
+    return os.path.join(get_download_cache_dir(), DOWNLOAD_MANIFEST_FILE_NAME)
+
+
+def _get_partial_download_path(url):
+    return os.path.join(get_download_cache_dir(), 'downloads', hashlib.md5(url.encode('utf-8')).hexdigest())
+
+
+def load_download_manifest():
+    """
+    The manifest records, for each url that has been downloaded into the download cache, the content hash, size and
+    modification time of the downloaded file.  It is a file of tab-separated lines, which are appended to as files are
+    downloaded (later lines take precedence).
+
+    :return: A dict<url -> (content_hash, size, mtime)>
+    """
+    path = _get_download_manifest_path()
+    file_size = os.path.getsize(path) if os.path.exists(path) else 0
+    n_bytes_read, manifest = _DOWNLOAD_MANIFESTS.get(path, (0, {}))
+    if file_size < n_bytes_read:  # The manifest was rewritten
+        n_bytes_read, manifest = 0, {}
+    if file_size > n_bytes_read:
+        with open(path, 'rb') as f:
+            f.seek(n_bytes_read)
+            new_data = f.read()
+        new_data = new_data[:new_data.rfind(b'\n')+1]  # Skip a line that is still being written
+        for line in new_data.decode('utf-8').splitlines():
+            url, content_hash, size, mtime = line.split('\t')
+            manifest[url] = (content_hash, int(size), float(mtime))
+        _DOWNLOAD_MANIFESTS[path] = (n_bytes_read + len(new_data), manifest)
+    return manifest
+
+
+def _add_to_download_manifest(url, content_hash, size, mtime):
+    path = _get_download_manifest_path()
+    make_file_dir(path)
+    with open(path, 'ab') as f:
+        f.write(u'{}\t{}\t{}\t{!r}\n'.format(url, content_hash, size, mtime).encode('utf-8'))
+
+
+def _hash_file(path, algorithm=DOWNLOAD_CACHE_HASH):
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _verify_checksum(url, path, checksum):
+    # Check an already-downloaded file against a checksum (see download_file)
+    algorithm, expected_digest = checksum.split(':', 1) if ':' in checksum else ('md5', checksum)
+    digest = _hash_file(path, algorithm=algorithm)
+    if digest != expected_digest.lower():
+        raise IOError('The file downloaded from "{}" had {} checksum {}, not {}.'.format(url, algorithm, digest, expected_digest))
+
+
+def _is_file_intact(path, manifest_entry):
+    # Check the size and modification time, and only if the file has been modified, check the hash.
+    content_hash, size, mtime = manifest_entry
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_size == size and (stat.st_mtime == mtime or _hash_file(path) == content_hash)
+
+
+def _is_local_copy_intact(url, local_path):
+    # Return False (and delete the file) if local_path was downloaded from url, but has been corrupted since.
+    manifest_entry = load_download_manifest().get(url)
+    if manifest_entry is None or _is_file_intact(local_path, manifest_entry):  # (No entry means it predates the download cache)
+        return True
+    print('The local copy of "{}" at "{}" is corrupt.  Downloading it again.'.format(url, local_path))
+    os.remove(local_path)
+    return False
+
+
+def _make_read_only(path):
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if mode & 0o222:
+        os.chmod(path, mode & ~0o222)
+
+
+def _link_file(source_path, destination_path):
+    # Hard-link source to destination (or copy it, where we can't link), replacing destination if it exists.
+    directory, filename = os.path.split(make_file_dir(destination_path))
+    temp_path = os.path.join(directory, '.{}.{}.link'.format(filename, uuid.uuid4().hex))  # Unique, so processes linking the same file don't collide
+    try:
+        try:
+            os.link(source_path, temp_path)
+        except (OSError, AttributeError):  # Different file systems, or no hard links on this platform
+            shutil.copy2(source_path, temp_path)  # (copy2 keeps the modification time, so the copy still matches the manifest)
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, destination_path)
+        else:  # Python 2
+            if os.path.exists(destination_path):
+                os.remove(destination_path)
+            os.rename(temp_path, destination_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _get_intact_cached_download(url):
+    # Return the path of the cached download of url, or None if it has not been downloaded (or the download is corrupt).
+    manifest_entry = load_download_manifest().get(url)
+    if manifest_entry is None:
+        return None
+    cached_path = get_cached_download_path(manifest_entry[0])
+    if _is_file_intact(cached_path, manifest_entry):
+        return cached_path
+    if os.path.exists(cached_path):
+        print('The cached download of "{}" is corrupt.  Downloading it again.'.format(url))
+        os.remove(cached_path)
+    return None
+
+
+def _download_into_cache(url, partial_path, **download_kwargs):
+    # Download url into the cache (the caller holds the lock on partial_path) and add it to the manifest.
+    hasher = hashlib.new(DOWNLOAD_CACHE_HASH)
+    download_path = download_file(url, partial_path, hasher=hasher, **download_kwargs)
+    content_hash = hasher.hexdigest()
+    cached_path = get_cached_download_path(content_hash)
+    if os.path.exists(cached_path) and _hash_file(cached_path) == content_hash:
+        os.remove(download_path)  # We already have this file (from another url)
+    else:
+        make_file_dir(cached_path)
+        if hasattr(os, 'replace'):
+            os.replace(download_path, cached_path)
+        else:  # Python 2
+            if os.path.exists(cached_path):
+                os.remove(cached_path)
+            os.rename(download_path, cached_path)
+    _make_read_only(cached_path)
+    file_stat = os.stat(cached_path)
+    _add_to_download_manifest(url, content_hash, file_stat.st_size, file_stat.st_mtime)
+    return cached_path
+
+
+def download_to_cache(url, local_path=None, checksum=None, use_cache=True, show_progress=True, chunk_callback=None):
+    """
+    Download a file into the download cache (unless it is already there), and hard-link it to local_path.
+
+    Downloads are stored by the hash of their contents, so a file downloaded from two urls (e.g. mirrors) is only stored
+    once.  The manifest (see load_download_manifest) records the hash, size and modification time of each url's file.
+    When a cached file is reused, we check that its size and modification time match the manifest (and if only the
+    modification time differs, that its hash still matches), and download it again if not.
+
+    Cached files are made read-only, because local_path is a hard link to the cached file (which may also be linked to
+    from other paths), so modifying it would modify the cached file.  If you need to modify it, copy it.
+
+    :param url: The url to download
+    :param local_path: Optionally, a path to link the downloaded file to.
+    :param checksum: Optionally, a checksum to verify the download against (see download_file)
+    :param use_cache: Use the cached file, if there is an intact one for this url.
+    :param show_progress: Print messages and progress while downloading
+    :param chunk_callback: Optionally, a function which is called with each chunk of data as it is downloaded (see
+        download_file).  Not called if we use the cached file.
+    :return: The path of the file in the download cache.
+    """
+    cached_path = _get_intact_cached_download(url) if use_cache else None
+    if cached_path is None:
+        partial_path = _get_partial_download_path(url)
+        make_file_dir(partial_path)
+        with hold_file_lock(partial_path+'.lock'):  # So that two processes do not write to the same .part file
+            if use_cache:  # Another process may have downloaded it while we waited for the lock
+                cached_path = _get_intact_cached_download(url)
+            if cached_path is None:
+                cached_path = _download_into_cache(url, partial_path, checksum=checksum, show_progress=show_progress, chunk_callback=chunk_callback)
+
+    if local_path is not None:
+        _link_file(cached_path, local_path)
+    return cached_path
+
+
+def verify_download_cache(repair=False):
+    """
+    Check the hash of every file in the download cache against the manifest.
+    :param repair: Download missing or corrupt files again, and rewrite the manifest with one line per url.
+    :return: A list of (url, problem) pairs, where problem is 'missing' or 'corrupt'
+    """
+    manifest = load_download_manifest()
+    hash_matches = {}  # content_hash -> whether the file matches its hash (several urls may share a file)
+    problems = []
+    for url, (content_hash, size, mtime) in sorted(manifest.items()):
+        cached_path = get_cached_download_path(content_hash)
+        if not os.path.exists(cached_path):
+            problems.append((url, 'missing'))
+            continue
+        if content_hash not in hash_matches:
+            hash_matches[content_hash] = _hash_file(cached_path) == content_hash
+        if not hash_matches[content_hash]:
+            problems.append((url, 'corrupt'))
+    print('Checked {} downloaded files: {} missing, {} corrupt.'.format(len(manifest), sum(p == 'missing' for _, p in problems), sum(p == 'corrupt' for _, p in problems)))
+
+    if repair:
+        for url, problem in problems:
+            cached_path = get_cached_download_path(manifest[url][0])
+            if os.path.exists(cached_path):
+                os.remove(cached_path)
+            try:
+                download_to_cache(url)
+            except Exception as err:
+                print('Could not download "{}" again: {}'.format(url, err))
+        manifest = load_download_manifest()
+        lines = []
+        for url, (content_hash, _, _) in sorted(manifest.items()):
+            cached_path = get_cached_download_path(content_hash)
+            if os.path.exists(cached_path):
+                stat = os.stat(cached_path)
+                lines.append(u'{}\t{}\t{}\t{!r}\n'.format(url, content_hash, stat.st_size, stat.st_mtime))
+        write_file_atomically(_get_download_manifest_path(), lambda f: f.write(u''.join(lines).encode('utf-8')))
+    return problems
+
+
+def download_file(url, local_path, checksum=None, resume=True, chunk_size=DOWNLOAD_CHUNK_SIZE, show_progress=True, chunk_callback=None, hasher=None):
+    """
+    Download a file, streaming it to disk in chunks (so it never has to fit in memory).
+
+    The data is written to local_path+'.part', which is renamed to local_path when the download is complete, so
+    local_path never holds a partial file.  If the download is interrupted, the .part file is left behind, and the next
+    call continues from where it stopped (if the server supports HTTP Range requests - otherwise it starts again).
+
+    :param url: The url to download
+    :param local_path: The path to save the file to
+    :param checksum: Optionally, a checksum to verify the downloaded file against, either as a hex digest string (for
+        md5) or as '<algorithm>:<hex digest>', e.g. 'sha256:9f86d0...'.  If the file does not match, the partial file
+        is deleted and an IOError is raised.
+    :param resume: Continue from a .part file left by an earlier download, if there is one.
+    :param chunk_size: Number of bytes to read and write at a time
+    :param show_progress: Print messages and progress while downloading
+    :param chunk_callback: Optionally, a function which is called with each chunk of data as it is downloaded.  (If
+        the download is resumed, this only sees the data after the resumed part).
+    :param hasher: Optionally, a hashlib object, which is updated with the entire contents of the file (including any
+        part downloaded earlier).
+    :return: local_path
+    """
+    part_path = local_path + '.part'
+    offset = os.path.getsize(part_path) if resume and os.path.exists(part_path) else 0
+    request = Request(url)
+    if offset > 0:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+    try:
+        response = urlopen(request)
+    except HTTPError as err:
+        if err.code != 416 or offset == 0:
+            raise
+        offset = 0  # Range not satisfiable, so the part file must not be part of this file.  Start again.
+        response = urlopen(url)
+
+    try:
+        if offset > 0 and (response.getcode() != 206 or not _get_content_range_start(response) == offset):
+            offset = 0  # The server does not support ranges, so it sent the whole file.
+        content_length = response.info().get('Content-Length')
+        total_size = offset + int(content_length) if content_length is not None else None
+
+        if checksum is not None:
+            algorithm, expected_digest = checksum.split(':', 1) if ':' in checksum else ('md5', checksum)
+            checksum_hasher = hashlib.new(algorithm)
+        else:
+            checksum_hasher = None
+        hashers = [h for h in (checksum_hasher, hasher) if h is not None]
+        if offset > 0 and len(hashers) > 0:
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    for h in hashers:
+                        h.update(chunk)
+
+        if show_progress and offset > 0:
+            print('Resuming download from url: "%s" at %s...' % (url, _format_n_bytes(offset)))
+        elif show_progress:
+            print('Downloading file from url: "%s"...' % (url, ))
+        make_file_dir(local_path)
+        n_bytes = offset
+        start_time = last_report_time = time.time()
+        with open(part_path, 'ab' if offset > 0 else 'wb') as f:
+            for chunk in iter(lambda: response.read(chunk_size), b''):
+                f.write(chunk)
+                if chunk_callback is not None:
+                    chunk_callback(chunk)
+                for h in hashers:
+                    h.update(chunk)
+                n_bytes += len(chunk)
+                if show_progress and time.time() - last_report_time > DOWNLOAD_PROGRESS_INTERVAL:
+                    last_report_time = time.time()
+                    print('  Downloaded {}{} ({}/s)'.format(
+                        _format_n_bytes(n_bytes),
+                        ' of {} ({:.0%})'.format(_format_n_bytes(total_size), float(n_bytes)/total_size) if total_size else '',
+                        _format_n_bytes((n_bytes-offset)/(last_report_time-start_time)),
+                        ))
+    finally:
+        response.close()
+
+    if total_size is not None and n_bytes < total_size:
+        raise IOError('The download from "{}" was interrupted after {} of {} bytes.  Call again to resume it.'.format(url, n_bytes, total_size))
+    if checksum_hasher is not None and checksum_hasher.hexdigest() != expected_digest.lower():
+        os.remove(part_path)
+        raise IOError('The file downloaded from "{}" had {} checksum {}, not {}.'.format(url, algorithm, checksum_hasher.hexdigest(), expected_digest))
+    if hasattr(os, 'replace'):
+        os.replace(part_path, local_path)
+    else:  # Python 2
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        os.rename(part_path, local_path)
+    if show_progress:
+        print('...Done.')
+    return local_path
+
+
+def _get_content_range_start(response):
+    content_range = response.info().get('Content-Range')  # e.g. "bytes 100-999/1000"
+    if content_range is None:
+        return None
+    return int(content_range.split()[-1].split('-')[0])
+
+
+def _format_n_bytes(n_bytes):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if n_bytes < 1024 or unit == 'GB':
+            return '{:.1f}{}'.format(n_bytes, unit) if unit != 'B' else '{}B'.format(int(n_bytes))
+        n_bytes /= 1024.
+
+
+class DownloadManager(object):
+    """
+    Downloads many files concurrently, with a bounded number of threads and connections per host.
+
+        with DownloadManager(n_threads=16) as manager:
+            local_paths = manager.get_files(urls, relative_names=names)
+
+    Or submit downloads one at a time, and wait for them later:
+
+        download = manager.submit(url, relative_name)
+        ...
+        local_path = download.wait()
+
+    Failed downloads are retried after increasing delays (1, 2, 4... times retry_delay), continuing from where they
+    stopped if the server supports it.  Submitting a download that is already in progress (the same url and local path)
+    returns the existing download.  A url that is requested under several local paths is only fetched once, and the
+    file linked to each of them.
+    """
+
+    def __init__(self, n_threads=8, max_per_host=4, n_retries=3, retry_delay=1., use_cache=True, show_progress=True):
+        """
+        :param n_threads: Number of downloads that can run at once
+        :param max_per_host: Number of downloads that can run at once from any one host
+        :param n_retries: Number of times to retry a failed download (errors like "404 Not Found" are not retried)
+        :param retry_delay: Seconds to wait before the first retry.  The delay doubles with each retry.
+        :param use_cache: If a file already exists locally (or is in the download cache), don't download it again.
+        :param show_progress: Periodically print the overall progress.
+        """
+        self.n_threads = n_threads
+        self.max_per_host = max_per_host
+        self.n_retries = n_retries
+        self.retry_delay = retry_delay
+        self.use_cache = use_cache
+        self.show_progress = show_progress
+        self._condition = threading.Condition()
+        self._pending_by_host = OrderedDict()  # host -> deque of downloads waiting to start
+        self._n_active_by_host = {}
+        self._downloads = {}  # (url, local_path) -> download
+        self._in_flight = {}  # url -> list of the downloads waiting for it to be fetched (the first is the one queued)
+        self._threads = []
+        self._closed = False
+        self._n_submitted = self._n_done = self._n_failed = self._n_bytes = 0
+        self._start_time = self._last_report_time = time.time()
+
+    def submit(self, url, relative_name=None, checksum=None):
+        """
+        Start downloading a file (or queue it to be downloaded).
+        :param url: The url to download
+        :param relative_name: The local name of the file, relative to FILE_ROOT (see get_file).
+        :param checksum: Optionally, a checksum to verify the file against (see download_file)
+        :return: A _Download object, whose wait() method returns the local path of the downloaded file.
+        """
+        local_path = get_file_path(relative_name=relative_name, url=url)
+        with self._condition:
+            assert not self._closed, 'This DownloadManager has been closed'
+            download = self._downloads.get((url, local_path))
+            if download is not None and not (download.done() and download.error is not None):
+                return download
+            download = self._downloads[(url, local_path)] = _Download(url, local_path, checksum)
+            self._n_submitted += 1
+            if self.use_cache and os.path.exists(local_path) and _is_local_copy_intact(url, local_path):
+                self._finish(download)
+                return download
+            if url in self._in_flight:  # Already being fetched under another name: we'll link the file when it arrives.
+                self._in_flight[url].append(download)
+                return download
+            self._in_flight[url] = [download]
+            host = urlparse(url).netloc
+            self._pending_by_host.setdefault(host, deque()).append(download)
+            if len(self._threads) < self.n_threads:
+                thread = threading.Thread(target=self._download_files, name='downloader-{}'.format(len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._condition.notify()
+        return download
+
+    def get_files(self, urls, relative_names=None, checksums=None, raise_errors=True):
+        """
+        Download a batch of files, and wait until they are all done.
+        :param urls: A list of urls
+        :param relative_names: Optionally, a list of local names (relative to FILE_ROOT) for the files.
+        :param checksums: Optionally, a list of checksums (see download_file)
+        :param raise_errors: If a download fails, raise its error (after all other downloads are done).  If False,
+            the path of a failed download is returned as None.
+        :return: A list of local paths to the files.
+        """
+        if relative_names is None:
+            relative_names = [None]*len(urls)
+        if checksums is None:
+            checksums = [None]*len(urls)
+        downloads = [self.submit(url, relative_name=name, checksum=checksum) for url, name, checksum in zip(urls, relative_names, checksums)]
+        for d in downloads:
+            d.wait(raise_error=False)
+        if raise_errors:
+            return [d.wait() for d in downloads]
+        else:
+            return [d.local_path if d.error is None else None for d in downloads]
+
+    def _get_next_download(self):
+        # Take a download from a host that has a connection free, waiting for one if necessary.  Call with the lock held.
+        while not self._closed:
+            for host, pending in self._pending_by_host.items():
+                if self._n_active_by_host.get(host, 0) < self.max_per_host:
+                    download = pending.popleft()
+                    if len(pending) == 0:
+                        del self._pending_by_host[host]
+                    self._n_active_by_host[host] = self._n_active_by_host.get(host, 0) + 1
+                    return host, download
+            self._condition.wait()
+        return None, None
+
+    def _download_files(self):
+        while True:
+            with self._condition:
+                host, download = self._get_next_download()
+            if download is None:
+                return
+            cached_path, error = None, None
+            for attempt in range(self.n_retries+1):
+                try:
+                    cached_path = download_to_cache(download.url, checksum=download.checksum, use_cache=self.use_cache, show_progress=False, chunk_callback=self._count_bytes)
+                    error = None
+                    break
+                except Exception as err:
+                    error = err
+                    if attempt == self.n_retries or (isinstance(err, HTTPError) and 400 <= err.code < 500 and err.code != 429):
+                        break
+                    time.sleep(self.retry_delay * 2**attempt)
+            with self._condition:
+                waiting = self._in_flight.pop(download.url)
+            for d in waiting:
+                d.error = error
+                if error is None:
+                    try:
+                        if d.checksum is not None and d.checksum != download.checksum:
+                            _verify_checksum(d.url, cached_path, d.checksum)
+                        _link_file(cached_path, d.local_path)
+                    except Exception as err:
+                        d.error = err
+            with self._condition:
+                self._n_active_by_host[host] -= 1
+                for d in waiting:
+                    self._finish(d)
+                self._condition.notify_all()
+
+    def _count_bytes(self, chunk):
+        with self._condition:
+            self._n_bytes += len(chunk)
+            self._report_progress()
+
+    def _finish(self, download):
+        # Call with the lock held
+        self._n_done += 1
+        self._n_failed += download.error is not None
+        download._done_event.set()
+        self._report_progress(final=self._n_done == self._n_submitted)
+
+    def _report_progress(self, final=False):
+        now = time.time()
+        if self.show_progress and (final or now - self._last_report_time > DOWNLOAD_PROGRESS_INTERVAL):
+            self._last_report_time = now
+            print('Downloaded {} of {} files{}.  {} at {}/s'.format(
+                self._n_done, self._n_submitted, ' ({} failed)'.format(self._n_failed) if self._n_failed else '',
+                _format_n_bytes(self._n_bytes), _format_n_bytes(self._n_bytes/max(now-self._start_time, 1e-9))))
+
+    def close(self):
+        """
+        Stop the download threads, after they finish their current downloads.  Downloads that have not started fail.
+        """
+        with self._condition:
+            self._closed = True
+            for pending in self._pending_by_host.values():
+                for download in pending:
+                    for d in self._in_flight.pop(download.url):
+                        d.error = IOError('The download manager was closed before "{}" was downloaded.'.format(d.url))
+                        self._finish(d)
+            self._pending_by_host.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Download(object):
+
+    def __init__(self, url, local_path, checksum=None):
+        self.url = url
+        self.local_path = local_path
+        self.checksum = checksum
+        self.error = None
+        self._done_event = threading.Event()
+
+    def done(self):
+        return self._done_event.is_set()
+
+    def wait(self, raise_error=True):
+        """
+        Wait for the download to finish.
+        :param raise_error: If the download failed, raise its error.
+        :return: The local path of the file
+        """
+        self._done_event.wait()
+        if raise_error and self.error is not None:
+            raise self.error
+        return self.local_path
+
+
+def get_files(urls, relative_names=None, checksums=None, **download_manager_kwargs):
+    """
+    Download a batch of files concurrently (see DownloadManager).
+    :param urls: A list of urls
+    :param relative_names: Optionally, a list of local names (relative to FILE_ROOT) for the files.
+    :param checksums: Optionally, a list of checksums (see download_file)
+    :param download_manager_kwargs: Passed to DownloadManager
+    :return: A list of local paths to the files.
+    """
+    with DownloadManager(**download_manager_kwargs) as manager:
+        return manager.get_files(urls, relative_names=relative_names, checksums=checksums)
+
+
 def get_file_in_archive(subpath, url, relative_path=None, force_extract = False, use_cache=True):
     """
     Download a zip file, unpack it, and get the local address of a file within this zip (so that you can open it, etc).
+    Only this file is extracted (unless the whole archive has already been extracted).
 
     :param relative_path: Local name for the extracted folder.  (Zip file will be named this with the appropriate zip extension)
     :param url: Url of the zip file to download
@@ -89,19 +678,27 @@ def get_file_in_archive(subpath, url, relative_path=None, force_extract = False,
     :param force_extract: Force the zip file to re-extract (rather than just reusing the extracted folder)
     :return: The full path to the file on your system.
     """
-    local_folder_path = get_archive(relative_path=relative_path, url=url, force_extract=force_extract, use_cache=use_cache)
+    local_folder_path = get_archive(relative_path=relative_path, url=url, force_extract=force_extract, use_cache=use_cache, member=subpath)
     local_file_path = os.path.join(local_folder_path, subpath)
     assert os.path.exists(local_file_path), 'Could not find the file "%s" within the extracted folder: "%s"' % (subpath, local_folder_path)
     return local_file_path
 
 
-def get_archive(url, relative_path=None, force_extract=False, archive_type = None, use_cache=True):
+def get_archive(url, relative_path=None, force_extract=False, archive_type = None, use_cache=True, member=None):
     """
     Download a compressed archive and extract it into a folder.
 
+    The archive is streamed to disk, and members are extracted in chunks, so neither the archive nor its members need to
+    fit in memory.  A .tar.gz archive is extracted while it downloads.  The archive is kept, so it can be re-extracted
+    without downloading it again.
+
     :param relative_path: Local name for the extracted folder.  (Zip file will be named this with the appropriate zip extension)
     :param url: Url of the archive to download
     :param force_extract: Force the zip file to re-extract (rather than just reusing the extracted folder)
+    :param archive_type: '.tar.gz' or '.zip', or None to infer it from the url or the downloaded file
+    :param use_cache: Reuse the extracted folder (or the downloaded archive) if it exists.
+    :param member: Optionally, the path of a single file within the archive.  If given, only this file is extracted
+        (until the whole archive is asked for).
     :return: The full path to the extracted folder on your system.
     """
 
@@ -110,63 +707,161 @@ def get_archive(url, relative_path=None, force_extract=False, archive_type = Non
 
     local_folder_path, _ = os.path.splitext(os.path.join(FILE_ROOT, relative_path))
 
-    assert archive_type in ('.tar.gz', '.zip', None)
+    assert archive_type in _ARCHIVE_TYPES + (None, )
+
+    incomplete_marker_path = os.path.join(local_folder_path, _INCOMPLETE_EXTRACTION_MARKER)
+    if not use_cache and os.path.exists(local_folder_path):
+        shutil.rmtree(local_folder_path)
+    if os.path.exists(local_folder_path) and not force_extract:
+        if not os.path.exists(incomplete_marker_path):
+            return local_folder_path
+        elif member is not None and os.path.exists(os.path.join(local_folder_path, member)):
+            return local_folder_path
+
+    if archive_type is None:
+        archive_type = next((ext for ext in _ARCHIVE_TYPES if url.endswith(ext) or os.path.exists(local_folder_path+ext)), None)
+    local_archive_path = local_folder_path + archive_type if archive_type is not None else None
+    if local_archive_path is not None and not use_cache and os.path.exists(local_archive_path):
+        os.remove(local_archive_path)
+
+    make_dir(local_folder_path)
+    with open(incomplete_marker_path, 'w'):
+        pass
+    if local_archive_path is not None and os.path.exists(local_archive_path):
+        _extract_archive(local_archive_path, local_folder_path, archive_type, member=member)
+    elif archive_type == '.tar.gz' and url not in load_download_manifest() and not os.path.exists(_get_partial_download_path(url)+'.part'):
+        _download_and_extract_tar_gz(url, local_archive_path, local_folder_path, member=member)
+    else:  # Zip files can only be extracted once they are complete.  If we don't know the type, we find it from the file.
+        download_path = local_archive_path if archive_type is not None else local_folder_path+'.download'
+        download_to_cache(url, download_path, use_cache=use_cache)
+        if archive_type is None:
+            archive_type = _get_archive_type_from_contents(download_path)
+            local_archive_path = local_folder_path + archive_type
+            os.rename(download_path, local_archive_path)
+        _extract_archive(local_archive_path, local_folder_path, archive_type, member=member)
+    if member is None:
+        os.remove(incomplete_marker_path)
 
-    if (not os.path.exists(local_folder_path)) or (not use_cache):  # If the folder does not exist, download zip and extract.
-        # (We also check force download here to avoid a race condition)
+    return local_folder_path
 
-        if not use_cache and os.path.exists(local_folder_path):
-            shutil.rmtree(local_folder_path)
 
-        response = urlopen(url)
+def _get_archive_type_from_contents(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(b'\x1f\x8b'):
+        return '.tar.gz'
+    elif magic == b'PK\x03\x04':
+        return '.zip'
+    else:
+        raise Exception("Could not infer archive type from user argument, url-name, or file contents.  Please specify archive type as either '.zip' or '.tar.gz'.")
 
-        # Need to infer
-        if archive_type is None:
-            if url.endswith('.tar.gz'):
-                archive_type = '.tar.gz'
-            elif url.endswith('.zip'):
-                archive_type = '.zip'
-            else:
-                # info = response.info()
-                try:
-                    # header = next(x for x in info.headers if x.startswith('Content-Disposition'))
-                    header = response.headers['content-disposition']
-                    original_file_name = next(x for x in header.split(';') if x.startswith('filename')).split('=')[-1].lstrip('"\'').rstrip('"\'')
-                    archive_type = '.tar.gz' if original_file_name.endswith('.tar.gz') else '.zip' if original_file_name.endswith('.zip') else \
-                        bad_value(original_file_name, 'Filename "%s" does not end with a familiar zip extension like .zip or .tar.gz' % (original_file_name, ))
-                except StopIteration:
-                    raise Exception("Could not infer archive type from user argument, url-name, or file-header.  Please specify archive type as either '.zip' or '.tar.gz'.")
-        print('Downloading archive from url: "%s"...' % (url, ))
-        data = response.read()
-        print('...Done.')
 
-        local_zip_path = local_folder_path + archive_type
-        if os.path.exists(local_zip_path):
-            if os.path.isdir(local_zip_path): # This shouldnt happen but may by accident.
-                rmtree(local_zip_path)
-            else:
-                os.remove(local_zip_path)
-        make_file_dir(local_zip_path)
-        with open(local_zip_path, 'wb') as f:
-            f.write(data)
-
-        force_extract = True
-
-    if force_extract:
-        if archive_type == '.tar.gz':
-            with tarfile.open(local_zip_path) as f:
-                f.extractall(local_folder_path)
-        elif archive_type == '.zip':
-            with ZipFile(local_zip_path) as f:
+def _normalize_member_name(name):
+    name = name.replace(os.sep, '/')
+    return name[2:] if name.startswith('./') else name
+
+
+def _extract_tar(tar, local_folder_path, member=None):
+    # Works on tarfiles opened as streams (mode 'r|gz'), which can only be read from start to end.
+    if member is None:
+        tar.extractall(local_folder_path)
+    else:
+        for tar_info in tar:
+            if _normalize_member_name(tar_info.name) == _normalize_member_name(member):
+                tar.extract(tar_info, local_folder_path)
+                break
+
+
+def _extract_archive(local_archive_path, local_folder_path, archive_type, member=None):
+    print('Extracting {}...'.format(member if member is not None else 'archive "%s"' % (local_archive_path, )))
+    if archive_type == '.tar.gz':
+        with tarfile.open(local_archive_path, mode='r|gz') as f:
+            _extract_tar(f, local_folder_path, member=member)
+    elif archive_type == '.zip':
+        with ZipFile(local_archive_path) as f:
+            if member is None:
                 f.extractall(local_folder_path)
-        else:
-            raise Exception()
+            elif _normalize_member_name(member) in f.namelist():
+                f.extract(_normalize_member_name(member), local_folder_path)
+    else:
+        raise Exception()
 
-    return local_folder_path
+
+class _ChunkStream(object):
+    """
+    A file-like object that reads chunks of bytes which are put into a bounded queue by another thread.
+    """
+
+    def __init__(self, max_chunks):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._chunk = b''
+        self._position = 0
+        self._done = False
+
+    def put(self, chunk):
+        self._queue.put(chunk)  # Blocks while the queue is full
+
+    def end(self, error=None):
+        self._queue.put(error)
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._position == len(self._chunk):
+                if self._done:
+                    break
+                chunk = self._queue.get()
+                if chunk is None or isinstance(chunk, BaseException):  # (BaseException, e.g. on KeyboardInterrupt)
+                    self._done = True
+                    if chunk is not None:
+                        raise IOError('The download failed: {}'.format(chunk))
+                    break
+                self._chunk, self._position = chunk, 0
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._position+size)
+            pieces.append(self._chunk[self._position:end])
+            if size > 0:
+                size -= end - self._position
+            self._position = end
+        return b''.join(pieces)
+
+    def drain(self):
+        while not self._done:
+            chunk = self._queue.get()
+            self._done = chunk is None or isinstance(chunk, BaseException)
+
+
+def _download_and_extract_tar_gz(url, local_archive_path, local_folder_path, member=None):
+    # Download the archive to disk, and at the same time extract it on another thread from a bounded buffer of chunks.
+    stream = _ChunkStream(max_chunks=EXTRACTION_BUFFER_CHUNKS)
+    extraction_errors = []
+
+    def extract():
+        try:
+            with tarfile.open(fileobj=stream, mode='r|gz') as f:
+                _extract_tar(f, local_folder_path, member=member)
+        except Exception as err:
+            extraction_errors.append(err)
+        finally:
+            stream.drain()  # If we stop early (e.g. we found the member), keep taking chunks so the download can finish
+
+    extraction_thread = threading.Thread(target=extract, name='archive-extractor')
+    extraction_thread.daemon = True
+    extraction_thread.start()
+    try:
+        download_to_cache(url, local_archive_path, chunk_callback=stream.put)
+    except BaseException as err:
+        stream.end(error=err)
+        raise
+    else:
+        stream.end()
+    finally:
+        extraction_thread.join()
+    if len(extraction_errors) > 0:
+        raise extraction_errors[0]
 
 
 def unzip_gz(data):
-    return gzip.GzipFile(fileobj = StringIO(data)).read()
+    return gzip.GzipFile(fileobj = BytesIO(data)).read()
 
 
 def get_file_path(relative_name = None, url=None, make_folder = False):
@@ -205,3 +900,12 @@ def get_unnamed_file_hash(url):
     hasher.update(url.encode('utf-8'))
     filename = os.path.join('temp', hasher.hexdigest()) + ext
     return filename
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Verify the files in the download cache against their hashes.')
+    parser.add_argument('-r', '--repair', action='store_true', help='Download missing or corrupt files again')
+    args = parser.parse_args()
+    for url, problem in verify_download_cache(repair=args.repair):
+        print('{}: {}'.format(problem, url))
@@ -0,0 +1,149 @@
+import logging
+import os
+import stat
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
+
+_warned_about_missing_locks = False
+
+
+@contextmanager
+def hold_file_lock(lock_path, shared=False):
+    """
+    Hold an advisory lock on a file, which is respected by other processes (and threads) that use hold_file_lock on the
+    same path.  The call blocks until the lock is available.
+
+        with hold_file_lock('/path/to/my_resource.lock'):
+            # Only one process gets in here at a time.
+            ...
+
+    The lock file is created if it does not exist, and left behind afterwards (removing it would let a waiting process
+    lock a file that no longer has a name).  The lock is released if the process dies.  On platforms without fcntl
+    (Windows) this does not lock, and logs a warning the first time it is used.
+
+    :param lock_path: Path of the lock file.
+    :param shared: If True, take a shared (read) lock, which can be held by many processes at once but excludes
+        exclusive locks.
+    """
+    lock = acquire_file_lock(lock_path, shared=shared)
+    try:
+        yield
+    finally:
+        release_file_lock(lock)
+
+
+def acquire_file_lock(lock_path, shared=False):
+    """
+    Take the lock that hold_file_lock holds, without releasing it at the end of a block.  This is for when the lock is
+    released somewhere else (e.g. on another thread).  Every call must be matched by a call to release_file_lock.
+
+    :param lock_path: Path of the lock file.
+    :param shared: If True, take a shared (read) lock.
+    :return: A handle to pass to release_file_lock.
+    """
+    global _warned_about_missing_locks
+    if fcntl is None:
+        if not _warned_about_missing_locks:
+            LOGGER.warning('File locking is not supported on this platform, so processes will not wait for one another.')
+            _warned_about_missing_locks = True
+        return None
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def release_file_lock(lock):
+    """
+    Release a lock taken with acquire_file_lock.
+    :param lock: The handle returned by acquire_file_lock
+    """
+    if lock is None:
+        return
+    try:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    finally:
+        os.close(lock)
+
+
+def remove_file_lock(lock_path):
+    """
+    Delete a lock file, if no process holds or is waiting for the lock.  If it is in use, it is left alone.
+
+    A process which opened the lock file just before we deleted it can still lock the deleted file, so two processes
+    may then hold "the" lock at once.  Only use this where that is harmless (e.g. when it can only cause duplicate work).
+
+    :param lock_path: Path of the lock file.
+    :return: True if the lock file was deleted.
+    """
+    if fcntl is None:
+        return False
+    try:
+        fd = os.open(lock_path, os.O_RDWR)
+    except OSError:  # It does not exist
+        return False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):  # Someone holds it
+            return False
+        try:
+            os.remove(lock_path)
+        except OSError:
+            return False
+        return True
+    finally:
+        os.close(fd)
+
+
+def _get_umask():
+    # There's no way to read the umask without setting it, which is not safe while other threads create files, so we
+    # read it once, on import.
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+_UMASK = _get_umask()
+
+
+def write_file_atomically(path, write_function):
+    """
+    Write a file so that readers either see the old file (or no file) or the complete new one - never a partially
+    written file.  We write to a temporary file in the same directory and then rename it into place.  The file keeps
+    the permissions of the file it replaces (or, if it is new, gets the permissions allowed by the umask).
+
+    :param path: The path of the file to write.
+    :param write_function: A function which takes an open binary file object and writes the contents to it.
+    :return: The path
+    """
+    directory, filename = os.path.split(path)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:  # It does not exist yet, so give it the permissions that open() would.
+        mode = 0o666 & ~_UMASK
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.'+filename+'.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if hasattr(os, 'fchmod'):  # mkstemp creates files that only we can read
+                os.fchmod(f.fileno(), mode)
+            write_function(f)
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, path)
+        else:  # Python 2 (where rename overwrites on everything but Windows)
+            os.rename(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
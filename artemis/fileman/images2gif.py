@@ -68,9 +68,10 @@ Usefull links
 import os, time
 
 def encode(x):
-  if False:
-    return x.encode('utf-8')
-  return x
+    # The header strings are built with chr, so in Python 3 we map each character to a byte.
+    if isinstance(x, bytes):
+        return x
+    return x.encode('latin-1')
 
 try:
     import PIL
@@ -139,6 +140,20 @@ def checkImages(images):
     return images2
 
 
+def getImageData(im):
+    """ getImageData(im)
+
+    Get the image descriptor (including the LZW minimum code size) and
+    the image data chunks of a paletted PIL image.
+
+    """
+    data = getdata(im)
+    imdes, data = data[0], data[1:]
+    if len(imdes) == 10:  # Newer versions of PIL give the LZW minimum code size as a separate chunk
+        imdes, data = imdes + data[0], data[1:]
+    return imdes, data
+
+
 def intToBin(i):
     """ Integer to two bytes """
     # devide in two parts (bytes)
@@ -342,8 +357,8 @@ class GifWriter:
             Y = np.argwhere(diff.sum(1))
             # Get rect coordinates
             if X.size and Y.size:
-                x0, x1 = X[0], X[-1]+1
-                y0, y1 = Y[0], Y[-1]+1
+                x0, x1 = int(X[0, 0]), int(X[-1, 0])+1
+                y0, y1 = int(Y[0, 0]), int(Y[-1, 0])+1
             else: # No change ... make it minimal
                 x0, x1 = 0, 2
                 y0, y1 = 0, 2
@@ -360,11 +375,12 @@ class GifWriter:
         return ims2, xy
 
 
-    def convertImagesToPIL(self, images, dither, nq=0):
-        """ convertImagesToPIL(images, nq=0)
+    def convertImagesToPIL(self, images, dither, nq=0, quantizer=None):
+        """ convertImagesToPIL(images, nq=0, quantizer=None)
 
         Convert images to Paletted PIL images, which can then be
-        written to a single animaged GIF.
+        written to a single animaged GIF.  See writeGif for nq and
+        quantizer.
 
         """
 
@@ -384,8 +400,15 @@ class GifWriter:
 
         # Convert to paletted PIL images
         images, images2 = images2, []
-        if nq >= 1:
+        if quantizer == 'kmeans':
+            quantizer = KMeansQuantizer()
+        if hasattr(quantizer, 'quantize'):
+            # A quantizer object, which is shared across the frames
+            for im in images:
+                images2.append(quantizer.quantize(im, dither=dither))
+        elif quantizer == 'neuquant' or (quantizer is None and nq >= 1):
             # NeuQuant algorithm
+            nq = nq if nq >= 1 else 10
             for im in images:
                 im = im.convert("RGBA") # NQ assumes RGBA
                 nqInstance = NeuQuant(im, int(nq)) # Learn colors from image
@@ -394,12 +417,14 @@ class GifWriter:
                 else:
                     im = nqInstance.quantize(im)  # Use to quantize the image itself
                 images2.append(im)
-        else:
+        elif quantizer in (None, 'pil'):
             # Adaptive PIL algorithm
             AD = Image.ADAPTIVE
             for im in images:
                 im = im.convert('P', palette=AD, dither=dither)
                 images2.append(im)
+        else:
+            raise ValueError("Unknown quantizer: {}".format(quantizer))
 
         # Done
         return images2
@@ -455,8 +480,7 @@ class GifWriter:
                 # xys[frames] = (0, 0)
 
                 # Gather info
-                data = getdata(im)
-                imdes, data = data[0], data[1:]
+                imdes, data = getImageData(im)
                 graphext = self.getGraphicsControlExt(durations[frames],
                                                         disposes[frames])
                 # Make image descriptor suitable for using 256 local color palette
@@ -487,8 +511,9 @@ class GifWriter:
 
 class OnlineGifWriter(object):
 
-    def __init__(self, filename, repeat = True, fps = 10, dispose = 2, xy = (0,0)):  # Todo, displose, loop, etc
+    def __init__(self, filename, repeat = True, fps = 10, dispose = 2, xy = (0,0), quantizer = None):  # Todo, displose, loop, etc
         self.filename = filename
+        self.quantizer = KMeansQuantizer() if quantizer == 'kmeans' else quantizer  # (So that the palette is shared across frames)
         self.pointless_instance = GifWriter()
         self.first_frame = True
         self.duration = 1./fps
@@ -511,7 +536,7 @@ class OnlineGifWriter(object):
         im = self.check_im(im)
 
         if isinstance(im, np.ndarray):
-            im, = self.pointless_instance.convertImagesToPIL([im], dither=False, nq=0)
+            im, = self.pointless_instance.convertImagesToPIL([im], dither=False, nq=0, quantizer=self.quantizer)
 
         if self.first_frame:
             self._init_gif(im)
@@ -542,8 +567,7 @@ class OnlineGifWriter(object):
             palette = im.palette.tobytes()
 
         # Gather info
-        data = getdata(im)
-        imdes, data = data[0], data[1:]
+        imdes, data = getImageData(im)
         graphext = self.pointless_instance.getGraphicsControlExt(duration,
                                                 dispose)
         # Make image descriptor suitable for using 256 local color palette
@@ -601,9 +625,9 @@ class OnlineGifWriter(object):
 ## Exposed functions
 
 def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
-                nq=0, subRectangles=True, dispose=None):
+                nq=0, subRectangles=True, dispose=None, quantizer=None):
     """ writeGif(filename, images, duration=0.1, repeat=True, dither=False,
-                    nq=0, subRectangles=True, dispose=None)
+                    nq=0, subRectangles=True, dispose=None, quantizer=None)
 
     Write an animated gif from the specified images.
 
@@ -640,6 +664,14 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
         in place. 2 means the background color should be restored after
         each frame. 3 means the decoder should restore the previous frame.
         If subRectangles==False, the default is 2, otherwise it is 1.
+    quantizer : None, 'pil', 'neuquant', 'kmeans', or a quantizer object
+        How to create the color palettes.  'pil' uses PIL's adaptive
+        palette for each frame.  'neuquant' uses NeuQuant (see nq), which
+        is slow.  'kmeans' uses a KMeansQuantizer, which is vectorized,
+        and shares one palette across frames until the colors change.
+        A quantizer object (e.g. a KMeansQuantizer) has a
+        quantize(image, dither) method.  If None, NeuQuant is used if
+        nq is nonzero, otherwise PIL.
 
     """
 
@@ -691,7 +723,7 @@ def writeGif(filename, images, duration=0.1, repeat=True, dither=False,
 
 
     # Make images in a format that we can write easy
-    images = gifWriter.convertImagesToPIL(images, dither, nq)
+    images = gifWriter.convertImagesToPIL(images, dither, nq, quantizer=quantizer)
 
     # Write
     fp = open(filename, 'wb')
@@ -709,8 +741,14 @@ def readGif(filename, asNumpy=True):
     Read images from an animated GIF file.  Returns a list of numpy
     arrays, or, if asNumpy is false, a list if PIL images.
 
+    To avoid holding all the frames in a list, see iterGif and
+    readGifIntoArray.
+
     """
+    return list(iterGif(filename, asNumpy=asNumpy))
 
+
+def _openGif(filename):
     # Check PIL
     if PIL is None:
         raise RuntimeError("Need PIL to read animated gif files.")
@@ -724,33 +762,124 @@ def readGif(filename, asNumpy=True):
         raise IOError('File not found: '+str(filename))
 
     # Load file using PIL
-    pilIm = PIL.Image.open(filename)
-    pilIm.seek(0)
+    return PIL.Image.open(filename)
+
+
+def _convertGifFrame(pilIm, mode=None):
+    # Get image as numpy array
+    tmp = pilIm.convert(mode) # Make without palette
+    a = np.asarray(tmp)
+    if len(a.shape)==0:
+        raise MemoryError("Too little memory to convert PIL image to array")
+    return a
+
+
+def countGifFrames(filename):
+    """ countGifFrames(filename)
+
+    Count the frames in a GIF file, without decoding them.
+
+    """
+    pilIm = _openGif(filename)
+    try:
+        return getattr(pilIm, 'n_frames', 1)
+    finally:
+        pilIm.close()
+
+
+def iterGif(filename, start=0, stop=None, step=1, asNumpy=True, mode=None):
+    """ iterGif(filename, start=0, stop=None, step=1, asNumpy=True, mode=None)
+
+    Iterate through the frames of a GIF file, decoding them one at a
+    time.  Yields numpy arrays, or, if asNumpy is false, PIL images.
+
+    Parameters
+    ----------
+    filename : string
+        The GIF file.
+    start, stop, step : integers
+        Which frames to read, as in range(start, stop, step).  Seeking to
+        frame k still has to go through the frames before it (a GIF frame
+        is drawn on top of the previous ones), but they are not converted.
+    asNumpy : bool
+        Whether to yield numpy arrays (otherwise PIL images).
+    mode : string or None
+        The PIL mode to convert frames to (e.g. 'RGB').  If None, paletted
+        frames are converted to RGB (or RGBA if they have transparency).
 
-    # Read all images inside
-    images = []
+    """
+    pilIm = _openGif(filename)
     try:
-        while True:
-            # Get image as numpy array
-            tmp = pilIm.convert() # Make without palette
-            a = np.asarray(tmp)
-            if len(a.shape)==0:
-                raise MemoryError("Too little memory to convert PIL image to array")
-            # Store, and next
-            images.append(a)
-            pilIm.seek(pilIm.tell()+1)
-    except EOFError:
-        pass
-
-    # Convert to normal PIL images if needed
-    if not asNumpy:
-        images2 = images
-        images = []
-        for im in images2:
-            images.append( PIL.Image.fromarray(im) )
+        frame = start
+        while stop is None or frame < stop:
+            try:
+                pilIm.seek(frame)
+            except EOFError:
+                break
+            a = _convertGifFrame(pilIm, mode=mode)
+            yield a if asNumpy else PIL.Image.fromarray(a)
+            frame += step
+    finally:
+        pilIm.close()
 
-    # Done
-    return images
+
+def readGifFrame(filename, index, mode=None):
+    """ readGifFrame(filename, index, mode=None)
+
+    Read a single frame of a GIF file as a numpy array.
+
+    """
+    for a in iterGif(filename, start=index, stop=index+1, mode=mode):
+        return a
+    raise IndexError('GIF {} has no frame {}'.format(filename, index))
+
+
+def readGifIntoArray(filename, out=None, start=0, stop=None, mode=None):
+    """ readGifIntoArray(filename, out=None, start=0, stop=None, mode=None)
+
+    Read the frames of a GIF file into a single uint8 array of shape
+    (n_frames, height, width[, channels]), decoding one frame at a time
+    straight into it, rather than collecting a list of frames and stacking
+    them.
+
+    Parameters
+    ----------
+    filename : string
+        The GIF file.
+    out : array or None
+        A preallocated uint8 array to decode into.  It must have room for
+        all the frames.  If None, an array is allocated.
+    start, stop : integers
+        Which frames to read.
+    mode : string or None
+        The PIL mode to convert every frame to.  If None, all frames are
+        converted to the mode of the first frame (RGB, RGBA or L).
+
+    Returns the array (the filled part of out, if out was given).
+
+    """
+    pilIm = _openGif(filename)
+    try:
+        n_frames = getattr(pilIm, 'n_frames', 1)
+        stop = n_frames if stop is None else min(stop, n_frames)
+        n_frames = max(stop - start, 0)
+        if out is not None and len(out) < n_frames:
+            raise ValueError('The output array only has room for {} frames, but GIF {} has {}'.format(len(out), filename, n_frames))
+        for i in range(n_frames):
+            pilIm.seek(start+i)
+            if i==0 and mode is None:
+                a = _convertGifFrame(pilIm)
+                mode = 'RGBA' if a.ndim==3 and a.shape[2]==4 else 'RGB' if a.ndim==3 else 'L'
+            else:
+                a = _convertGifFrame(pilIm, mode=mode)
+            if out is None:
+                out = np.empty((n_frames, )+a.shape, dtype=np.uint8)
+            out[i] = a
+        if out is None:
+            out = np.zeros((0, pilIm.size[1], pilIm.size[0], 3), dtype=np.uint8)
+        return out[:n_frames]
+    finally:
+        pilIm.close()
 
 
 class NeuQuant:
@@ -843,7 +972,7 @@ class NeuQuant:
         self.CUTNETSIZE = self.NETSIZE - self.SPECIALS
         self.MAXNETPOS = self.NETSIZE - 1
 
-        self.INITRAD = self.NETSIZE/8 # For 256 colours, radius starts at 32
+        self.INITRAD = self.NETSIZE//8 # For 256 colours, radius starts at 32
         self.RADIUSBIASSHIFT = 6
         self.RADIUSBIAS = 1 << self.RADIUSBIASSHIFT
         self.INITBIASRADIUS = self.INITRAD * self.RADIUSBIAS
@@ -883,7 +1012,7 @@ class NeuQuant:
 
         # Initialize
         self.setconstants(samplefac, colors)
-        self.pixels = np.fromstring(image.tostring(), np.uint32)
+        self.pixels = np.frombuffer(image.tobytes() if hasattr(image, 'tobytes') else image.tostring(), np.uint32)
         self.setUpArrays()
 
         self.learn()
@@ -1009,10 +1138,10 @@ class NeuQuant:
 
     def learn(self):
         biasRadius = self.INITBIASRADIUS
-        alphadec = 30 + ((self.samplefac-1)/3)
+        alphadec = 30 + ((self.samplefac-1)//3)
         lengthcount = self.pixels.size
-        samplepixels = lengthcount / self.samplefac
-        delta = samplepixels / self.NCYCLES
+        samplepixels = lengthcount // self.samplefac
+        delta = samplepixels // self.NCYCLES
         alpha = self.INITALPHA
 
         i = 0;
@@ -1062,8 +1191,8 @@ class NeuQuant:
 
             i += 1
             if i%delta == 0:
-                alpha -= alpha / alphadec
-                biasRadius -= biasRadius / self.RADIUSDEC
+                alpha -= alpha // alphadec
+                biasRadius -= biasRadius // self.RADIUSDEC
                 rad = biasRadius * 2**self.RADIUSBIASSHIFT
                 if rad <= 1:
                     rad = 0
@@ -1183,6 +1312,151 @@ class NeuQuant:
 
 
 
+class KMeansQuantizer(object):
+    """ KMeansQuantizer(colors=256, n_iterations=10, refit_tolerance=1.5,
+                        seed=1234)
+
+    A vectorized (numpy) colour quantizer.  The palette is found by
+    k-means on a colour histogram of the image (with 5 bits per channel,
+    so there are at most 32768 points to cluster, whatever the image
+    size), and each histogram cell is mapped to its nearest palette
+    colour.  Frames with at most `colors` distinct colours are not
+    clustered: their exact colours are used as the palette, so they are
+    reproduced exactly.
+
+    The palette is kept between frames.  A new frame is quantized with
+    the current palette, unless that is more than refit_tolerance times
+    worse (in mean squared error) than it was on the frame it was fit to,
+    in which case the palette is refit, starting from the current one.
+    So an animation usually shares one global palette, which is both
+    faster and gives smaller files.
+
+    """
+
+    BITS = 5
+
+    def __init__(self, colors=256, n_iterations=10, refit_tolerance=1.5, seed=1234):
+        if np is None:
+            raise RuntimeError("Need Numpy for the KMeansQuantizer.")
+        self.colors = colors
+        self.n_iterations = n_iterations
+        self.refit_tolerance = refit_tolerance
+        self.rng = np.random.RandomState(seed)
+        self.palette = None
+        self.fit_error = None
+        self.n_fits = 0
+        self.pimage = None
+
+    def getHistogram(self, rgb):
+        """ Return the histogram cell of each pixel, and the pixel count and
+            mean colour of each occupied cell. """
+        shift = 8 - self.BITS
+        cells = ((rgb[..., 0] >> shift).astype(np.int32) << 2*self.BITS) | ((rgb[..., 1] >> shift).astype(np.int32) << self.BITS) | (rgb[..., 2] >> shift)
+        cells = cells.ravel()
+        n_cells = 1 << 3*self.BITS
+        counts = np.bincount(cells, minlength=n_cells)
+        occupied = np.flatnonzero(counts)
+        flat_rgb = rgb.reshape(-1, 3)
+        means = np.column_stack([np.bincount(cells, weights=flat_rgb[:, c], minlength=n_cells)[occupied] for c in range(3)]) / counts[occupied, None]
+        return cells, occupied, counts[occupied].astype(np.float64), means
+
+    def findNearest(self, points, palette):
+        """ Return the index of the nearest palette colour to each point, and
+            the squared distance to it. """
+        palette_norms = (palette**2).sum(axis=1)
+        indices = np.empty(len(points), dtype=np.int64)
+        distances = np.empty(len(points))
+        for start in range(0, len(points), 4096):
+            chunk = points[start:start+4096]
+            d = (chunk**2).sum(axis=1)[:, None] - 2*chunk.dot(palette.T) + palette_norms
+            indices[start:start+4096] = np.argmin(d, axis=1)
+            distances[start:start+4096] = np.maximum(d[np.arange(len(chunk)), indices[start:start+4096]], 0)
+        return indices, distances
+
+    def fit(self, points, weights):
+        """ Fit the palette to histogram points with the given weights. """
+        if len(points) <= self.colors:  # Few enough colours to keep them all
+            centres = points.copy()
+        else:
+            if self.palette is not None and len(self.palette) == self.colors:
+                centres = self.palette.copy()
+            else:
+                centres = points[self.rng.choice(len(points), size=self.colors, replace=False, p=weights/weights.sum())]
+            for _ in range(self.n_iterations):
+                assignments, _ = self.findNearest(points, centres)
+                totals = np.bincount(assignments, weights=weights, minlength=len(centres))
+                used = totals > 0
+                for c in range(3):
+                    centres[used, c] = np.bincount(assignments, weights=weights*points[:, c], minlength=len(centres))[used] / totals[used]
+        self.palette = centres
+        self.pimage = None
+        self.n_fits += 1
+        _, distances = self.findNearest(points, centres)
+        self.fit_error = (distances*weights).sum() / weights.sum()
+
+    def paletteImage(self):
+        """ Return a paletted PIL image with the palette (see NeuQuant.paletteImage). """
+        if self.pimage is None:
+            palette = np.zeros((256, 3), dtype=np.uint8)
+            palette[:len(self.palette)] = np.clip(np.round(self.palette), 0, 255)
+            self.pimage = Image.new("P", (1, 1), 0)
+            self.pimage.putpalette(palette.ravel().tolist())
+        return self.pimage
+
+    def quantize(self, image, dither=False):
+        """ quantize(image, dither=False)
+
+        Quantize a PIL image or an (height, width, 3) uint8 array, and return
+        a paletted PIL image.
+
+        """
+        if isinstance(image, np.ndarray):
+            rgb = image if image.ndim == 3 else np.repeat(image[:, :, None], 3, axis=2)
+            rgb = rgb[:, :, :3]
+        else:
+            rgb = np.asarray(image.convert("RGB"))
+        cells, occupied, weights, means = self.getHistogram(rgb)
+        if len(occupied) <= self.colors:  # (Otherwise there are certainly too many colours to keep them all)
+            packed = (rgb[..., 0].astype(np.int32) << 16) | (rgb[..., 1].astype(np.int32) << 8) | rgb[..., 2]
+            colours, inverse = np.unique(packed.ravel(), return_inverse=True)
+            if len(colours) <= self.colors:
+                return self.quantizeExactly(colours, inverse.reshape(rgb.shape[:2]))
+        if self.palette is None:
+            self.fit(means, weights)
+        indices, distances = self.findNearest(means, self.palette)
+        error = (distances*weights).sum() / weights.sum()
+        if error > self.refit_tolerance * self.fit_error and error > 1.:
+            self.fit(means, weights)
+            indices, _ = self.findNearest(means, self.palette)
+        if dither:  # Let PIL do the error diffusion, with our palette
+            return Image.fromarray(np.ascontiguousarray(rgb), 'RGB').quantize(palette=self.paletteImage())
+        lookup = np.zeros(1 << 3*self.BITS, dtype=np.uint8)
+        lookup[occupied] = indices
+        return self.makePalettedImage(lookup[cells].reshape(rgb.shape[:2]))
+
+    def quantizeExactly(self, colours, colour_indices):
+        """ Make a paletted image from the sorted distinct colours of a frame
+            (packed as 0xRRGGBB) and the index of each pixel's colour.  The
+            current palette is kept if it already has all the colours. """
+        if self.palette is not None:
+            palette = np.clip(np.round(self.palette), 0, 255).astype(np.int32)
+            packed_palette = (palette[:, 0] << 16) | (palette[:, 1] << 8) | palette[:, 2]
+            order = np.argsort(packed_palette, kind='mergesort')
+            positions = np.minimum(np.searchsorted(packed_palette[order], colours), len(order)-1)
+            if np.array_equal(packed_palette[order][positions], colours):
+                return self.makePalettedImage(order[positions][colour_indices])
+        self.palette = np.column_stack([(colours >> 16) & 255, (colours >> 8) & 255, colours & 255]).astype(np.float64)
+        self.pimage = None
+        self.n_fits += 1
+        self.fit_error = 0.
+        return self.makePalettedImage(colour_indices)
+
+    def makePalettedImage(self, palette_indices):
+        im = Image.fromarray(palette_indices.astype(np.uint8), 'P')
+        im.putpalette(self.paletteImage().getpalette())
+        return im
+
+
 if __name__ == '__main__':
     im = np.zeros((200,200), dtype=np.uint8)
     im[10:30,:] = 100
@@ -0,0 +1,44 @@
+import struct
+from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED, BadZipfile
+
+import numpy as np
+
+
+def load_npz_memmapped(path, mmap_mode='r'):
+    """
+    Load the arrays in an uncompressed .npz file (as written by np.savez) as memory-maps.  np.load ignores mmap_mode for
+    .npz files, but since the arrays are stored uncompressed, we can map them directly from the zip file.  Compressed
+    members are just loaded normally.
+
+    :param path: Path to the .npz file
+    :param mmap_mode: The mode of the memory-maps (see np.memmap): 'r' (read-only) or 'c' (copy-on-write)
+    :return: A dict<name -> array>
+    """
+    with ZipFile(path) as zf:
+        infos = zf.infolist()
+    arrays = {}
+    with open(path, 'rb') as f:
+        for info in infos:
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != ZIP_STORED:
+                with ZipFile(path) as zf:
+                    arrays[name] = np.lib.format.read_array(BytesIO(zf.read(info.filename)))
+                continue
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            if len(local_header) < 30 or local_header[:4] != b'PK\x03\x04':
+                raise BadZipfile('Bad local file header for {} in {}'.format(info.filename, path))
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            if dtype.hasobject:
+                raise ValueError('Cannot memory-map array {} in {}, because it contains objects'.format(name, path))
+            n_items = int(np.prod(shape)) if len(shape) > 0 else 1
+            if n_items == 0:
+                arrays[name] = np.empty(shape, dtype=dtype, order='F' if fortran_order else 'C')
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode=mmap_mode, shape=shape, order='F' if fortran_order else 'C', offset=f.tell())
+    return arrays
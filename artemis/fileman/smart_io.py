@@ -4,11 +4,17 @@ import re
 from contextlib import contextmanager
 from datetime import datetime
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
 import numpy as np
 
 from artemis.fileman.file_getter import get_file
-from artemis.fileman.images2gif import readGif
+from artemis.fileman.images2gif import readGifIntoArray
 from artemis.fileman.local_dir import get_artemis_data_path, make_file_dir
+from artemis.fileman.npy_io import load_npz_memmapped
 from artemis.general.image_ops import get_dark_edge_slice, resize_image
 
 
@@ -17,7 +23,10 @@ def smart_save(obj, relative_path, remove_file_after = False):
     Save an object locally.  How you save it depends on its extension.
     Extensions currently supported:
         pkl: Pickle file.
-        That is all.
+        npy: A numpy array
+        npz: A dict of numpy arrays (saved uncompressed, so that they can be memory-mapped when loaded)
+        jpg, jpeg, png, gif: An image array
+        pdf: A matplotlib figure
     :param obj: Object to save
     :param relative_path: Path to save it, relative to "Data" directory.  The following placeholders can be used:
         %T - ISO time
@@ -38,6 +47,11 @@ def smart_save(obj, relative_path, remove_file_after = False):
         if ext=='.pkl':
             with open(local_path, 'wb') as f:
                 pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        elif ext=='.npy':
+            np.save(local_path, obj)
+        elif ext=='.npz':
+            assert isinstance(obj, dict), 'You can only save a dict of arrays to a .npz file.  Got a {}'.format(type(obj))
+            np.savez(local_path, **obj)
         elif ext in _IMAGE_EXTENSIONS:
             _save_image(obj, local_path)
         elif ext=='.pdf':
@@ -51,7 +65,7 @@ def smart_save(obj, relative_path, remove_file_after = False):
     return local_path
 
 
-def smart_load(location, use_cache = False):
+def smart_load(location, use_cache = False, mmap_mode = None):
     """
     Load a file, with the method based on the extension.  See smart_save doc for the list of extensions.
     :param location: Identifies file location.
@@ -60,20 +74,31 @@ def smart_load(location, use_cache = False):
         Otherwise, it is assumed to be referenced relative to the data directory.
     :param use_cache: If True, and the location is a url, make a local cache of the file for future use (note: if the
         file at this url changes, the cached file will not).
+    :param mmap_mode: For .npy and .npz files, memory-map the arrays instead of reading them (see np.memmap - e.g. 'r'
+        for read-only), so that only the parts that you access are read from disk.  (Only uncompressed .npz members can
+        be mapped).  Ignored for urls that are not cached, which are read into memory.
     :return: An object, whose type depends on the extension.  Generally a numpy array for data or an object for pickles.
+        For .npz files, this is a dict-like object (a LazyNpzDict), which reads each array when it is first accessed.
     """
     assert isinstance(location, str), 'Location must be a string!  We got: %s' % (location, )
     with smart_file(location, use_cache=use_cache) as local_path:
         ext = os.path.splitext(local_path)[1].lower()
+        keep_file = use_cache or not is_url(location)  # Otherwise, the file is deleted after loading
         if ext=='.pkl':
             with open(local_path) as f:
                 obj = pickle.load(f)
-        elif ext=='.gif':
-            frames = readGif(local_path)
-            if frames[0].shape[2]==3 and all(f.shape[2] for f in frames[1:]):  # Wierd case:
-                obj = np.array([frames[0]]+[f[:, :, :3] for f in frames[1:]])
+        elif ext=='.npy':
+            obj = np.load(local_path, mmap_mode=mmap_mode if keep_file else None)
+        elif ext=='.npz':
+            if mmap_mode is not None and keep_file:
+                obj = load_npz_memmapped(local_path, mmap_mode=mmap_mode)
+            elif keep_file:
+                obj = LazyNpzDict(local_path)
             else:
-                obj = np.array(readGif(local_path))
+                with np.load(local_path) as f:
+                    obj = dict(f.items())
+        elif ext=='.gif':
+            obj = readGifIntoArray(local_path)  # (Frames after the first can come out as RGBA, so we convert all to the first frame's mode)
         elif ext in _IMAGE_EXTENSIONS:
             from PIL import Image
             obj = _load_image(local_path)
@@ -84,6 +109,43 @@ def smart_load(location, use_cache = False):
     return obj
 
 
+class LazyNpzDict(Mapping):
+    """
+    The arrays in a .npz file, as a read-only dict which reads each array when it is first accessed.  Unlike the NpzFile
+    returned by np.load, this only holds the file open while it reads from it, so it does not need to be closed (but
+    like an NpzFile, it can be used in a "with" block).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as f:
+            self._names = list(f.files)
+        self._arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            if name not in self._names:
+                raise KeyError('{} is not a file in {}'.format(name, self.path))
+            with np.load(self.path) as f:
+                self._arrays[name] = f[name]
+        return self._arrays[name]
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def smart_load_image(location, max_resolution = None, force_rgb=False, use_cache = False):
     """
     Load an image into a numpy array.
@@ -183,7 +245,7 @@ def is_url(path):
     return True if re.match(regex, path) else False
 
 
-def smart_load_video(location, use_cache = False, resize_mode='resize_and_crop', cut_edges=False, size = None, cut_edges_thresh=0):
+def smart_load_video(location, use_cache = False, resize_mode='resize_and_crop', cut_edges=False, size = None, cut_edges_thresh=0, frame_stride=1, out=None):
     """
     :param location:
     :param size: A 2-tuple of width-height, indicating the desired size of the ouput
@@ -191,41 +253,147 @@ def smart_load_video(location, use_cache = False, resize_mode='resize_and_crop',
         'squeeze', 'preserve_aspect', 'crop', 'scale_crop'.  See resize_image in image_ops.py for more info.
     :param cut_edges: True if you want to cut the dark edges from the video
     :param cut_edges_thresh: If cut_edges, this is the threshold at which you'd like to cut them.
+    :param frame_stride: Only keep every frame_stride'th frame.
+    :param out: Optionally, a (n_frames, height, width, 3) array to write the frames into (it must have room for all
+        of them).  Otherwise, an array is allocated from the frame count in the video's header, and the frames are
+        written into it as they are decoded.
     :return: A (n_frames, height, width, 3) numpy array
     """
 
     with smart_file(location, use_cache=use_cache) as local_path:
-        return _load_video(local_path, resize_mode=resize_mode, cut_edges=cut_edges, size=size, cut_edges_thresh=cut_edges_thresh)
+        return _load_video(local_path, resize_mode=resize_mode, cut_edges=cut_edges, size=size, cut_edges_thresh=cut_edges_thresh, frame_stride=frame_stride, out=out)
 
 
-def _load_video(full_path, size = None, resize_mode = 'resize_and_crop', cut_edges=False, cut_edges_thresh=0):
+def smart_iter_video(location, use_cache = False, resize_mode='resize_and_crop', cut_edges=False, size = None, cut_edges_thresh=0, frame_stride=1, batch_size=None):
     """
-    Lead a video into a numpy array
+    Iterate through the frames of a video, decoding them one at a time, so that the video never has to fit in memory.
+    See smart_load_video for the arguments.
 
-    :param full_path: Full path to the video
-    :param size: A 2-tuple of width-height, indicating the desired size of the ouput
-    :param resize_mode: The mode with which to get the video to the desired size.  Can be:
-        'squeeze', 'preserve_aspect', 'crop', 'scale_crop'.  See resize_image in image_ops.py for more info.
-    :param cut_edges: True if you want to cut the dark edges from the video
-    :param cut_edges_thresh: If cut_edges, this is the threshold at which you'd like to cut them.
-    :return: A (n_frames, height, width, 3) numpy array
+    :param batch_size: If not None, yield batches of this many frames, as (batch_size, height, width, 3) arrays (the
+        last batch may be smaller).
+    :return: A generator of (height, width, 3) frames (or batches of frames)
     """
+    with smart_file(location, use_cache=use_cache) as local_path:
+        video = _open_video(local_path)
+        try:
+            frames = _process_video_frames(video.iter_frames(), size=size, resize_mode=resize_mode, cut_edges=cut_edges, cut_edges_thresh=cut_edges_thresh, frame_stride=frame_stride)
+            for item in (frames if batch_size is None else _iter_frame_batches(frames, batch_size)):
+                yield item
+        finally:
+            _close_video(video)
+
+
+def _open_video(full_path):
     try:
         from moviepy.video.io.VideoFileClip import VideoFileClip
     except ImportError:
         raise ImportError("You need to install moviepy to read videos.  In the virtualenv, go `pip install moviepy`")
     assert os.path.exists(full_path)
-    video = VideoFileClip(full_path)
-    images = []
+    return VideoFileClip(full_path)
+
+
+def _close_video(video):
+    if hasattr(video, 'close'):  # (Older versions of moviepy can't be closed)
+        video.close()
+
+
+def _get_n_video_frames(video):
+    # The count from the header, which can be off by a frame or two.
+    reader = getattr(video, 'reader', None)
+    return reader.nframes if hasattr(reader, 'nframes') else int(video.duration*video.fps)
+
+
+def _process_video_frames(frames, size = None, resize_mode = 'resize_and_crop', cut_edges=False, cut_edges_thresh=0, frame_stride=1):
+    """
+    Lazily stride, crop and resize a sequence of video frames.  See smart_load_video for the arguments.
+    :param frames: An iterable of (height, width, 3) frames
+    :return: A generator of processed frames
+    """
     edge_crops = None
-    for frame in video.iter_frames():
+    for i, frame in enumerate(frames):
+        if i % frame_stride != 0:
+            continue
         if cut_edges:
             if edge_crops is None:
                 edge_crops = get_dark_edge_slice(frame, cut_edges_thresh=cut_edges_thresh)
-            else:
-                frame = frame[edge_crops[0], edge_crops[1]]
+            frame = frame[edge_crops[0], edge_crops[1]]
         if size is not None:
             width, height = size
             frame = resize_image(frame, width=width, height=height, mode=resize_mode)
-        images.append(frame)
-    return images
+        yield frame
+
+
+def _iter_frame_batches(frames, batch_size):
+    batch = None
+    i = 0
+    for frame in frames:
+        if batch is None:
+            batch = np.empty((batch_size, )+frame.shape, dtype=frame.dtype)
+        batch[i] = frame
+        i += 1
+        if i == batch_size:
+            yield batch
+            batch, i = None, 0
+    if i > 0:
+        yield batch[:i]
+
+
+def _collect_frames(frames, n_frames=None, out=None):
+    """
+    Put a sequence of frames into an array, writing each frame straight into the array (rather than building a list
+    and stacking it) when we know how many frames there are.
+
+    :param frames: An iterable of equally-shaped frames
+    :param n_frames: The expected number of frames (if the sequence turns out to be longer or shorter, we still return
+        all the frames).
+    :param out: Optionally, an array to write the frames into.  It must have room for all the frames.
+    :return: An array of frames.  If out was given, this is out (or the filled part of it).
+    """
+    frames = iter(frames)
+    if out is None:
+        first_frame = next(frames, None)
+        if first_frame is None:
+            return np.zeros((0, 0, 0, 3), dtype=np.uint8)
+        if n_frames is None:
+            return np.array([first_frame]+list(frames))
+        out = np.empty((max(n_frames, 1), )+first_frame.shape, dtype=first_frame.dtype)
+        out[0] = first_frame
+        n_written = 1
+        extra_frames = []
+    else:
+        n_written = 0
+        extra_frames = None
+    for frame in frames:
+        if n_written < len(out):
+            out[n_written] = frame
+            n_written += 1
+        elif extra_frames is not None:
+            extra_frames.append(frame)
+        else:
+            raise ValueError('The output array only has room for {} frames, but there are more'.format(len(out)))
+    if extra_frames:
+        return np.concatenate([out, extra_frames])
+    return out[:n_written]
+
+
+def _load_video(full_path, size = None, resize_mode = 'resize_and_crop', cut_edges=False, cut_edges_thresh=0, frame_stride=1, out=None):
+    """
+    Lead a video into a numpy array
+
+    :param full_path: Full path to the video
+    :param size: A 2-tuple of width-height, indicating the desired size of the ouput
+    :param resize_mode: The mode with which to get the video to the desired size.  Can be:
+        'squeeze', 'preserve_aspect', 'crop', 'scale_crop'.  See resize_image in image_ops.py for more info.
+    :param cut_edges: True if you want to cut the dark edges from the video
+    :param cut_edges_thresh: If cut_edges, this is the threshold at which you'd like to cut them.
+    :param frame_stride: Only keep every frame_stride'th frame.
+    :param out: Optionally, an array to write the frames into
+    :return: A (n_frames, height, width, 3) numpy array
+    """
+    video = _open_video(full_path)
+    try:
+        frames = _process_video_frames(video.iter_frames(), size=size, resize_mode=resize_mode, cut_edges=cut_edges, cut_edges_thresh=cut_edges_thresh, frame_stride=frame_stride)
+        n_frames = (_get_n_video_frames(video) + frame_stride - 1) // frame_stride
+        return _collect_frames(frames, n_frames=n_frames, out=out)
+    finally:
+        _close_video(video)
@@ -1,7 +1,9 @@
 from six.moves.configparser import NoSectionError, NoOptionError
 from pytest import raises
+from artemis.fileman import config_files
 from artemis.fileman.config_files import get_config_path, get_config_value, set_non_persistent_config_value
 import os
+import time
 __author__ = 'peter'
 
 
@@ -56,8 +58,48 @@ def test_get_config_value():
     value = get_config_value(config_filename='.testconfigrc', section='schmapts', option='setting2')
     assert value == 'bob'
 
+    # Writing a default does not write the non-persistent values to the file
+    value = get_config_value(config_filename='.testconfigrc', section='opts', option='setting4', default_generator=lambda: 'new', write_default=True)
+    assert value == 'new'
+    assert get_config_value(config_filename='.testconfigrc', section='opts', option='setting4', use_cashed_config=False) == 'new'
+    assert get_config_value(config_filename='.testconfigrc', section='opts', option='setting2', use_cashed_config=False) == 'blah'
+    with raises(NoSectionError):
+        _ = get_config_value(config_filename='.testconfigrc', section='schmapts', option='setting2', use_cashed_config=False)
+    assert get_config_value(config_filename='.testconfigrc', section='opts', option='setting2') == 'bob'
+    assert get_config_value(config_filename='.testconfigrc', section='opts', option='setting4') == 'new'
+
     os.remove(config_path)
 
 
+def test_config_cache_sees_edits():
+
+    config_path = get_config_path('.testconfigcacherc')
+    with open(config_path, 'w') as f:
+        f.write('[opts]\nsetting1 = 1\nsetting2 = [1, 2]\n')
+    old_ttl = config_files.CONFIG_CACHE_TTL
+    try:
+        config_files.CONFIG_CACHE_TTL = 1000
+        assert get_config_value('.testconfigcacherc', section='opts', option='setting1', read_method=int) == 1
+        assert get_config_value('.testconfigcacherc', section='opts', option='setting2', read_method='eval') == [1, 2]
+        get_config_value('.testconfigcacherc', section='opts', option='setting2', read_method='eval').append(99)
+        assert get_config_value('.testconfigcacherc', section='opts', option='setting2', read_method='eval') == [1, 2]  # Cached values can not be modified by callers
+        set_non_persistent_config_value('.testconfigcacherc', section='other', option='setting3', value='x')
+
+        with open(config_path, 'w') as f:
+            f.write('[opts]\nsetting1 = 22\n')
+        os.utime(config_path, (time.time()+10, time.time()+10))  # (In case the file system's clock is coarse)
+        assert get_config_value('.testconfigcacherc', section='opts', option='setting1', read_method=int) == 1  # Within the TTL, we trust the cache
+
+        config_files.CONFIG_CACHE_TTL = 0
+        assert get_config_value('.testconfigcacherc', section='opts', option='setting1', read_method=int) == 22
+        with raises(NoOptionError):
+            get_config_value('.testconfigcacherc', section='opts', option='setting2')
+        assert get_config_value('.testconfigcacherc', section='other', option='setting3') == 'x'  # Non-persistent values survive re-reading
+    finally:
+        config_files.CONFIG_CACHE_TTL = old_ttl
+        os.remove(config_path)
+
+
 if __name__ == '__main__':
     test_get_config_value()
+    test_config_cache_sees_edits()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from artemis.fileman import directory_crawl
+from artemis.fileman.directory_crawl import crawl_directory, iter_directory, DirectoryCrawler
+
+
+def _make_test_tree():
+    root = tempfile.mkdtemp()
+    for i in range(3):
+        for j in range(4):
+            os.makedirs(os.path.join(root, 'dir{}'.format(i), 'sub{}'.format(j)))
+            with open(os.path.join(root, 'dir{}'.format(i), 'sub{}'.format(j), 'file.txt'), 'w') as f:
+                f.write('aaa')
+    os.makedirs(os.path.join(root, '.hidden'))
+    with open(os.path.join(root, '.hidden', 'secret.txt'), 'w') as f:
+        f.write('bbb')
+    with open(os.path.join(root, 'top.txt'), 'w') as f:
+        f.write('ccc')
+    return root
+
+
+def test_iter_directory():
+
+    root = _make_test_tree()
+    try:
+        paths = [entry.path for entry in iter_directory(root)]
+        assert len(paths) == 1 + 3 + 3*4 + 3*4
+        assert not any('.hidden' in p for p in paths)
+        assert all(paths.index(os.path.dirname(p)) < paths.index(p) for p in paths if os.path.dirname(p) != root)  # Parents come first
+        assert sorted(entry.path for entry in iter_directory(root, n_threads=4)) == sorted(paths)
+        assert len(list(iter_directory(root, ignore_hidden=False, n_threads=4))) == len(paths) + 2
+        assert sum(entry.stat().st_size for entry in iter_directory(root) if entry.is_file()) == 3*13
+
+        tree = crawl_directory(root)
+        assert tree['dir1']['sub2']['file.txt'] == os.path.join(root, 'dir1', 'sub2', 'file.txt')
+        assert set(tree.keys()) == {'dir0', 'dir1', 'dir2', 'top.txt'}
+        assert crawl_directory(root+os.sep, n_threads=4) == crawl_directory(root+os.sep)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_iter_directory_raises_errors_from_threads():
+
+    def scan_directory(directory, ignore_hidden):
+        if os.path.basename(directory) == 'sub2':
+            raise KeyboardInterrupt()
+        return old_scan_directory(directory, ignore_hidden=ignore_hidden)
+
+    root = _make_test_tree()
+    old_scan_directory = directory_crawl.scan_directory
+    directory_crawl.scan_directory = scan_directory
+    try:
+        for n_threads in (None, 4):
+            with pytest.raises(KeyboardInterrupt):  # (Rather than waiting forever for the worker that failed)
+                list(iter_directory(root, n_threads=n_threads))
+    finally:
+        directory_crawl.scan_directory = old_scan_directory
+        shutil.rmtree(root)
+
+
+def test_directory_crawler():
+
+    root = _make_test_tree()
+    try:
+        now = time.time()
+        for i, name in enumerate(['dir2', 'top.txt', 'dir0', 'dir1']):
+            os.utime(os.path.join(root, name), (now-100+i, now-100+i))
+        dc = DirectoryCrawler(root)
+        assert dc.listdir(sortby='mtime') == ['dir2'+os.sep, 'top.txt', 'dir0'+os.sep, 'dir1'+os.sep]
+        assert dc.listdir(refresh=True, sortby='-name') == ['top.txt', 'dir2'+os.sep, 'dir1'+os.sep, 'dir0'+os.sep]
+        assert dc['dir1'].listdir(sortby='name', end_dirs_with_slash=False) == ['sub0', 'sub1', 'sub2', 'sub3']
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    test_iter_directory()
+    test_iter_directory_raises_errors_from_threads()
+    test_directory_crawler()
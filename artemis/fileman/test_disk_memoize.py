@@ -1,6 +1,12 @@
 import time
+import multiprocessing
+import os
+import tempfile
+
 from artemis.fileman.disk_memoize import memoize_to_disk, clear_memo_files_for_function, DisableMemos, memoize_to_disk_and_cache, \
-    memoize_to_disk_test, memoize_to_disk_and_cache_test
+    memoize_to_disk_test, memoize_to_disk_and_cache_test, get_memo_files_for_function, get_memo_stats, \
+    flush_memo_stats, get_memo_stats_table, flush_memo_writes, get_memo_dir, MEMO_COMPUTE_TIMES_FILE_NAME
+from artemis.fileman import disk_memoize
 from artemis.general.test_mode import set_test_mode
 import numpy as np
 from pytest import raises
@@ -151,6 +157,224 @@ def test_catch_kwarg_error():
     assert t3 == t1
 
 
+def test_bounded_local_cache():
+
+    @memoize_to_disk_test
+    def make_array(n):
+        return np.random.randn(n)
+
+    bounded_make_array = memoize_to_disk(make_array.wrapped_fcn, disable_on_tests=False, local_cache_max_bytes=2000)
+    clear_memo_files_for_function(make_array)
+
+    a1 = bounded_make_array(100)  # 800 bytes
+    assert bounded_make_array(100) is a1
+    b1 = bounded_make_array(200)  # 1600 bytes, so a is evicted from memory...
+    assert bounded_make_array(200) is b1
+    a2 = bounded_make_array(100)  # ... but is still on disk
+    assert a2 is not a1 and np.array_equal(a1, a2)
+    assert bounded_make_array.local_cache.get_stats()['evictions'] == 2
+    assert len(bounded_make_array.local_cache) == 1 and bounded_make_array.local_cache.n_bytes == 800
+
+
+def make_range(n):
+    return np.arange(n)
+
+
+def make_dataset(n, name):
+    return {'x': np.arange(n, dtype=float), 'y': [np.ones((n, 2)), name], 'n': n}
+
+
+def test_numpy_storage():
+
+    memoized_make_dataset = memoize_to_disk(make_dataset, disable_on_tests=False, storage='numpy')
+    memoized_arange = memoize_to_disk(make_range, disable_on_tests=False, storage='numpy')
+    clear_memo_files_for_function(make_dataset)
+
+    d1 = memoized_make_dataset(5, name='aaa')
+    d2 = memoized_make_dataset(5, name='aaa')
+    assert isinstance(d2['x'], np.memmap) and isinstance(d2['y'][0], np.memmap)
+    assert np.array_equal(d1['x'], d2['x']) and np.array_equal(d1['y'][0], d2['y'][0])
+    assert d2['y'][1] == 'aaa' and d2['n'] == 5
+    assert [os.path.splitext(f)[1] for f in get_memo_files_for_function(make_dataset)] == ['.npz']
+
+    # Results without arrays are still pickled, and memos are found whatever storage the reader uses
+    assert memoized_make_dataset(0, name='bbb')['x'].shape == (0, )
+    assert memoize_to_disk(make_dataset, disable_on_tests=False)(5, name='aaa')['y'][1] == 'aaa'
+
+    clear_memo_files_for_function(memoized_arange)
+    memoized_arange(4)
+    arr = memoized_arange(4)
+    assert isinstance(arr, np.memmap) and np.array_equal(arr, [0, 1, 2, 3])
+
+
+@memoize_to_disk_test
+def compute_slow_thing_and_count(a, count_file_path):
+    with open(count_file_path, 'a') as f:
+        f.write('x')
+    time.sleep(0.2)
+    return np.ones(100000)*a
+
+
+def _call_compute_slow_thing_and_count(count_file_path):
+    return float(compute_slow_thing_and_count(3, count_file_path=count_file_path).sum())
+
+
+def test_single_flight_across_processes():
+
+    clear_memo_files_for_function(compute_slow_thing_and_count)
+    _, count_file_path = tempfile.mkstemp()
+    pool = multiprocessing.Pool(8)
+    try:
+        results = pool.map(_call_compute_slow_thing_and_count, [count_file_path]*8)
+    finally:
+        pool.close()
+        pool.join()
+    assert results == [300000.]*8
+    with open(count_file_path) as f:
+        assert f.read() == 'x'  # Only one process computed the result
+    os.remove(count_file_path)
+    assert len(get_memo_files_for_function(compute_slow_thing_and_count)) == 1
+    assert not any(path.endswith('.tmp') for path in get_memo_files_for_function(compute_slow_thing_and_count, include_other_files=True))  # No leftover temp files
+
+
+def test_memo_files_get_default_permissions():
+
+    clear_memo_files_for_function(make_range)
+    umask = os.umask(0)
+    os.umask(umask)
+    memoize_to_disk(make_range, disable_on_tests=False)(3)
+    memo_path, = get_memo_files_for_function(make_range)
+    assert os.stat(memo_path).st_mode & 0o777 == 0o666 & ~umask
+
+
+def make_sized_string(n_bytes, name):
+    time.sleep(0.01)
+    return name * n_bytes
+
+
+def test_memo_size_limit_and_stats():
+
+    limited_make_string = memoize_to_disk(make_sized_string, disable_on_tests=False, max_disk_bytes=2500)
+    clear_memo_files_for_function(make_sized_string)
+    flush_memo_stats()
+
+    limited_make_string(1000, name='a')
+    limited_make_string(1000, name='b')
+    limited_make_string(1000, name='a')  # Hit, so now 'b' is the least recently used
+    limited_make_string(1000, name='c')  # Evicts 'b'
+    assert len(get_memo_files_for_function(make_sized_string)) == 2
+    assert len([f for f in get_memo_files_for_function(make_sized_string, include_other_files=True) if f.endswith('.lock')]) == 2  # The lock of 'b' went with it
+    limited_make_string(1000, name='a')  # Still there
+    limited_make_string(1000, name='b')  # Was evicted, so recomputed (and evicts 'c')
+    with open(os.path.join(get_memo_dir(make_sized_string), MEMO_COMPUTE_TIMES_FILE_NAME)) as f:
+        assert len(f.readlines()) == 2  # Compute times of evicted memos are dropped
+
+    flush_memo_stats()
+    limited_make_string(1000, name='b')  # Stats that are not yet flushed are also counted
+    stats = get_memo_stats()['make_sized_string']
+    assert (stats['n_memos'], stats['hits'], stats['misses'], stats['evictions']) == (2, 3, 4, 2)
+    assert stats['bytes'] > 2000
+    assert stats['time_saved'] >= 0.03 and stats['compute_time'] >= 0.04
+    assert 'make_sized_string' in get_memo_stats_table()
+
+
+def test_memo_size_limit_does_not_scan_on_every_write():
+
+    limited_make_string = memoize_to_disk(make_sized_string, disable_on_tests=False, max_disk_bytes=5500)
+    clear_memo_files_for_function(make_sized_string)
+    original_evict_memos = disk_memoize._evict_memos
+    n_scans = [0]
+
+    def counting_evict_memos(*args, **kwargs):
+        n_scans[0] += 1
+        return original_evict_memos(*args, **kwargs)
+
+    disk_memoize._evict_memos = counting_evict_memos
+    try:
+        for name in 'abcd':
+            limited_make_string(1000, name=name)
+        assert n_scans[0] == 1  # Only the first write scans, after that we keep a running total
+        for name in 'efgh':
+            limited_make_string(1000, name=name)
+        assert n_scans[0] == 3  # Writing 'f' and then 'h' would exceed the limit
+    finally:
+        disk_memoize._evict_memos = original_evict_memos
+    assert len(get_memo_files_for_function(make_sized_string)) == 4
+
+
+def make_sparse_array(n):
+    arr = np.zeros(n)
+    arr[::100] = 1
+    return arr
+
+
+def test_compressed_memos():
+
+    for compression in ('zlib', 'lzma', 'fast'):
+        for storage in ('pickle', 'numpy'):
+            memoized_make_sparse_array = memoize_to_disk(make_sparse_array, disable_on_tests=False, compression=compression, storage=storage)
+            memoized_make_dataset = memoize_to_disk(make_dataset, disable_on_tests=False, compression=compression, storage=storage)
+            clear_memo_files_for_function(make_sparse_array)
+            clear_memo_files_for_function(make_dataset)
+            arr = memoized_make_sparse_array(10000)
+            memo_files = get_memo_files_for_function(make_sparse_array)
+            assert len(memo_files) == 1 and os.path.getsize(memo_files[0]) < arr.nbytes/10
+            assert np.array_equal(memoized_make_sparse_array(10000), arr)
+            memoized_make_dataset(4, name='aaa')
+            dataset = memoized_make_dataset(4, name='aaa')
+            assert np.array_equal(dataset['x'], np.arange(4)) and dataset['y'][1] == 'aaa'
+
+    # Memos are found whatever the compression setting of the reader
+    assert np.array_equal(memoize_to_disk(make_sparse_array, disable_on_tests=False)(10000), arr)
+
+
+def test_corrupt_compressed_memos_are_recomputed():
+
+    for compression in ('zlib', 'lzma', 'fast'):
+        memoized_make_sparse_array = memoize_to_disk(make_sparse_array, disable_on_tests=False, compression=compression)
+        clear_memo_files_for_function(make_sparse_array)
+        arr = memoized_make_sparse_array(10000)
+        memo_path, = get_memo_files_for_function(make_sparse_array)
+        with open(memo_path, 'r+b') as f:
+            f.seek(os.path.getsize(memo_path)//2)
+            f.write(b'\xff\x00')
+        assert np.array_equal(memoized_make_sparse_array(10000), arr)
+
+
+class SlowToPickle(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __getstate__(self):
+        time.sleep(0.5)
+        return self.__dict__
+
+
+_slow_computations = []
+
+
+def make_slow_to_pickle(value):
+    _slow_computations.append(value)
+    return SlowToPickle(value)
+
+
+def test_write_behind():
+
+    memoized_make_slow_to_pickle = memoize_to_disk(make_slow_to_pickle, disable_on_tests=False, write_behind=True)
+    clear_memo_files_for_function(make_slow_to_pickle)
+    del _slow_computations[:]
+    start = time.time()
+    obj = memoized_make_slow_to_pickle(3)
+    assert time.time() - start < 0.4  # We did not wait for it to be pickled
+    assert memoized_make_slow_to_pickle(3) is obj  # Served from the pending write, not recomputed
+    assert _slow_computations == [3]
+    flush_memo_writes()
+    assert len(get_memo_files_for_function(make_slow_to_pickle)) == 1
+    assert memoized_make_slow_to_pickle(3).value == 3
+    assert _slow_computations == [3]
+
+
 if __name__ == '__main__':
     set_test_mode(True)
     test_unnoticed_wrong_arg_bug_is_dead()
@@ -160,3 +384,12 @@ if __name__ == '__main__':
     test_memoize_to_disk_and_cache()
     test_memoize_to_disk()
     test_complex_args()
+    test_bounded_local_cache()
+    test_numpy_storage()
+    test_single_flight_across_processes()
+    test_memo_files_get_default_permissions()
+    test_memo_size_limit_and_stats()
+    test_memo_size_limit_does_not_scan_on_every_write()
+    test_compressed_memos()
+    test_corrupt_compressed_memos_are_recomputed()
+    test_write_behind()
@@ -1,7 +1,20 @@
-from artemis.fileman.file_getter import get_file_in_archive, hold_file_root, get_file, get_file_path
+from artemis.fileman.file_getter import get_file_in_archive, hold_file_root, get_file, get_file_path, get_archive, unzip_gz, \
+    DownloadManager, load_download_manifest, get_cached_download_path, verify_download_cache, get_download_cache_dir, \
+    download_to_cache, _ChunkStream
 from artemis.fileman.local_dir import get_artemis_data_path
+import gzip
+import hashlib
+import io
 import os
+import tarfile
+import zipfile
+import threading
+import time
+from contextlib import contextmanager
+import pytest
 from six.moves import xrange
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
 
 
 __author__ = 'peter'
@@ -87,9 +100,297 @@ def test_temp_file():
             assert f.read() == '1,2,3'
 
 
+class _LocalFileHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files in self.server.files (a dict<path -> bytes>), with support for Range requests.  If
+    self.server.cut_after is set, the connection is dropped after sending that many bytes of the body (once).  Each
+    response is delayed by self.server.latency seconds, and the first self.server.failures[path] requests for a path
+    fail with "503 Service Unavailable".
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers.get('Range')))
+            self.server.n_active += 1
+            self.server.max_active = max(self.server.max_active, self.server.n_active)
+            fail = self.server.failures.get(self.path, 0) > 0
+            if fail:
+                self.server.failures[self.path] -= 1
+        try:
+            time.sleep(self.server.latency)
+            if fail:
+                self.send_error(503)
+            else:
+                self._send_file()
+        finally:
+            with self.server.lock:
+                self.server.n_active -= 1
+
+    def _send_file(self):
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data = self.server.files[self.path]
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            start = int(range_header.split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)-start))
+        self.end_headers()
+        body = data[start:]
+        if self.server.cut_after is not None:
+            body = body[:self.server.cut_after]
+            self.server.cut_after = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@contextmanager
+def serve_files_locally(files, latency=0.):
+    """
+    Serve files over HTTP on localhost.
+    :param files: A dict<path -> bytes>
+    :param latency: Delay every response by this many seconds
+    :return: A context manager yielding the server.  Its URL is server.url, server.requests records the
+        (path, range_header) of each request, and server.max_active is the max number of simultaneous requests.
+    """
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _LocalFileHandler)
+    server.files = files
+    server.requests = []
+    server.cut_after = None
+    server.latency = latency
+    server.failures = {}
+    server.lock = threading.Lock()
+    server.n_active = server.max_active = 0
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _list_partial_downloads():
+    # (Lock files are left behind in the downloads directory, so we ignore them)
+    return [f for f in os.listdir(os.path.join(get_download_cache_dir(), 'downloads')) if not f.endswith('.lock')]
+
+
+def test_resumable_download():
+
+    data = os.urandom(3*2**20 + 12345)
+    with hold_file_root(get_artemis_data_path('file_getter_tests'), delete_after=True, delete_before=True), serve_files_locally({'/data.bin': data}) as server:
+
+        server.cut_after = 2**20 + 100
+        with pytest.raises(IOError):
+            get_file(relative_name='data.bin', url=server.url+'/data.bin')
+        assert not os.path.exists(get_file_path('data.bin'))
+        part_files = [f for f in os.listdir(os.path.join(get_download_cache_dir(), 'downloads')) if f.endswith('.part')]
+        assert len(part_files) == 1 and os.path.getsize(os.path.join(get_download_cache_dir(), 'downloads', part_files[0])) == 2**20 + 100
+
+        path = get_file(relative_name='data.bin', url=server.url+'/data.bin', checksum='sha256:'+hashlib.sha256(data).hexdigest())
+        assert server.requests[-1] == ('/data.bin', 'bytes={}-'.format(2**20+100))
+        with open(path, 'rb') as f:
+            assert f.read() == data
+        assert _list_partial_downloads() == []
+
+        with pytest.raises(IOError):
+            get_file(relative_name='data2.bin', url=server.url+'/data.bin', checksum=hashlib.md5(b'something else').hexdigest(), use_cache=False)
+        assert not os.path.exists(get_file_path('data2.bin')) and _list_partial_downloads() == []
+
+
+def _make_archive(archive_type, files):
+    buffer = io.BytesIO()
+    if archive_type == '.tar.gz':
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    else:
+        with zipfile.ZipFile(buffer, 'w') as z:
+            for name, data in files:
+                z.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_streaming_archive_extraction():
+
+    big_data = os.urandom(5*2**20)
+    files = [('testzip/big.bin', big_data), ('testzip/test_file.txt', b'blah blah blah'), ('testzip/other.txt', b'other')]
+    served_files = {'/archive.tar.gz': _make_archive('.tar.gz', files), '/download?id=2': _make_archive('.zip', files), '/data.gz': gzip.compress(big_data) if hasattr(gzip, 'compress') else None}
+    with hold_file_root(get_artemis_data_path('file_getter_tests'), delete_after=True, delete_before=True), serve_files_locally(served_files) as server:
+
+        for i, url in enumerate([server.url+'/archive.tar.gz', server.url+'/download?id=2']):
+            relative_path = 'tests/archive{}'.format(i)
+            # Extract a single file
+            path = get_file_in_archive(url=url, subpath='testzip/test_file.txt', relative_path=relative_path)
+            with open(path) as f:
+                assert f.read() == 'blah blah blah'
+            assert not os.path.exists(get_file_path(os.path.join(relative_path, 'testzip', 'other.txt')))
+            n_requests = len(server.requests)
+
+            # Then the whole archive, from the downloaded copy
+            folder = get_archive(url=url, relative_path=relative_path)
+            assert len(server.requests) == n_requests
+            with open(os.path.join(folder, 'testzip', 'big.bin'), 'rb') as f:
+                assert f.read() == big_data
+            with open(os.path.join(folder, 'testzip', 'other.txt')) as f:
+                assert f.read() == 'other'
+
+            # Extract everything while downloading
+            folder = get_archive(url=url, relative_path=relative_path, use_cache=False)
+            assert len(server.requests) == n_requests + 1
+            assert sorted(os.listdir(os.path.join(folder, 'testzip'))) == ['big.bin', 'other.txt', 'test_file.txt']
+
+        if served_files['/data.gz'] is not None:
+            path = get_file(relative_name='data.bin', url=server.url+'/data.gz', data_transformation=unzip_gz)
+            with open(path, 'rb') as f:
+                assert f.read() == big_data
+
+
+def test_chunk_stream_ends_on_interrupt():
+
+    # If the download is interrupted (e.g. by ctrl-C), the extracting thread must stop reading and draining the stream
+    stream = _ChunkStream(max_chunks=2)
+    errors = []
+
+    def extract():
+        try:
+            while stream.read(3):
+                pass
+        except Exception as err:
+            errors.append(err)
+        finally:
+            stream.drain()
+
+    extraction_thread = threading.Thread(target=extract)
+    extraction_thread.daemon = True
+    extraction_thread.start()
+    stream.put(b'abcdef')
+    stream.end(error=KeyboardInterrupt())
+    extraction_thread.join(timeout=5)
+    assert not extraction_thread.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0], IOError)
+
+
+def test_download_manager():
+
+    files = {'/file-{}.txt'.format(i): 'contents of file {}'.format(i).encode('utf-8') for i in range(20)}
+    with hold_file_root(get_artemis_data_path('file_getter_tests'), delete_after=True, delete_before=True), serve_files_locally(files, latency=0.2) as server:
+        server.failures['/file-3.txt'] = 2
+        urls = [server.url+'/file-{}.txt'.format(i) for i in range(20)]
+        start = time.time()
+        with DownloadManager(n_threads=8, max_per_host=4, retry_delay=0.01) as manager:
+            paths = manager.get_files(urls+urls[:5], relative_names=['downloads/{}.txt'.format(i) for i in list(range(20))+list(range(5))])
+        assert time.time() - start < 20*0.2/2  # Serially, it would take at least 20*0.2s
+        assert server.max_active == 4
+        assert len(server.requests) == 20+2  # Duplicates were downloaded once, and file-3 was retried twice
+        for i, path in enumerate(paths):
+            with open(path) as f:
+                assert f.read() == 'contents of file {}'.format(i % 20)
+
+        # A url requested under several names is only fetched once
+        n_requests = len(server.requests)
+        with DownloadManager(retry_delay=0.01, use_cache=False) as manager:
+            paths = manager.get_files([urls[7]]*4, relative_names=['copies/{}.txt'.format(i) for i in range(4)])
+        assert server.requests[n_requests:] == [('/file-7.txt', None)]
+        assert len(set(paths)) == 4
+        for path in paths:
+            with open(path) as f:
+                assert f.read() == 'contents of file 7'
+
+        # Files that are not found are not retried (and files that are already in the download cache are not downloaded)
+        n_requests = len(server.requests)
+        with DownloadManager(retry_delay=0.01) as manager:
+            assert manager.get_files([server.url+'/missing.txt', urls[0]], raise_errors=False) == [None, get_file_path(url=urls[0])]
+        assert server.requests[n_requests:] == [('/missing.txt', None)]
+
+
+def test_download_cache():
+
+    files = {'/a/data.txt': b'some data', '/mirror/data.txt': b'some data', '/b/other.txt': b'other data'}
+    with hold_file_root(get_artemis_data_path('file_getter_tests'), delete_after=True, delete_before=True), serve_files_locally(files) as server:
+
+        path_1 = get_file(url=server.url+'/a/data.txt')
+        path_2 = get_file(relative_name='data.txt', url=server.url+'/mirror/data.txt')
+        path_3 = get_file(url=server.url+'/b/other.txt')
+        manifest = load_download_manifest()
+        content_hash = hashlib.sha256(b'some data').hexdigest()
+        assert manifest[server.url+'/a/data.txt'][:2] == manifest[server.url+'/mirror/data.txt'][:2] == (content_hash, 9)
+        assert len(os.listdir(os.path.join(get_download_cache_dir(), 'objects', content_hash[:2]))) == 1  # Stored once
+        assert os.path.samefile(path_1, get_cached_download_path(content_hash))
+        assert os.stat(path_1).st_mode & 0o222 == 0  # Read-only, since it is shared with the mirror's file
+
+        # Reusing an intact file does not download it again
+        n_requests = len(server.requests)
+        assert get_file(url=server.url+'/a/data.txt') == path_1
+        assert len(server.requests) == n_requests
+
+        # But a corrupted one is downloaded again
+        time.sleep(0.01)
+        os.chmod(path_3, 0o644)
+        with open(path_3, 'wb') as f:
+            f.write(b'other dat!')
+        assert get_file(url=server.url+'/b/other.txt') == path_3
+        assert len(server.requests) == n_requests + 1
+        with open(path_3, 'rb') as f:
+            assert f.read() == b'other data'
+
+        # The whole cache can be verified and repaired
+        time.sleep(0.01)
+        os.chmod(path_2, 0o644)
+        with open(path_2, 'wb') as f:
+            f.write(b'some dat!')
+        assert verify_download_cache() == [(server.url+'/a/data.txt', 'corrupt'), (server.url+'/mirror/data.txt', 'corrupt')]
+        verify_download_cache(repair=True)
+        assert verify_download_cache() == []
+        with open(get_cached_download_path(content_hash), 'rb') as f:
+            assert f.read() == b'some data'
+
+        # A new download replaces a corrupt cached file with the same contents, even if the size still matches
+        os.chmod(path_1, 0o644)
+        with open(path_1, 'wb') as f:
+            f.write(b'some dat!')
+        files['/c/data.txt'] = b'some data'
+        assert download_to_cache(server.url+'/c/data.txt') == get_cached_download_path(content_hash)
+        with open(get_cached_download_path(content_hash), 'rb') as f:
+            assert f.read() == b'some data'
+
+        # Simultaneous downloads of the same url wait for one another, rather than writing to the same file
+        files['/d/more.txt'] = b'more data'
+        server.latency = 0.2
+        threads = [threading.Thread(target=download_to_cache, args=(server.url+'/d/more.txt', )) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [r for r, _ in server.requests].count('/d/more.txt') == 1
+        with open(get_cached_download_path(hashlib.sha256(b'more data').hexdigest()), 'rb') as f:
+            assert f.read() == b'more data'
+
+
 if __name__ == '__main__':
     test_temp_file()
     test_unpack_zip()
     test_unpack_tar_gz()
     test_get_unnamed_file_in_archive()
     test_get_file()
+    test_resumable_download()
+    test_streaming_archive_extraction()
+    test_chunk_stream_ends_on_interrupt()
+    test_download_manager()
+    test_download_cache()
@@ -0,0 +1,81 @@
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from artemis.fileman.images2gif import readGif, iterGif, readGifFrame, readGifIntoArray, countGifFrames, writeGif, \
+    KMeansQuantizer, OnlineGifWriter
+
+
+def _write_test_gif(path, n_frames=6, size=(24, 16)):
+    frames = [np.zeros((size[1], size[0], 3), dtype=np.uint8) for _ in range(n_frames)]
+    for i, f in enumerate(frames):
+        f[:, :, i % 3] = 51*(i % 5 + 1)  # Web-palette colours, which survive PIL's quantization exactly
+        f[i, :, :] = 255
+    Image.fromarray(frames[0]).save(path, save_all=True, append_images=[Image.fromarray(f) for f in frames[1:]], duration=100, loop=0)
+    return frames
+
+
+def test_streaming_gif_reader():
+
+    path = os.path.join(tempfile.mkdtemp(), 'test.gif')
+    frames = _write_test_gif(path)
+
+    assert countGifFrames(path) == 6
+    read_frames = readGif(path)
+    assert len(read_frames) == 6 and all(np.array_equal(r, f) for r, f in zip(read_frames, frames))
+    assert [np.array_equal(r, frames[i]) for i, r in zip(range(1, 6, 2), iterGif(path, start=1, step=2))] == [True]*3
+    assert np.array_equal(readGifFrame(path, 4), frames[4])
+    assert np.array_equal(readGifFrame(path, 2), frames[2])
+
+    arr = readGifIntoArray(path)
+    assert arr.shape == (6, 16, 24, 3) and arr.dtype == np.uint8 and np.array_equal(arr, frames)
+    out = np.zeros((10, 16, 24, 3), dtype=np.uint8)
+    arr = readGifIntoArray(path, out=out, start=2)
+    assert arr.base is out and np.array_equal(arr, frames[2:])
+    try:
+        readGifIntoArray(path, out=out[:3])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Should have complained that the array is too small')
+
+
+def test_kmeans_quantizer():
+
+    gif_dir = tempfile.mkdtemp()
+    y, x = np.mgrid[:64, :80]
+    frames = [np.stack([(x+4*t) % 256, 3*y, (x+y) // 2], axis=2).astype(np.uint8) for t in range(4)]
+    writeGif(os.path.join(gif_dir, 'kmeans.gif'), frames, quantizer='kmeans')
+    assert np.abs(readGifIntoArray(os.path.join(gif_dir, 'kmeans.gif')).astype(int) - frames).mean() < 4
+
+    # Images with few colours are reproduced exactly
+    quantizer = KMeansQuantizer()
+    flat_frames = [np.tile(np.array([[[51*i, 0, 255]], [[0, 255-51*i, 0]]], dtype=np.uint8), (4, 3, 1)) for i in range(3)]
+    with OnlineGifWriter(os.path.join(gif_dir, 'online.gif'), quantizer=quantizer) as writer:
+        for frame in flat_frames:
+            writer.write(frame)
+    assert np.array_equal(readGifIntoArray(os.path.join(gif_dir, 'online.gif')), flat_frames)
+
+    # ... even if the colours are too close to be told apart by the colour histogram
+    gradient = np.tile(np.arange(256, dtype=np.uint8), (8, 1))
+    writeGif(os.path.join(gif_dir, 'gradient.gif'), [gradient, gradient[::-1]], quantizer='kmeans')
+    assert np.array_equal(readGifIntoArray(os.path.join(gif_dir, 'gradient.gif'), mode='RGB'), np.repeat(np.array([gradient, gradient[::-1]])[..., None], 3, axis=3))
+    quantizer = KMeansQuantizer()
+    for im in [gradient, gradient[::-1], gradient[:, :100]]:
+        assert np.array_equal(np.asarray(quantizer.quantize(im).convert('L')), im)
+    assert quantizer.n_fits == 1  # All of them fit the first frame's palette
+
+    # The palette is reused until the colours change
+    quantizer = KMeansQuantizer(colors=16)
+    for frame in frames:
+        quantizer.quantize(frame)
+    assert quantizer.n_fits == 1
+    quantizer.quantize(255-frames[0])
+    assert quantizer.n_fits == 2
+
+
+if __name__ == '__main__':
+    test_streaming_gif_reader()
+    test_kmeans_quantizer()
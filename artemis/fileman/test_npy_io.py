@@ -0,0 +1,34 @@
+import os
+import tempfile
+from shutil import rmtree
+
+import numpy as np
+
+from artemis.fileman.npy_io import load_npz_memmapped
+
+
+def test_load_npz_memmapped():
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, 'arrays.npz')
+        np.savez(path, a=np.arange(12).reshape(3, 4), b=np.asfortranarray(np.random.randn(5, 2)), c=np.zeros((0, 3)), d=np.float32(3.))
+        arrays = load_npz_memmapped(path)
+        assert sorted(arrays.keys()) == ['a', 'b', 'c', 'd']
+        assert isinstance(arrays['a'], np.memmap) and isinstance(arrays['b'], np.memmap)
+        with np.load(path) as f:
+            for name in 'abcd':
+                assert np.array_equal(arrays[name], f[name]) and arrays[name].dtype == f[name].dtype
+        assert not arrays['a'].flags.writeable
+
+        # Compressed files are just loaded normally
+        compressed_path = os.path.join(temp_dir, 'compressed.npz')
+        np.savez_compressed(compressed_path, a=np.arange(5))
+        arrays = load_npz_memmapped(compressed_path)
+        assert not isinstance(arrays['a'], np.memmap) and np.array_equal(arrays['a'], np.arange(5))
+    finally:
+        rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    test_load_npz_memmapped()
@@ -1,5 +1,6 @@
-from artemis.fileman.smart_io import smart_load, smart_save
+from artemis.fileman.smart_io import smart_load, smart_save, _process_video_frames, _iter_frame_batches, _collect_frames
 import numpy as np
+import os
 
 
 def test_smart_image_io(plot = False):
@@ -14,5 +15,49 @@ def test_smart_image_io(plot = False):
         dbplot(rev_image, 'Simetra', hang=True)
 
 
+def test_smart_numpy_io():
+
+    arr = np.random.RandomState(1234).randn(100, 20)
+    path = smart_save(arr, 'tests/smart_io/arr.npy')
+    assert np.array_equal(smart_load('tests/smart_io/arr.npy'), arr)
+    mapped = smart_load('tests/smart_io/arr.npy', mmap_mode='r')
+    assert isinstance(mapped, np.memmap) and np.array_equal(mapped[50:60], arr[50:60])
+    del mapped
+    os.remove(path)
+
+    arrays = {'x': arr, 'y': np.arange(100)}
+    path = smart_save(arrays, 'tests/smart_io/arrs.npz')
+    with smart_load('tests/smart_io/arrs.npz') as loaded:  # Arrays are read when they are accessed
+        assert sorted(loaded.keys()) == ['x', 'y'] and np.array_equal(loaded['y'], arrays['y'])
+    assert np.array_equal(smart_load('tests/smart_io/arrs.npz')['x'], arr)  # No need to close it, as it holds no open file
+    mapped = smart_load('tests/smart_io/arrs.npz', mmap_mode='r')
+    assert all(isinstance(mapped[k], np.memmap) and np.array_equal(mapped[k], arrays[k]) for k in arrays)
+    del mapped
+    os.remove(path)
+
+
+def test_video_frame_streaming():
+
+    frames = np.random.RandomState(1234).randint(256, size=(10, 30, 40, 3)).astype(np.uint8)
+    frames[:, :5] = 0  # Dark top edge
+
+    processed = list(_process_video_frames(iter(frames), frame_stride=3, cut_edges=True))
+    assert len(processed) == 4 and all(f.shape == (25, 40, 3) for f in processed)
+    assert np.array_equal(processed[1], frames[3, 5:])
+    processed = list(_process_video_frames(iter(frames), size=(20, 15)))
+    assert all(f.shape == (15, 20, 3) for f in processed)
+
+    batches = list(_iter_frame_batches(iter(frames), batch_size=4))
+    assert [len(b) for b in batches] == [4, 4, 2] and np.array_equal(np.concatenate(batches), frames)
+
+    assert np.array_equal(_collect_frames(iter(frames), n_frames=10), frames)
+    assert np.array_equal(_collect_frames(iter(frames), n_frames=8), frames)  # The frame count in video headers can be off
+    assert np.array_equal(_collect_frames(iter(frames), n_frames=12), frames)
+    out = np.zeros((10, 30, 40, 3), dtype=np.uint8)
+    assert _collect_frames(iter(frames), out=out).base is out and np.array_equal(out, frames)
+
+
 if __name__ == '__main__':
-    test_smart_image_io(plot=False)
\ No newline at end of file
+    test_smart_image_io(plot=False)
+    test_smart_numpy_io()
+    test_video_frame_streaming()
@@ -0,0 +1,64 @@
+import json
+import platform
+import sys
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from artemis._version import __version__ as ARTEMIS_VERSION
+
+"""
+Shared pieces of the benchmark scripts (e.g. artemis.fileman.benchmark_disk_memoize), which each save a report of the
+environment, the settings, and a dict<benchmark_name -> value> as JSON, so that results can be compared across
+versions and machines.
+"""
+
+
+def make_benchmark_report(settings, benchmarks):
+    """
+    :param settings: A dict<setting_name -> value> of the arguments the benchmarks were run with
+    :param benchmarks: A dict<benchmark_name -> value> of results
+    :return: An OrderedDict containing info about the environment, the settings, and the results.
+    """
+    return OrderedDict([
+        ('artemis_version', ARTEMIS_VERSION),
+        ('python_version', platform.python_version()),
+        ('numpy_version', np.__version__),
+        ('platform', platform.platform()),
+        ('date', datetime.now().isoformat()),
+        ('settings', OrderedDict(settings)),
+        ('benchmarks', OrderedDict(benchmarks)),
+        ])
+
+
+def run_benchmark_script(run_benchmarks, parser, unit='', args=None):
+    """
+    Run a benchmark suite from the command line.  Every argument of the parser is passed to run_benchmarks as a keyword
+    argument, except --output, which is added here.  The results are printed to stderr, and the report is saved as
+    JSON to the output file (or printed to stdout if there is none).
+
+        if __name__ == '__main__':
+            parser = argparse.ArgumentParser(description='Benchmark my thing.')
+            parser.add_argument('-n', '--n_items', type=int, default=100, help='Number of items')
+            run_benchmark_script(run_benchmarks, parser, unit='s')
+
+    :param run_benchmarks: A function which takes the arguments of the parser and returns a report (see
+        make_benchmark_report)
+    :param parser: An argparse.ArgumentParser with the arguments of run_benchmarks
+    :param unit: A unit to print after each result
+    :param args: The command-line arguments (defaults to sys.argv[1:])
+    :return: The report
+    """
+    parser.add_argument('-o', '--output', default=None, help='Path of a JSON file to save the results to')
+    kwargs = vars(parser.parse_args(args))
+    output = kwargs.pop('output')
+    report = run_benchmarks(**kwargs)
+    for name, value in report['benchmarks'].items():
+        sys.stderr.write('{}: {:.4g}{}\n'.format(name, value, unit))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return report
@@ -2,11 +2,13 @@ import hashlib
 import pickle
 from collections import OrderedDict
 import itertools
+import weakref
 import numpy as np
-from six import string_types, next
+from six import string_types, text_type, binary_type, integer_types, next
 
 _ALREADY_SEEN_CODE = 'dbf056790fabd3c7b79c1ddab7b7ee49'.encode('utf-8')
 _END_CODE = 'e0abd6b36d6e295b6c8859cdffc773df'.encode('utf-8')
+_FROZEN_ARRAY_DATA_DIGESTS = {}  # (data address, dtype, shape, strides) -> (weakref to array, dict<algorithm -> digest of its data>)
 
 
 def fixed_hash_eq(obj1, obj2):
@@ -22,10 +24,186 @@ def fixed_hash_eq(obj1, obj2):
     return compute_fixed_hash(obj1)==compute_fixed_hash(obj2)
 
 
-def compute_fixed_hash(obj, try_objects=False, _hasher = None, _memo = None, _count=None):
+def compute_fixed_hash(obj, try_objects=False, algorithm='md5', legacy=False):
     """
     Given an object, return a hash that will always be the same (not just for the lifetime of the
     object, but for all future runs of the program too).
+
+    The structure is walked once, feeding type tags and the raw contents of primitives into a single digest.  The data of
+    each array is hashed in place (without copying, unless the array is not contiguous), and its digest fed in.  The
+    digests of arrays frozen with freeze_array are cached, so hashing them again is O(1).
+
+    :param obj: Some nested container of primitives
+    :param try_objects: Try to break into objects
+    :param algorithm: The hashlib algorithm to use.  'blake2b' is faster than the default 'md5' on 64-bit machines
+        (Python 3 only).  Blake2 digests are truncated to 16 bytes, so all the algorithms give codes of the same length.
+    :param legacy: Compute the hash the way older versions of artemis did (which is slower, and gives different codes).
+        Use this to find results (e.g. memos) that were saved under an old hash.
+    :return: A 32-character hexidecimal (0-f) hash code for your object.
+    """
+    if legacy:
+        assert algorithm == 'md5', 'Legacy hashes are always computed with md5'
+        return _compute_legacy_fixed_hash(obj, try_objects=try_objects)
+    hasher = _new_hasher(algorithm)
+    _update_fixed_hash(obj, hasher=hasher, try_objects=try_objects, _in_progress={})
+    return hasher.hexdigest()
+
+
+def freeze_array(arr):
+    """
+    Return a read-only version of an array, and let compute_fixed_hash cache the hash of its data.  Use this on large
+    arrays (e.g. datasets) that are repeatedly passed to memoized functions or experiments, so that their contents are
+    only hashed once:
+
+        x_train = freeze_array(x_train)
+
+    The cached hash must never go stale, so the array must be one that numpy will not let anyone make writeable again.
+    Arrays whose data is in a read-only buffer, like a bytes object or a file memory-mapped in read-only mode (e.g. by
+    np.load(path, mmap_mode='r')), are used as they are.  Other arrays are copied into a bytes object.  The hash is
+    cached by the address and layout of the data, so read-only views with the same layout (e.g. arr[:]) share it.
+    Object arrays (whose elements are hashed one by one anyway) are just made read-only, and their hashes are not cached.
+
+    :param arr: A numpy array
+    :return: A read-only array with the same contents.
+    """
+    assert isinstance(arr, np.ndarray), 'Can only freeze numpy arrays, not {}'.format(type(arr))
+    if arr.dtype.hasobject:
+        arr.flags.writeable = False
+        return arr
+    if not _is_immutable_array(arr):
+        arr = np.frombuffer(arr.tobytes(), dtype=arr.dtype).reshape(arr.shape)
+    key = _get_array_data_key(arr)
+    entry = _FROZEN_ARRAY_DATA_DIGESTS.get(key)
+    if entry is None or entry[0]() is None:
+        def forget(ref):
+            if _FROZEN_ARRAY_DATA_DIGESTS.get(key, (None, ))[0] is ref:
+                del _FROZEN_ARRAY_DATA_DIGESTS[key]
+        _FROZEN_ARRAY_DATA_DIGESTS[key] = (weakref.ref(arr, forget), {})
+    return arr
+
+
+def _is_immutable_array(arr):
+    # True if the array's data lives in a read-only buffer (e.g. a bytes object or a read-only mmap), and every array
+    # between it and the buffer is read-only (so numpy refuses to make any of them writeable).
+    base = arr
+    while isinstance(base, np.ndarray):
+        if base.flags.writeable:
+            return False
+        base = base.base
+    if base is None:  # The array owns its data
+        return False
+    try:
+        view = memoryview(base)
+    except TypeError:
+        return False
+    readonly = view.readonly
+    if hasattr(view, 'release'):  # (Python 3) So that we don't stop the buffer (e.g. an mmap) from being closed
+        view.release()
+    return readonly
+
+
+def _get_array_data_key(arr):
+    return (arr.__array_interface__['data'][0], arr.dtype.str, arr.shape, arr.strides)
+
+
+def _new_hasher(algorithm):
+    return hashlib.new(algorithm, digest_size=16) if algorithm in ('blake2b', 'blake2s') else hashlib.new(algorithm)
+
+
+def _get_array_data_digest(arr, algorithm):
+    entry = _FROZEN_ARRAY_DATA_DIGESTS.get(_get_array_data_key(arr)) if not arr.flags.writeable else None
+    if entry is not None:
+        frozen_arr = entry[0]()
+        # An immutable array with the same data address and layout as a live frozen array views the same data.
+        is_frozen = frozen_arr is arr or frozen_arr is not None and _is_immutable_array(arr)
+    else:
+        is_frozen = False
+    if is_frozen and algorithm in entry[1]:
+        return entry[1][algorithm]
+    data_hasher = _new_hasher(algorithm)
+    data_hasher.update(np.ascontiguousarray(arr).reshape(-1).view(np.uint8))
+    digest = data_hasher.digest()
+    if is_frozen:
+        entry[1][algorithm] = digest
+    return digest
+
+
+def _update_fixed_hash(obj, hasher, try_objects, _in_progress):
+    """
+    Feed an object into a hasher (see compute_fixed_hash).
+    :param _in_progress: A dict<id -> depth> of the containers that we are currently inside, so that circular references
+        are hashed as a reference back up the structure instead of recursing forever.
+    """
+    obj_id = id(obj)
+    if obj_id in _in_progress:
+        hasher.update(_ALREADY_SEEN_CODE)
+        hasher.update(str(_in_progress[obj_id]).encode('utf-8'))
+        return
+
+    hasher.update(obj.__class__.__name__.encode('utf-8'))
+    hasher.update(b'\0')
+    if isinstance(obj, np.ndarray):
+        hasher.update(str(obj.dtype.descr).encode('utf-8'))
+        hasher.update(str(obj.shape).encode('utf-8'))
+        if obj.dtype.hasobject:
+            _in_progress[obj_id] = len(_in_progress)
+            for el in obj.ravel():
+                _update_fixed_hash(el, hasher=hasher, try_objects=try_objects, _in_progress=_in_progress)
+            del _in_progress[obj_id]
+        else:
+            hasher.update(_get_array_data_digest(obj, hasher.name))
+    elif isinstance(obj, string_types):
+        data = obj.encode('utf-8') if isinstance(obj, text_type) else obj
+        hasher.update(str(len(data)).encode('utf-8'))
+        hasher.update(b':')
+        hasher.update(data)
+    elif isinstance(obj, binary_type):
+        hasher.update(str(len(obj)).encode('utf-8'))
+        hasher.update(b':')
+        hasher.update(obj)
+    elif isinstance(obj, np.generic):  # (Before the check for python numbers, because np.float64 subclasses float)
+        hasher.update(str(obj.dtype.descr).encode('utf-8'))
+        hasher.update(np.asarray(obj).reshape(-1).view(np.uint8))
+    elif isinstance(obj, (bool, float)+integer_types):
+        hasher.update(repr(obj).encode('utf-8'))
+    elif obj is None:
+        pass
+    elif obj in (int, str, float, bool):
+        hasher.update(obj.__name__.encode('utf-8'))
+    else:
+        _in_progress[obj_id] = len(_in_progress)
+        kwargs = dict(hasher=hasher, try_objects=try_objects, _in_progress=_in_progress)
+        if isinstance(obj, (list, tuple)):
+            for el in obj:
+                _update_fixed_hash(el, **kwargs)
+        elif isinstance(obj, set):
+            for el in sorted(obj):
+                _update_fixed_hash(el, **kwargs)
+        elif isinstance(obj, dict):
+            keys = obj.keys() if isinstance(obj, OrderedDict) else sorted(obj.keys())
+            for k in keys:
+                _update_fixed_hash(k, **kwargs)
+                _update_fixed_hash(obj[k], **kwargs)
+        elif isinstance(obj, FixedHashObject):  # See below... allows you to make custom hashables
+            _update_fixed_hash(obj.get_hash_description(), **kwargs)
+        elif hasattr(obj, 'memo_hashable'):  # Deprecated, just here for back-compatibility
+            _update_fixed_hash(obj.memo_hashable(), **kwargs)
+        elif try_objects:
+            keys = sorted(obj.__dict__.keys())
+            for k in keys:
+                _update_fixed_hash(k, **kwargs)
+                _update_fixed_hash(obj.__dict__[k], **kwargs)
+        else:
+            # TODO: Consider whether to pickle by default.  Note that pickle strings are not necessairly the same for identical objects.
+            raise NotImplementedError("Don't have a method for hashing this %s" % (obj, ))
+        del _in_progress[obj_id]
+    hasher.update(_END_CODE)  # Necessary to distinguish ([a, b], c) from ([a, b, c])
+
+
+def _compute_legacy_fixed_hash(obj, try_objects=False, _hasher = None, _memo = None, _count=None):
+    """
+    The original implementation of compute_fixed_hash, which computes a digest at every level of the structure.  Kept so
+    that hashes (e.g. memo file names) computed by older versions can still be reproduced.
     :param obj: Some nested container of primitives
     :param try_objects: Try to break into objects
     :param _hasher: (for internal use - note that this is stateful, so calling this function with this argument changes
@@ -55,29 +233,29 @@ def compute_fixed_hash(obj, try_objects=False, _hasher = None, _memo = None, _co
     if isinstance(obj, np.ndarray):
         _hasher.update(pickle.dumps(obj.dtype, protocol=2))
         _hasher.update(pickle.dumps(obj.shape, protocol=2))
-        _hasher.update(obj.tostring())
+        _hasher.update(obj.tobytes())  # (Same bytes as the tostring() that older versions used)
     elif isinstance(obj, (int, float, bool)+string_types) or (obj is None) or (obj in (int, str, float, bool)):
         _hasher.update(pickle.dumps(obj, protocol=2))
     elif isinstance(obj, (list, tuple)):
         for el in obj:
-            compute_fixed_hash(el, **kwargs)
+            _compute_legacy_fixed_hash(el, **kwargs)
     elif isinstance(obj, set):
         for el in sorted(obj):
-            compute_fixed_hash(el, **kwargs)
+            _compute_legacy_fixed_hash(el, **kwargs)
     elif isinstance(obj, dict):
         keys = obj.keys() if isinstance(obj, OrderedDict) else sorted(obj.keys())
         for k in keys:
-            compute_fixed_hash(k, **kwargs)
-            compute_fixed_hash(obj[k], **kwargs)
+            _compute_legacy_fixed_hash(k, **kwargs)
+            _compute_legacy_fixed_hash(obj[k], **kwargs)
     elif isinstance(obj, FixedHashObject):  # See below... allows you to make custom hashables
-        compute_fixed_hash(obj.get_hash_description(), **kwargs)
+        _compute_legacy_fixed_hash(obj.get_hash_description(), **kwargs)
     elif hasattr(obj, 'memo_hashable'):  # Deprecated, just here for back-compatibility
-        compute_fixed_hash(obj.memo_hashable(), **kwargs)
+        _compute_legacy_fixed_hash(obj.memo_hashable(), **kwargs)
     elif try_objects:
         keys = sorted(obj.__dict__.keys())
         for k in keys:
-            compute_fixed_hash(k, **kwargs)
-            compute_fixed_hash(obj.__dict__[k], **kwargs)
+            _compute_legacy_fixed_hash(k, **kwargs)
+            _compute_legacy_fixed_hash(obj.__dict__[k], **kwargs)
     else:
         # TODO: Consider whether to pickle by default.  Note that pickle strings are not necessairly the same for identical objects.
         raise NotImplementedError("Don't have a method for hashing this %s" % (obj, ))
@@ -62,12 +62,12 @@ def resize_and_crop(im, width, height):
     if im_aspect > new_aspect:  # Need to chop the top and bottom
         new_height = int(width*im_aspect)
         resized_im = imresize(im, (new_height, width))
-        start = (new_height-height)/2
+        start = (new_height-height)//2
         output_im = resized_im[start:start+height, :]
     else:  # Need to chop the left and right.
         new_width = int(height/im_aspect)
         resized_im = imresize(im, (height, new_width))
-        start = (new_width-width)/2
+        start = (new_width-width)//2
         output_im = resized_im[:, start:start+width]
     assert output_im.shape[:2] == (height, width)
     return output_im
@@ -82,8 +82,8 @@ def resize_image(im, width=None, height=None, mode='squeeze'):
     elif mode == 'crop':
         current_height, current_width = im.shape[:2]
         assert height>=height and width>=width, "Crop size must be smaller than image size"
-        row_start = (current_height-height)/2
-        col_start = (current_width-width)/2
+        row_start = (current_height-height)//2
+        col_start = (current_width-width)//2
         im = im[..., row_start:row_start+224, col_start:col_start+224, :]
     elif mode in ('resize_and_crop', 'scale_crop'):
         assert height is not None and width is not None, "You need to specify both height and width. for 'scale_crop' mode"
@@ -2,6 +2,10 @@ import inspect
 from collections import OrderedDict
 import itertools
 import os
+import sys
+import threading
+import time
+from functools import partial
 
 import math
 from six.moves import xrange, zip_longest
@@ -50,27 +54,183 @@ def bad_value(value, explanation = None):
     raise ValueError('Bad Value: %s%s' % (value, ': '+explanation if explanation is not None else ''))
 
 
-def memoize(fcn):
+def memoize(fcn, max_entries=None, max_bytes=None, ttl=None):
     """
     Use this to decorate a function whose results you want to cache.
+
+    The wrapper is thread-safe: if several threads call it with the same arguments at once, the function is called
+    once, and the other threads wait for (and return) its result.  By default everything is cached forever - use
+    memoize_with_settings to bound the cache:
+
+        @memoize_with_settings(max_entries=4, ttl=3600)
+        def get_dataset(name):
+            ...
+
+    The wrapper has methods wrapper.clear_cache() and wrapper.get_stats() (hits, misses, evictions, ...).
+
+    :param fcn: The function to memoize
+    :param max_entries: Keep at most this many results, evicting the least recently used ones.
+    :param max_bytes: Keep results whose total (estimated) size is at most this many bytes.
+    :param ttl: Recompute results that were computed more than this many seconds ago.
+    :return: The memoized function
     """
-    lookup = {}
+    cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes, size_function=lambda value_and_time: estimate_memory_size(value_and_time[0]))
+    lock = threading.Lock()
+    computing = {}  # arg signature -> Event which is set when the thread computing the result for it is done.
+    stats = dict(expirations=0)
 
     def memoization_wrapper(*args, **kwargs):
         # arg_signature = args + ('5243643254_kwargs_start_here', ) + tuple((k, kwargs[k]) for k in sorted(kwargs.keys()))
         hashable_arg_structure = arg_signature((args, kwargs))
-        if hashable_arg_structure in lookup:
-            return lookup[hashable_arg_structure]
-        else:
+        while True:
+            with lock:
+                if hashable_arg_structure in cache:
+                    out, compute_time = cache[hashable_arg_structure]
+                    if ttl is None or time.time() - compute_time < ttl:
+                        return out
+                    cache.pop(hashable_arg_structure)
+                    stats['expirations'] += 1
+                done = computing.get(hashable_arg_structure)
+                if done is None:  # Nobody else is computing this, so we do it.
+                    cache.misses += 1
+                    done = computing[hashable_arg_structure] = threading.Event()
+                    break
+            done.wait()  # Then loop back to get the result (or compute it ourselves, if the other thread failed)
+        try:
             out = fcn(*args, **kwargs)
-            lookup[hashable_arg_structure]=out
+            with lock:
+                cache[hashable_arg_structure] = (out, time.time())
             return out
+        finally:
+            with lock:
+                del computing[hashable_arg_structure]
+            done.set()
+
+    def clear_cache():
+        with lock:
+            cache.clear()
+
+    def get_stats():
+        with lock:
+            return OrderedDict(list(cache.get_stats().items()) + list(stats.items()))
 
     memoization_wrapper.wrapped_fcn = fcn
+    memoization_wrapper.clear_cache = clear_cache
+    memoization_wrapper.get_stats = get_stats
 
     return memoization_wrapper
 
 
+def memoize_with_settings(**kwargs):
+    """
+    Get a memoize decorator with settings.  See memoize for the options.
+    """
+    return partial(memoize, **kwargs)
+
+
+def estimate_memory_size(obj):
+    """
+    Roughly estimate the number of bytes taken up by an object.  Arrays (anything with an nbytes attribute) count their
+    data, containers count their contents, and anything else counts sys.getsizeof.  Objects referenced more than once are
+    counted each time.
+    :param obj: Any object
+    :return: An estimate of the size, in bytes
+    """
+    if hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(estimate_memory_size(x) for x in obj)
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_memory_size(k)+estimate_memory_size(v) for k, v in obj.items())
+    else:
+        return sys.getsizeof(obj)
+
+
+class LRUCache(object):
+    """
+    A dict-like cache that evicts the least-recently-used items when it exceeds a maximum number of entries or a
+    maximum total (estimated) size.  It keeps statistics of hits, misses and evictions.
+
+        cache = LRUCache(max_entries=100, max_bytes=1e9)
+        cache['a'] = np.zeros(1000)
+        arr = cache.get('a')  # Returns None (and counts a miss) if it was not in the cache.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, size_function=estimate_memory_size):
+        """
+        :param max_entries: Maximum number of entries to keep (None for no limit)
+        :param max_bytes: Maximum total size of entries to keep, as measured by size_function (None for no limit)
+        :param size_function: A function which estimates the size of a value, in bytes.  Only used if max_bytes is set.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_function = size_function
+        self._items = OrderedDict()  # key -> (value, size), from least to most recently used
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Get an item and mark it as recently used.
+        :return: The value if the key is in the cache, otherwise default.
+        """
+        if key in self._items:
+            self.hits += 1
+            value, size = self._items.pop(key)
+            self._items[key] = (value, size)
+            return value
+        else:
+            self.misses += 1
+            return default
+
+    def __getitem__(self, key):
+        if key not in self._items:
+            self.misses += 1
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            self.pop(key)
+        size = self.size_function(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # Would not fit even in an empty cache, so just don't store it.
+        self._items[key] = (value, size)
+        self.n_bytes += size
+        while (self.max_entries is not None and len(self._items) > self.max_entries) or (self.max_bytes is not None and self.n_bytes > self.max_bytes):
+            oldest_key = next(iter(self._items))
+            self.pop(oldest_key)
+            self.evictions += 1
+
+    def pop(self, key, *default):
+        if key not in self._items and len(default) > 0:
+            return default[0]
+        value, size = self._items.pop(key)
+        self.n_bytes -= size
+        return value
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return list(self._items.keys())
+
+    def clear(self):
+        self._items.clear()
+        self.n_bytes = 0
+
+    def get_stats(self):
+        """
+        :return: An OrderedDict of statistics on the use of the cache.
+        """
+        return OrderedDict([('entries', len(self._items)), ('bytes', self.n_bytes), ('hits', self.hits), ('misses', self.misses), ('evictions', self.evictions)])
+
+
 def arg_signature(arg):
     """
     Turn the argument into something hashable
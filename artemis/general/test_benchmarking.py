@@ -0,0 +1,51 @@
+import argparse
+import importlib
+import json
+import os
+import tempfile
+from shutil import rmtree
+
+import pytest
+
+from artemis.general.benchmarking import make_benchmark_report, run_benchmark_script
+
+# (module, small settings for run_benchmarks, a benchmark which should be in the report)
+BENCHMARK_SUITES = [
+    ('artemis.fileman.benchmark_disk_memoize', dict(size_mb=0.1, codec_size_mb=0.1), 'memo_storage/array/numpy/file_size'),
+    ('artemis.fileman.benchmark_images2gif', dict(sizes=(64, ), n_frames=3, quantizers=('pil', 'kmeans')), 'gif_quantizers/64x64/kmeans/frames_per_second'),
+    ('artemis.experiments.benchmark_experiments', dict(n_records=20, n_experiments=4, n_repeats=1, n_runs=2, n_grouping_records=20, n_config_calls=100), 'config_access/get_artemis_config_value'),
+    ]
+
+
+@pytest.mark.parametrize('module_name, kwargs, benchmark_name', BENCHMARK_SUITES)
+def test_run_benchmarks(module_name, kwargs, benchmark_name):
+
+    report = json.loads(json.dumps(importlib.import_module(module_name).run_benchmarks(**kwargs)))
+    assert list(report.keys()) == ['artemis_version', 'python_version', 'numpy_version', 'platform', 'date', 'settings', 'benchmarks']
+    assert all(report['settings'][k] == (list(v) if isinstance(v, tuple) else v) for k, v in kwargs.items())
+    assert benchmark_name in report['benchmarks']
+    assert all(isinstance(value, (int, float)) for value in report['benchmarks'].values())
+
+
+def test_run_benchmark_script():
+
+    def run_benchmarks(n_items=3):
+        return make_benchmark_report(settings=[('n_items', n_items)], benchmarks=[('items/n_items', n_items)])
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-n', '--n_items', type=int, default=3)
+        path = os.path.join(temp_dir, 'results.json')
+        report = run_benchmark_script(run_benchmarks, parser, args=['-n', '5', '-o', path])
+        with open(path) as f:
+            assert json.load(f) == json.loads(json.dumps(report))
+        assert report['settings'] == {'n_items': 5} and report['benchmarks'] == {'items/n_items': 5}
+    finally:
+        rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    for module_name, kwargs, benchmark_name in BENCHMARK_SUITES:
+        test_run_benchmarks(module_name, kwargs, benchmark_name)
+    test_run_benchmark_script()
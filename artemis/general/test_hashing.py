@@ -1,6 +1,10 @@
-from artemis.general.hashing import compute_fixed_hash, fixed_hash_eq
+from pytest import raises
+from artemis.general.hashing import compute_fixed_hash, fixed_hash_eq, freeze_array, _FROZEN_ARRAY_DATA_DIGESTS, \
+    _get_array_data_key
 import numpy as np
+import os
 import sys
+import tempfile
 
 _IS_PYTHON_3 = sys.version_info > (3, 0)
 
@@ -9,17 +13,17 @@ def test_compute_fixed_hash():
     # Not really sure why the fixed hash differes between python 2 and 4 here (maybe something do do with changes to strings)
 
     complex_obj = [1, 'd', {'a': 4, 'b': np.arange(10)}, (7, list(range(10)))]
-    original_code = compute_fixed_hash(complex_obj)
+    original_code = compute_fixed_hash(complex_obj, legacy=True)
 
     expected_code = 'c9b83dd2e1099c3bcbb05e3c69327c72' if _IS_PYTHON_3 else '6c98fabc301361863f321f6149a8a12a'
 
-    assert compute_fixed_hash(complex_obj) == original_code == expected_code
+    assert compute_fixed_hash(complex_obj, legacy=True) == original_code == expected_code
     complex_obj[2]['b'][6]=0
 
     expected_code = 'a783b1f098fca8ccaf977a3123be5ac4' if _IS_PYTHON_3 else '8aee1f739fc9a612ed72e14682026627'
-    assert compute_fixed_hash(complex_obj) == expected_code != original_code
+    assert compute_fixed_hash(complex_obj, legacy=True) == expected_code != original_code
     complex_obj[2]['b'][6]=6  # Revert to old value
-    assert compute_fixed_hash(complex_obj) == original_code
+    assert compute_fixed_hash(complex_obj, legacy=True) == original_code
 
 
 def test_compute_fixed_hash_terminates():
@@ -27,13 +31,13 @@ def test_compute_fixed_hash_terminates():
     a = []
     b = [a]
     a.append(b)
-    code = compute_fixed_hash(a)
+    code = compute_fixed_hash(a, legacy=True)
     assert code == 'cffaee424a62cd1893825a5811c34b8d'
 
     c = []
     d = [c]
     c.append(d)
-    code = compute_fixed_hash(c)
+    code = compute_fixed_hash(c, legacy=True)
     assert code == 'cffaee424a62cd1893825a5811c34b8d'
 
 
@@ -47,7 +51,89 @@ def test_fixed_hash_eq():
     assert not fixed_hash_eq(obj1, obj3)
 
 
+def test_streaming_fixed_hash():
+
+    complex_obj = [1, 'd', {'a': 4, 'b': np.arange(10, dtype=np.int64)}, (7, list(range(10)))]
+    if _IS_PYTHON_3:
+        assert compute_fixed_hash(complex_obj) == '9e61485c0bf6f9cab2a12b61cdda57b8'
+    assert compute_fixed_hash(complex_obj) != compute_fixed_hash(complex_obj, legacy=True)
+    assert len(compute_fixed_hash(complex_obj, algorithm='sha256')) == 64
+    if _IS_PYTHON_3:
+        assert len(compute_fixed_hash(complex_obj, algorithm='blake2b')) == 32
+
+    assert compute_fixed_hash(([1, 2], 3)) != compute_fixed_hash(([1, 2, 3], ))
+    assert compute_fixed_hash(['ab', 'c']) != compute_fixed_hash(['a', 'bc'])
+    assert compute_fixed_hash([1, True, 1.]) != compute_fixed_hash([1, 1, 1])
+
+    # Numpy scalars are hashed by dtype and bytes (not repr, which changes across numpy versions), even np.float64,
+    # which subclasses float
+    if _IS_PYTHON_3:
+        assert compute_fixed_hash(np.float64(1.5)) == 'ea5541b978072315b17911176fb454d9'
+    assert compute_fixed_hash(np.float64(1.5)) != compute_fixed_hash(1.5)
+    assert compute_fixed_hash(np.float64(1.5)) != compute_fixed_hash(np.float32(1.5))
+    assert compute_fixed_hash(np.arange(10)) != compute_fixed_hash(np.arange(10).astype(np.int32))
+    assert compute_fixed_hash(np.arange(10)) != compute_fixed_hash(np.arange(10).reshape(2, 5))
+    x = np.random.RandomState(1234).randn(20, 30)
+    assert compute_fixed_hash(x[::2, ::-1]) == compute_fixed_hash(x[::2, ::-1].copy())  # Non-contiguous arrays
+    assert compute_fixed_hash(np.array(['a', 2], dtype=object)) == compute_fixed_hash(np.array(['a', 2], dtype=object))
+
+    # Shared references hash the same as copies, but circular references terminate
+    a = [1, 2]
+    assert compute_fixed_hash([a, a]) == compute_fixed_hash([[1, 2], [1, 2]])
+    b = []
+    b.append([b])
+    c = []
+    c.append([c])
+    assert compute_fixed_hash(b) == compute_fixed_hash(c) != compute_fixed_hash([[[]]])
+
+
+def test_frozen_array_hash_cache():
+
+    x = np.random.RandomState(1234).randn(100, 10)
+    code = compute_fixed_hash(dict(data=x, n=3))
+    y = freeze_array(x)
+    assert not y.flags.writeable and np.array_equal(x, y) and freeze_array(y) is y
+    assert compute_fixed_hash(dict(data=y, n=3)) == code  # Freezing does not change the hash...
+    assert compute_fixed_hash(dict(data=y, n=3)) == code
+    assert list(_FROZEN_ARRAY_DATA_DIGESTS[_get_array_data_key(y)][1].keys()) == ['md5']  # ... but the hash of the data is now cached
+    assert compute_fixed_hash(y[:50]) == compute_fixed_hash(x[:50].copy())  # Views of frozen arrays are not cached
+
+    # Frozen arrays can not be unfrozen and modified, so the cached hash can not go stale
+    with raises(ValueError):
+        y.flags.writeable = True
+    with raises(ValueError):
+        y[:50].flags.writeable = True
+
+    # Modifying the original array does not affect the frozen copy
+    x.flags.writeable = False
+    x.flags.writeable = True
+    x[0, 0] = 0
+    x.flags.writeable = False
+    assert compute_fixed_hash(dict(data=y, n=3)) == code
+    assert compute_fixed_hash(dict(data=x, n=3)) != code
+    z = freeze_array(x)
+    assert compute_fixed_hash(dict(data=z, n=3)) == compute_fixed_hash(dict(data=x.copy(), n=3)) != code
+
+    n_frozen = len(_FROZEN_ARRAY_DATA_DIGESTS)
+    del y
+    assert len(_FROZEN_ARRAY_DATA_DIGESTS) == n_frozen - 1
+
+    # Arrays memory-mapped in read-only mode are frozen without copying them
+    path = os.path.join(tempfile.mkdtemp(), 'data.npy')
+    np.save(path, x)
+    mapped = np.load(path, mmap_mode='r')
+    frozen_mapped = freeze_array(mapped)
+    assert frozen_mapped is mapped
+    assert compute_fixed_hash(frozen_mapped) == compute_fixed_hash(np.load(path, mmap_mode='r'))
+    assert 'md5' in _FROZEN_ARRAY_DATA_DIGESTS[_get_array_data_key(mapped)][1]
+    copy_on_write = np.load(path, mmap_mode='c')
+    copy_on_write.flags.writeable = False
+    assert freeze_array(copy_on_write) is not copy_on_write  # It could be made writeable again, so it is copied
+
+
 if __name__ == '__main__':
     test_compute_fixed_hash()
     test_compute_fixed_hash_terminates()
-    test_fixed_hash_eq()
\ No newline at end of file
+    test_fixed_hash_eq()
+    test_streaming_fixed_hash()
+    test_frozen_array_hash_cache()
@@ -4,7 +4,10 @@ import pytest
 
 from artemis.general.should_be_builtins import itermap, reducemap, separate_common_items, remove_duplicates, \
     detect_duplicates, remove_common_prefix, all_equal, get_absolute_module, insert_at, get_shifted_key_value, \
-    divide_into_subsets
+    divide_into_subsets, LRUCache, memoize, memoize_with_settings
+import numpy as np
+import threading
+import time
 
 __author__ = 'peter'
 
@@ -117,6 +120,74 @@ def test_divide_into_subsets():
     assert divide_into_subsets(range(9), subset_size=3) == [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
 
 
+def test_lru_cache():
+
+    cache = LRUCache(max_entries=3)
+    for i in range(3):
+        cache[i] = str(i)
+    assert cache.get(0) == '0'  # Now 1 is the least recently used
+    cache[3] = '3'
+    assert cache.keys() == [2, 0, 3]
+    assert cache.get(1) is None
+    assert cache.get_stats() == OrderedDict([('entries', 3), ('bytes', 0), ('hits', 1), ('misses', 1), ('evictions', 1)])
+
+    cache = LRUCache(max_bytes=2500)
+    cache['a'] = np.zeros(100)  # 800 bytes
+    cache['b'] = np.zeros(150)
+    assert cache.n_bytes == 2000
+    cache['c'] = np.zeros(100)
+    assert cache.keys() == ['b', 'c'] and cache.n_bytes == 2000
+    cache['d'] = np.zeros(1000)  # Too big to ever fit
+    assert 'd' not in cache and cache.keys() == ['b', 'c']
+    with pytest.raises(KeyError):
+        cache['a']
+
+
+def test_memoize():
+
+    calls = []
+
+    @memoize_with_settings(max_entries=2)
+    def slow_square(x):
+        calls.append(x)
+        time.sleep(0.1)
+        return x**2
+
+    # Concurrent calls with the same arguments compute the result once
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow_square(3))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [9]*8 and calls == [3]
+
+    assert slow_square(4) == 16 and slow_square(5) == 25  # Evicts 3
+    assert slow_square(3) == 9 and calls == [3, 4, 5, 3]
+    stats = slow_square.get_stats()
+    assert (stats['entries'], stats['hits'], stats['misses'], stats['evictions']) == (2, 7, 4, 2)
+    slow_square.clear_cache()
+    assert slow_square(5) == 25 and calls == [3, 4, 5, 3, 5]
+
+    @memoize_with_settings(ttl=0.05)
+    def get_time(x):
+        return time.time()
+
+    t = get_time(1)
+    assert get_time(1) == t
+    time.sleep(0.1)
+    assert get_time(1) > t
+    assert get_time.get_stats()['expirations'] == 1
+
+    # The plain decorator still caches everything
+    @memoize
+    def add(a, b=1):
+        calls.append((a, b))
+        return a+b
+    assert add(1, b=2) == add(1, b=2) == 3
+    assert calls[-1] == (1, 2) and len(calls) == 6
+
+
 if __name__ == '__main__':
     test_separate_common_items()
     test_reducemap()
@@ -128,4 +199,6 @@ if __name__ == '__main__':
     test_get_absolute_module()
     test_insert_at()
     test_get_shifted_key_value()
-    test_divide_into_subsets()
\ No newline at end of file
+    test_divide_into_subsets()
+    test_lru_cache()
+    test_memoize()
@@ -1,6 +1,6 @@
 import json
 from itertools import izip
-from artemis.fileman.file_getter import get_file, unzip_gz
+from artemis.fileman.file_getter import get_file, unzip_gz, get_files
 from artemis.fileman.smart_io import smart_load
 import numpy as np
 import os
@@ -38,7 +38,10 @@ def get_imagenet_images(indices):
     """
     highest_index = np.max(indices)
     code_url_pairs = get_imagenet_fall11_urls(highest_index+1)
-    files = [get_file('data/imagenet/%s%s' % (code_url_pairs[index][0], os.path.splitext(code_url_pairs[index][1])[1]), code_url_pairs[index][1]) for index in indices]
+    files = get_files(
+        urls = [code_url_pairs[index][1] for index in indices],
+        relative_names = ['data/imagenet/%s%s' % (code_url_pairs[index][0], os.path.splitext(code_url_pairs[index][1])[1]) for index in indices]
+        )
     return [smart_load(f) for f in files]
 
 
@@ -1,6 +1,6 @@
 import pickle
 
-from artemis.general.should_be_builtins import memoize
+from artemis.general.should_be_builtins import memoize_with_settings
 from artemis.ml.datasets.datasets import DataSet, DataCollection
 from artemis.fileman.file_getter import get_file, unzip_gz
 import numpy as np
@@ -8,7 +8,7 @@ import numpy as np
 __author__ = 'peter'
 
 
-@memoize  # This should save time on tests and dataset should be immutable so it's all good.
+@memoize_with_settings(max_entries=4)  # This should save time on tests and dataset should be immutable so it's all good.
 def get_mnist_dataset(n_training_samples = None, n_test_samples = None, flat = False, join_train_and_val = False, binarize = False):
     """
     The MNIST DataSet - the Drosophila of machine learning.
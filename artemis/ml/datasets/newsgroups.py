@@ -1,14 +1,14 @@
 import numpy as np
 
 from artemis.fileman.file_getter import get_file
-from artemis.general.should_be_builtins import memoize
+from artemis.general.should_be_builtins import memoize_with_settings
 from artemis.ml.datasets.datasets import DataSet
 
 
 __author__ = 'peter'
 
 
-@memoize
+@memoize_with_settings(max_entries=4)
 def get_20_newsgroups_dataset(filter_most_common = 2000, numeric = False, shuffling_seed = 1234, bag_of_words = False, count_scaling = None):
     """
     The 20 newsgroups dataset.  In this dataset, you try to predict the topic of a forum from the words contained in